@@ -1,4 +1,5 @@
 import itertools
+import random
 import time
 import json
 import os
@@ -6,16 +7,21 @@ import re
 from typing import Tuple, Dict
 from xml.etree import ElementTree
 
-from httpx import Timeout
+from httpx import Timeout, TransportError
 
 from .Uploader import SimpleProgress, Uploader
 
 
-API_RETRY = 3  # number of retries (include first try)
-API_RETRY_INTERVAL = 5  # Wait these seconds for the next retry
+API_RETRY = 5  # number of retries (include first try)
+API_RETRY_INTERVAL = 2  # Wait these seconds for the first retry, doubled for every next retry (with jitter).
+API_MAX_RETRY_INTERVAL = 60
 
 
 class Flickr(SimpleProgress, Uploader):
+    MAX_WORKERS = 4
+    RATE_LIMIT = 0.5  # each upload also makes API calls, which are limited to 3600 per hour.
+    RATE_BURST = 4
+
     def __init__(self, cookie_ffs, cookie_session):
         super().__init__(
             'POST', 'https://up.flickr.com/services/upload',
@@ -34,12 +40,20 @@ class Flickr(SimpleProgress, Uploader):
         self.auth_hash, self.api_key, self.user_id = auth_hash[1], api_key[1], user_id[1]
 
     def _request_api(self, data):
-        for _ in range(API_RETRY):
+        for i in range(API_RETRY):
+            if i:
+                time.sleep(self._get_retry_interval(i))
+
             headers = {'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8'}
-            self.last_response = self.client.post('https://api.flickr.com/services/rest', headers=headers, data=data)
+            try:
+                self.last_response = self.client.post(
+                    'https://api.flickr.com/services/rest', headers=headers, data=data)
+            except TransportError:
+                if i == API_RETRY - 1:
+                    raise
+                continue
 
             if self.last_response.status_code != 200:
-                time.sleep(API_RETRY_INTERVAL)
                 continue
 
             result = json.loads(self.last_response.text)
@@ -49,6 +63,13 @@ class Flickr(SimpleProgress, Uploader):
         else:
             raise FlickrAPIError('Last response status code: ' + str(self.last_response.status_code))
 
+    def _get_retry_interval(self, i):
+        """ returns seconds to wait before the `i`th retry, `Retry-After` header of the last response if any. """
+        retry_after = self.last_response.headers.get('Retry-After', '') if self.last_response is not None else ''
+        if retry_after.isdigit():
+            return min(int(retry_after), API_MAX_RETRY_INTERVAL)
+        return min(API_RETRY_INTERVAL * 2 ** (i - 1), API_MAX_RETRY_INTERVAL) * random.uniform(0.5, 1.0)
+
     def get_image_url_by_photo_id(self, photo_id):
         data = {
             'photo_id': photo_id,
@@ -104,24 +125,23 @@ class Flickr(SimpleProgress, Uploader):
 
         return [(title, title_urls[title]) for title in titles]
 
-    def upload_file(self, path: str) -> Tuple[str, Dict[str, str]]:
+    def upload_fobj(self, fobj, filename: str) -> Tuple[str, Dict[str, str]]:
         data = {
             'auth_hash': self.auth_hash,
             'api_key': self.api_key,
             'hidden': '2'  # hide from public searches.
         }
 
-        filename = os.path.split(path)[1]
-        with open(path, 'rb') as fobj:
-            self.last_response = self.upload(
-                data=data, files={
-                    'photo': (filename, fobj)
-                }
-            )
+        self.last_response = self.upload(
+            data=data, files={
+                'photo': (filename, fobj)
+            }
+        )
 
         if self.last_response.status_code == 504:
+            # the latest photo can be another worker's upload, so it's looked up by its title instead.
             name = os.path.splitext(filename)[0]
-            return self.get_image_url_by_latest(name), {}
+            return self.get_image_url_by_titles(name)[0][1], {}
         else:
             xml = ElementTree.fromstring(self.last_response.text)
             assert xml.attrib['stat'] == 'ok', self.last_response.text
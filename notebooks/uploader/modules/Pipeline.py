@@ -0,0 +1,200 @@
+import threading
+import sqlite3
+import queue
+import io
+import os
+from typing import Callable, List, Optional, Tuple
+
+from pngbin.meta import register_urls
+from .Scheduler import TokenBucket, get_retry_delay
+from .Uploader import Uploader
+
+
+class SpooledImage(io.BytesIO):
+    def __init__(self, pipeline: 'Pipeline', name: str):
+        """ An in-memory PngBin image file made by Pipeline.open(), use it as `fobj` of a writer.
+            Closing it hands it to the pipeline to be uploaded, its buffer is freed after the upload.
+        """
+        super().__init__()
+        self.name = name
+        self._pipeline = pipeline
+        self._submitted = False
+
+    def close(self):
+        if not self._submitted:
+            self._submitted = True
+            self._pipeline._submit(self)
+
+    def release(self):
+        """ Frees the buffer, this is called by the pipeline. """
+        self._submitted = True
+        try:
+            super().close()
+        except BufferError:
+            pass  # the buffer is still referenced somewhere, it will be freed when it's garbage collected.
+
+
+# ====================================================================================================================
+# Uploads PngBin images while they are being created, without writing them to disk.
+#
+# Use open(name) as `open_image` of Packer.pack() (or as the `fobj` of each image in ChainWriter `info`,
+# and close it once the image is finished), each image is then uploaded by worker threads
+# while the next images are being written. At most `max_pending` images
+# are kept in memory, open(name) blocks until an upload is done if there are already that many.
+# Uploaded image urls are kept in memory until save(conn) inserts them into a metadata database connection,
+# so they can be committed in the same transaction as the `images` and `files` rows.
+# Images that still fail after all retries, or are not uploaded before close(), are written to `spill_dir`
+# to be uploaded later by Scheduler.
+# ====================================================================================================================
+class Pipeline:
+    def __init__(self, uploader_factory: Callable[[], Uploader], spill_dir: Optional[str] = None,
+                 workers: Optional[int] = None, rate: Optional[float] = None, burst: Optional[float] = None,
+                 retries: int = 5, backoff: float = 2.0, max_backoff: float = 300.0,
+                 max_pending: Optional[int] = None):
+        """ Creates an upload pipeline for one host and starts its worker threads.
+
+        :param uploader_factory: A callable that returns a new Uploader instance (e.g. a subclass like Flickr).
+        :param spill_dir: Path to a directory to write images that failed to upload to, optional.
+        :param workers: Maximum number of concurrent uploads, defaults to the uploader's `MAX_WORKERS`.
+        :param rate: Maximum number of uploads started per second, defaults to the uploader's `RATE_LIMIT`.
+        :param burst: Maximum number of uploads started at once, defaults to the uploader's `RATE_BURST`.
+        :param retries: Maximum number of tries of each image before it's spilled.
+        :param backoff: Seconds to wait before the first retry, doubled for every next retry (with jitter).
+        :param max_backoff: Maximum seconds to wait before a retry.
+        :param max_pending: Maximum number of images in memory, including the one being written,
+                            defaults to `workers` + 2.
+        """
+        self.spill_dir = spill_dir
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._uploaders = [uploader_factory()]  # the first one tells the host limits.
+        cls = type(self._uploaders[0])
+        self.workers = workers or cls.MAX_WORKERS
+        self.bucket = TokenBucket(rate or cls.RATE_LIMIT, burst or cls.RATE_BURST)
+        self.max_pending = max_pending or self.workers + 2
+
+        self.results: List[Tuple[str, str, dict]] = []  # (name, image_url, extra) of uploaded images.
+        self.failed: List[Tuple[str, Optional[str], str]] = []  # (name, spilled path, error).
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pending = threading.Semaphore(self.max_pending)
+        self._queue = queue.Queue()
+
+        while len(self._uploaders) < self.workers:
+            self._uploaders.append(uploader_factory())
+        if self.workers > 1:
+            for uploader in self._uploaders:
+                uploader.progress_callback = lambda *_: None  # interleaved progress lines are unreadable.
+        self._threads = [threading.Thread(target=self._worker, args=(x,), daemon=True) for x in self._uploaders]
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+        return False
+
+    def open(self, name: str) -> SpooledImage:
+        """ Returns a new in-memory image file to be uploaded as `name` once it's closed. """
+        self._pending.acquire()
+        return SpooledImage(self, name)
+
+    def join(self):
+        """ Blocks until every closed image has been uploaded or spilled. """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            while thread.is_alive():
+                thread.join(0.5)
+
+    def close(self):
+        """ Stops the workers, images that have not been uploaded yet are spilled. Call join() first to wait. """
+        self._stop.set()
+        self.join()
+        for uploader in self._uploaders:
+            uploader.client.close()
+
+    def save(self, conn: sqlite3.Connection) -> int:
+        """ Inserts uploaded image urls into `urls` table with `conn` (without committing),
+            returns number of inserted urls.
+
+        :param conn: A connection to the metadata database file which has `images` rows of the uploaded images.
+        """
+        with self._lock:
+            entries = [(name, image_url) for name, image_url, _ in self.results]
+        return register_urls(conn, entries)[0]
+
+    def _submit(self, image: SpooledImage):
+        if self._stop.is_set():
+            try:
+                self._spill(image, 'stopped before upload')
+            finally:
+                image.release()
+                self._pending.release()
+        else:
+            self._queue.put(image)
+
+    def _worker(self, uploader: Uploader):
+        while True:
+            image = self._queue.get()
+            if image is None:
+                return
+            try:
+                if self._stop.is_set():
+                    self._spill(image, 'stopped before upload')
+                else:
+                    self._upload(uploader, image)
+            except Exception as e:  # keeps the worker alive, or nothing would drain the queue.
+                error = f'{type(e).__name__}: {e}'
+                with self._lock:
+                    self.failed.append((image.name, None, error))
+                print(f'[failed] {image.name} {error}')
+            finally:
+                image.release()
+                self._pending.release()
+
+    def _upload(self, uploader: Uploader, image: SpooledImage):
+        attempts = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                image_url, extra = uploader.upload_fobj(image, image.name)
+                break
+            except Exception as e:
+                attempts += 1
+                error = f'{type(e).__name__}: {e}'
+                if attempts >= self.retries:
+                    self._spill(image, error)
+                    return
+
+                delay = get_retry_delay(uploader, attempts, self.backoff, self.max_backoff)
+                print(f'[retry {attempts}/{self.retries - 1} in {delay:.1f}s] {image.name} {error}')
+                if self._stop.wait(delay):
+                    self._spill(image, f'stopped while waiting to retry, {error}')
+                    return
+
+        with self._lock:
+            self.results.append((image.name, image_url, extra))
+        print(f'[done] {image.name} {image_url}')
+
+    def _spill(self, image: SpooledImage, error: str):
+        """ writes an image that failed to upload to `spill_dir` if it's set,
+            a spilled image of the same name from an earlier run is replaced. """
+        path = None
+        if self.spill_dir:
+            path = os.path.join(self.spill_dir, image.name)
+            try:
+                with open(path, 'wb') as fobj:
+                    fobj.write(image.getbuffer())
+            except OSError as e:
+                error += f', cannot be written to {path}: {e}'
+                path = None
+        with self._lock:
+            self.failed.append((image.name, path, error))
+        print(f'[failed] {image.name} {error}' + (f', written to {path}' if path else ''))
@@ -1,4 +1,3 @@
-import os
 import re
 import secrets
 import string
@@ -13,6 +12,10 @@ ALPHABET = string.ascii_letters + string.digits
 
 
 class PostImages(SimpleProgress, Uploader):
+    MAX_WORKERS = 2
+    RATE_LIMIT = 0.5
+    RATE_BURST = 2
+
     def __init__(self):
         super().__init__(
             'POST', 'https://postimages.org/json/rr',
@@ -32,7 +35,7 @@ class PostImages(SimpleProgress, Uploader):
         response = self.client.request('DELETE', 'https://postimg.cc/json', data=data)
         return response.json()
 
-    def upload_file(self, path: str) -> Tuple[str, Dict[str, str]]:
+    def upload_fobj(self, fobj, filename: str) -> Tuple[str, Dict[str, str]]:
         data = {
             'token': self.token,
             'upload_session': ''.join(secrets.choice(ALPHABET) for _ in range(32)),
@@ -45,12 +48,11 @@ class PostImages(SimpleProgress, Uploader):
         headers = {
             'Accept': 'application/json'
         }
-        with open(path, 'rb') as fobj:
-            response = self.upload(
-                data=data, files={
-                    'file': (os.path.split(path)[1], fobj)
-                }, headers=headers
-            )
+        response = self.upload(
+            data=data, files={
+                'file': (filename, fobj)
+            }, headers=headers
+        )
 
         result = response.json()
         assert result['status'] == 'OK', result
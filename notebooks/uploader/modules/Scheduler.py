@@ -0,0 +1,272 @@
+import threading
+import sqlite3
+import random
+import json
+import time
+import os
+from typing import Callable, Iterable, Optional
+
+import httpx
+
+from .Uploader import Uploader
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1.0):
+        """ A thread-safe token bucket rate limiter.
+
+        :param rate: Number of tokens added per second.
+        :param capacity: Maximum number of tokens, this is how many acquires can burst at once.
+        """
+        if rate <= 0 or capacity < 1:
+            raise ValueError('`rate` must be greater than 0 and `capacity` must be at least 1.')
+
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n: float = 1.0) -> float:
+        """ Takes `n` tokens, blocks until they are available. Returns seconds spent waiting. """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return waited
+                delay = (n - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def get_retry_delay(uploader: Uploader, attempts: int, backoff: float, max_backoff: float) -> float:
+    """ Returns seconds to wait before the next try of a failed upload, which is `Retry-After` header
+        if the host sent one, otherwise exponential backoff with jitter.
+
+    :param uploader: The uploader which has failed, its `last_response` is checked if it has one.
+    :param attempts: Number of tries so far.
+    :param backoff: Seconds to wait before the first retry, doubled for every next retry.
+    :param max_backoff: Maximum seconds to wait.
+    """
+    response = getattr(uploader, 'last_response', None)
+    if isinstance(response, httpx.Response) and response.status_code in (429, 503):
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return min(float(retry_after), max_backoff)
+    return min(backoff * 2 ** (attempts - 1), max_backoff) * random.uniform(0.5, 1.0)
+
+
+# ====================================================================================================================
+# Uploads many files to one host with bounded concurrency, rate limiting and retries.
+#
+# Each worker thread has its own uploader instance made by `uploader_factory`, the host limits come from
+# the Uploader subclass (`MAX_WORKERS`, `RATE_LIMIT` and `RATE_BURST`) unless they are given.
+# Every file goes through a persistent queue (an sqlite database file) so an interrupted or crashed run
+# can be resumed by running it again, files that have been uploaded are never uploaded again.
+# The url of each upload is kept in the queue before it's saved, so a file whose url could not be saved
+# (e.g. the metadata database is locked) is only saved again when it's retried.
+# Uploaded image urls are inserted into `urls` table of the metadata database file right away
+# and/or appended to a text file in the old urls.txt format (name, url, empty line).
+# ====================================================================================================================
+class Scheduler:
+    _CREATE_SQL = """
+    CREATE TABLE IF NOT EXISTS "uploads" (
+        "name"     TEXT NOT NULL PRIMARY KEY,
+        "path"     TEXT NOT NULL,
+        "state"    TEXT NOT NULL DEFAULT 'queued',
+        "url"      TEXT,
+        "extra"    TEXT,
+        "attempts" INTEGER NOT NULL DEFAULT 0,
+        "error"    TEXT,
+        "updated"  REAL
+    );
+    """
+
+    def __init__(self, uploader_factory: Callable[[], Uploader], queue_path: str, meta_path: Optional[str] = None,
+                 urls_path: Optional[str] = None, workers: Optional[int] = None, rate: Optional[float] = None,
+                 burst: Optional[float] = None, retries: int = 5, backoff: float = 2.0, max_backoff: float = 300.0):
+        """ Creates an upload scheduler for one host.
+
+        :param uploader_factory: A callable that returns a new Uploader instance (e.g. a subclass like Flickr).
+        :param queue_path: Path to an sqlite database file of the persistent queue. It will be created if not exists.
+        :param meta_path: Path to a metadata database file to insert uploaded image urls into, optional.
+        :param urls_path: Path to a text file to append uploaded image urls to, optional.
+        :param workers: Maximum number of concurrent uploads, defaults to the uploader's `MAX_WORKERS`.
+        :param rate: Maximum number of uploads started per second, defaults to the uploader's `RATE_LIMIT`.
+        :param burst: Maximum number of uploads started at once, defaults to the uploader's `RATE_BURST`.
+        :param retries: Maximum number of tries of each file before it's marked as failed.
+        :param backoff: Seconds to wait before the first retry, doubled for every next retry (with jitter).
+        :param max_backoff: Maximum seconds to wait before a retry.
+        """
+        self.uploader_factory = uploader_factory
+        self.queue_path = queue_path
+        self.meta_path = meta_path
+        self.urls_path = urls_path
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._uploaders = [uploader_factory()]  # the first one tells the host limits.
+        cls = type(self._uploaders[0])
+        self.workers = workers or cls.MAX_WORKERS
+        self.bucket = TokenBucket(rate or cls.RATE_LIMIT, burst or cls.RATE_BURST)
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._conn = sqlite3.connect(queue_path, check_same_thread=False)
+        with self._conn:
+            self._conn.executescript(self._CREATE_SQL)
+            self._conn.execute(  # after a crash, 'uploaded' files are only saved again.
+                "UPDATE uploads SET state='queued' WHERE state IN ('uploading', 'uploaded');")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+        for uploader in self._uploaders:
+            uploader.client.close()
+
+    def add(self, paths: Iterable[str]) -> int:
+        """ Queues files to be uploaded by their file names, files that are already queued are skipped.
+            Returns number of newly queued files. """
+        with self._lock, self._conn:
+            return sum(self._conn.execute(
+                'INSERT OR IGNORE INTO uploads (name, path) VALUES (?, ?);', (os.path.split(x)[1], x)
+            ).rowcount for x in paths)
+
+    def retry_failed(self) -> int:
+        """ Queues failed files again, returns number of them. Files that have been uploaded
+            but failed to be saved keep their url, they are saved without being uploaded again. """
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "UPDATE uploads SET state='queued', attempts=0, error=NULL WHERE state='failed';").rowcount
+
+    def counts(self) -> dict:
+        """ Returns number of files of each state, e.g. {'queued': 10, 'done': 90}. """
+        with self._lock:
+            return dict(self._conn.execute('SELECT state, COUNT() FROM uploads GROUP BY state;').fetchall())
+
+    def run(self, on_result: Optional[Callable[[str, str, dict], None]] = None):
+        """ Uploads all queued files, blocks until the queue is empty or stop() is called.
+            If interrupted by KeyboardInterrupt, waits for the running uploads and re-raises.
+
+        :param on_result: An optional callable that takes (name, image_url, extra) of each uploaded file,
+                          it's called from worker threads.
+        """
+        self._stop.clear()
+        while len(self._uploaders) < self.workers:
+            self._uploaders.append(self.uploader_factory())
+        if self.workers > 1:
+            for uploader in self._uploaders:
+                uploader.progress_callback = lambda *_: None  # interleaved progress lines are unreadable.
+
+        threads = [threading.Thread(target=self._worker, args=(x, on_result), daemon=True)
+                   for x in self._uploaders[:self.workers]]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            self.stop()
+            for thread in threads:
+                thread.join()
+            raise
+
+    def stop(self):
+        """ Stops taking new files, running uploads are finished. """
+        self._stop.set()
+
+    def _claim(self) -> Optional[tuple]:
+        """ returns (name, path, attempts, url, extra) of the next queued file and marks it as uploading, or None.
+            `url` and `extra` are not None if it has been uploaded but not saved. """
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT name, path, attempts, url, extra FROM uploads WHERE state='queued' "
+                                     "ORDER BY name LIMIT 1;").fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE uploads SET state='uploading', updated=? WHERE name=?;",
+                                   (time.time(), row[0]))
+            return row
+
+    def _set(self, name: str, **columns):
+        columns['updated'] = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(f'UPDATE uploads SET {", ".join(x + "=?" for x in columns)} WHERE name=?;',
+                               (*columns.values(), name))
+
+    def _worker(self, uploader: Uploader, on_result: Optional[Callable]):
+        while not self._stop.is_set():
+            item = self._claim()
+            if item is None:
+                return
+            name, path, attempts, image_url, extra = item
+
+            try:
+                if image_url is None:
+                    result = self._upload(uploader, name, path, attempts)
+                    if result is None:
+                        continue
+                    if result is False:
+                        return
+                    image_url, extra = result
+                    self._set(name, state='uploaded', url=image_url, extra=json.dumps(extra), error=None)
+                else:
+                    extra = json.loads(extra) if extra else {}
+                self._save(name, image_url, extra)
+                self._set(name, state='done', error=None)
+            except Exception as e:  # keeps the worker running, e.g. when the database is locked.
+                error = f'{type(e).__name__}: {e}'
+                print(f'[failed] {name} {error}')
+                try:
+                    self._set(name, state='failed', error=error)  # retry_failed() queues it again, with its url.
+                except Exception:
+                    pass  # it's queued again when the queue file is opened next time.
+                continue
+
+            print(f'[done] {name} {image_url}')
+            if on_result is not None:
+                on_result(name, image_url, extra)
+
+    def _upload(self, uploader: Uploader, name: str, path: str, attempts: int):
+        """ uploads a file with retries, returns (image_url, extra) if uploaded,
+            None if it failed too many times, or False if stopped while waiting for a retry. """
+        while True:
+            self.bucket.acquire()
+            try:
+                return uploader.upload_file(path)
+            except Exception as e:
+                attempts += 1
+                error = f'{type(e).__name__}: {e}'
+                if attempts >= self.retries:
+                    self._set(name, state='failed', attempts=attempts, error=error)
+                    print(f'[failed] {name} {error}')
+                    return None
+
+                delay = self._get_delay(uploader, attempts)
+                self._set(name, attempts=attempts, error=error)
+                print(f'[retry {attempts}/{self.retries - 1} in {delay:.1f}s] {name} {error}')
+                if self._stop.wait(delay):
+                    self._set(name, state='queued')
+                    return False
+
+    def _get_delay(self, uploader: Uploader, attempts: int) -> float:
+        return get_retry_delay(uploader, attempts, self.backoff, self.max_backoff)
+
+    def _save(self, name: str, image_url: str, extra: dict):
+        """ writes an uploaded image url to the metadata database file and/or the urls text file. """
+        with self._lock:
+            if self.meta_path:
+                conn = sqlite3.connect(self.meta_path, timeout=30.0)
+                try:
+                    with conn:
+                        conn.execute('INSERT OR IGNORE INTO urls (url, images_id) '
+                                     'SELECT ?, id FROM images WHERE name=?;', (image_url, name))
+                finally:
+                    conn.close()
+            if self.urls_path:
+                with open(self.urls_path, 'a') as fobj:
+                    print(name, image_url, '', sep='\n', file=fobj)
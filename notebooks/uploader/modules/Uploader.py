@@ -2,17 +2,23 @@ from typing import (
     Callable,
     Dict,
     IO,
-    Iterable,
+    Iterator,
     Mapping,
     Optional,
     Sequence,
     Tuple,
     Union,
 )
+import mimetypes
+import secrets
+import mmap
+import time
+import os
 
 import httpx
 
-MIN_BUFFER_SIZE = 64 * 2**10  # 64KiB
+CHUNK_SIZE = 256 * 2**10  # 256KiB
+PROGRESS_INTERVAL = 0.5  # minimum seconds between two progress callbacks.
 USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; rv:78.0) Gecko/20100101 Firefox/78.0'
 
 FileContent = Union[IO[str], IO[bytes], str, bytes]
@@ -28,6 +34,11 @@ RequestFiles = Union[Mapping[str, FileTypes], Sequence[Tuple[str, FileTypes]]]
 
 
 class Uploader:
+    # Host limits used by Scheduler, subclasses should tune them to their host.
+    MAX_WORKERS = 2  # maximum number of concurrent uploads.
+    RATE_LIMIT = 0.5  # maximum number of uploads started per second.
+    RATE_BURST = 1  # maximum number of uploads started at once.
+
     def __init__(self, method: str, url: str, **client_kwargs):
         """ An uploader superclass with optional progress callback.
 
@@ -47,7 +58,7 @@ class Uploader:
     @staticmethod
     def progress_callback(bytes_read: int, bytes_total: int) -> None:
         """ Subclass can optionally overwrite this to make a progress output.
-            This will be called just before each buffer has been sent.
+            This will be called at most every `PROGRESS_INTERVAL` seconds while sending, and once at the end.
 
         :param bytes_read: Number of bytes this class has read so far.
         :param bytes_total: Number of total bytes to send.
@@ -62,24 +73,33 @@ class Uploader:
         :param request_kwargs: Pass optional keyword arguments to client.build_request.
         :return: A response of type httpx.Response.
         """
-        request = self.client.build_request(
-            self.method, self.url,
-            data=data, files=files,
-            **request_kwargs
-        )
-        bytes_total = int(request.headers['Content-Length'])
-        request.stream = StreamMonitor(
-            BufferedStream(request.stream, MIN_BUFFER_SIZE),
-            lambda bytes_read: self.progress_callback(bytes_read, bytes_total)
-        )
-        return self.client.send(request)
+        stream = MultipartStream(data, files, self.progress_callback)
+        headers = dict(request_kwargs.pop('headers', None) or {})
+        headers['Content-Type'] = stream.content_type
+        headers['Content-Length'] = str(stream.content_length)
+        request = self.client.build_request(self.method, self.url, headers=headers, **request_kwargs)
+        request.stream = stream
+        try:
+            return self.client.send(request)
+        finally:
+            stream.close()
 
     def upload_file(self, path: str) -> Tuple[str, Dict[str, str]]:
-        """ Subclass should implement this method as a wrapper of `upload()`.
+        """ Uploads a file by its path, see `upload_fobj()`.
 
         :param path: A path to a file you want to upload.
         :return: a tuple of (image_url, extra)
         """
+        with open(path, 'rb') as fobj:
+            return self.upload_fobj(fobj, os.path.split(path)[1])
+
+    def upload_fobj(self, fobj: IO[bytes], filename: str) -> Tuple[str, Dict[str, str]]:
+        """ Subclass should implement this method as a wrapper of `upload()`.
+
+        :param fobj: A binary file object to upload, e.g. an opened file or io.BytesIO.
+        :param filename: File name to upload as.
+        :return: a tuple of (image_url, extra)
+        """
         raise NotImplementedError
 
 
@@ -90,29 +110,92 @@ class SimpleProgress:
         print(f'{bytes_read:>{n}}/{bytes_total} {bytes_read / bytes_total:.2%}', end='\r')
 
 
-class StreamMonitor(httpx.SyncByteStream):
-    def __init__(self, stream: Iterable[bytes], callback: Callable):
-        self.stream = stream
+class MultipartStream(httpx.SyncByteStream):
+    def __init__(self, data: dict, files: RequestFiles, callback: Callable[[int, int], None],
+                 chunk_size: int = CHUNK_SIZE):
+        """ A multipart/form-data request body with a known length, which is sent without copying file contents.
+
+        File contents are sent as memoryview slices of their buffers, which is an mmap of a real file,
+        the buffer of an io.BytesIO, or the bytes-like object itself.
+
+        :param data: A mapping data to send.
+        :param files: A mapping file to send.
+        :param callback: A callable that takes (bytes_read, bytes_total), called at most every
+                         `PROGRESS_INTERVAL` seconds and once when everything has been read.
+        :param chunk_size: Maximum length in bytes of each chunk of file contents.
+        """
         self.callback = callback
-        self.bytes_read = 0
-
-    def __iter__(self) -> bytes:
-        for chunk in self.stream:
-            self.bytes_read += len(chunk)
-            self.callback(self.bytes_read)
-            yield chunk
-
-
-class BufferedStream:
-    def __init__(self, stream: Iterable[bytes], min_size: int):
-        self.stream = stream
-        self.min_size = min_size
-
-    def __iter__(self) -> bytes:
-        chunks = bytearray()
-        for chunk in self.stream:
-            chunks.extend(chunk)
-            if len(chunks) >= self.min_size:
-                yield bytes(chunks)
-                chunks.clear()
-        yield bytes(chunks)
+        self.chunk_size = chunk_size
+        self.boundary = secrets.token_hex(16)
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+        self._mmaps = []
+        self._parts = []  # bytes of headers and values, memoryviews of file contents.
+
+        for name, value in data.items():
+            self._parts.append(self._get_header(name) + b'\r\n\r\n')
+            self._parts.append((value if isinstance(value, bytes) else str(value).encode('utf-8')) + b'\r\n')
+
+        for name, value in (files.items() if isinstance(files, Mapping) else files):
+            filename, fobj, content_type = (tuple(value) + (None,) * 2)[:3] if isinstance(value, tuple) \
+                else (None, value, None)
+            if filename is None:
+                filename = os.path.basename(getattr(fobj, 'name', None) or 'upload')
+            content_type = content_type or (filename and mimetypes.guess_type(filename)[0]) \
+                or 'application/octet-stream'
+            self._parts.append(self._get_header(name, filename) + f'\r\nContent-Type: {content_type}\r\n\r\n'
+                               .encode('utf-8'))
+            self._parts.append(self._get_buffer(fobj))
+            self._parts.append(b'\r\n')
+        self._parts.append(f'--{self.boundary}--\r\n'.encode('utf-8'))
+
+        self.content_length = sum(len(x) for x in self._parts)
+
+    def __iter__(self) -> Iterator[bytes]:
+        bytes_read = 0
+        last_callback = time.monotonic()
+        for part in self._parts:
+            for i in range(0, len(part), self.chunk_size) if isinstance(part, memoryview) else [None]:
+                chunk = part if i is None else part[i:i + self.chunk_size]
+                yield chunk
+                bytes_read += len(chunk)
+                now = time.monotonic()
+                if now - last_callback >= PROGRESS_INTERVAL or bytes_read == self.content_length:
+                    last_callback = now
+                    self.callback(bytes_read, self.content_length)
+
+    def close(self):
+        """ Releases the file buffers, call this after the request has been sent. """
+        self._parts.clear()
+        for x in self._mmaps:
+            try:
+                x.close()
+            except BufferError:
+                pass  # a chunk is still referenced somewhere, it will be closed when it's garbage collected.
+        self._mmaps.clear()
+
+    def _get_header(self, name: str, filename: Optional[str] = None) -> bytes:
+        header = f'--{self.boundary}\r\nContent-Disposition: form-data; name="{self._quote(name)}"'
+        if filename is not None:
+            header += f'; filename="{self._quote(filename)}"'
+        return header.encode('utf-8')
+
+    @staticmethod
+    def _quote(value: str) -> str:
+        return value.replace('\\', '\\\\').replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+
+    def _get_buffer(self, fobj) -> memoryview:
+        """ returns a read-only memoryview of the whole content of `fobj` without copying it if possible. """
+        if isinstance(fobj, str):
+            return memoryview(fobj.encode('utf-8'))
+        if isinstance(fobj, (bytes, bytearray, memoryview)):
+            return memoryview(fobj).cast('B').toreadonly()
+        if hasattr(fobj, 'getbuffer'):  # io.BytesIO
+            return fobj.getbuffer().toreadonly()
+        try:
+            fileno = fobj.fileno()
+        except (AttributeError, OSError):
+            return memoryview(fobj.read())
+        if os.fstat(fileno).st_size == 0:
+            return memoryview(b'')
+        self._mmaps.append(mmap.mmap(fileno, 0, access=mmap.ACCESS_READ))
+        return memoryview(self._mmaps[-1])
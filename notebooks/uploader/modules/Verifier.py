@@ -0,0 +1,189 @@
+import concurrent.futures
+import sqlite3
+import random
+import time
+import io
+from typing import Callable, Optional, Tuple
+
+import httpx
+
+from pngbin import Writer
+from pngbin.meta import add_health_columns
+from .Uploader import USER_AGENT
+
+BLOCK_SIZE = 0xffff  # length in bytes of each zlib stored block, except the last one.
+FOOTER = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+
+
+class VerifyError(Exception):
+    """ Raises when an uploaded image is not the same PngBin image that has been uploaded. """
+    pass
+
+
+# ====================================================================================================================
+# Checks uploaded images in a metadata database file without downloading them,
+# hosts sometimes recompress, resize or truncate images and they would only fail when they are read.
+#
+# Each url is checked with a few small range requests:
+#   - Total length from `Content-Range` header must be the length of PngBin image of the known width and height.
+#   - PNG signature, IHDR chunk, IDAT length and zlib header must be exactly what Writer writes.
+#   - The 5-byte header of a few randomly chosen zlib stored blocks and the filter bytes after them.
+#   - The footer must end with IEND chunk, its CRC32 is recorded and compared to the previous check
+#     and to the other urls of the same image.
+# Results are written to `status`, `error`, `checked_at`, `latency` and `crc32` columns of `urls` table,
+# which are added if they don't exist yet (see URLS_HEALTH_COLUMNS of pngbin.meta). `status` is 'ok', 'bad',
+# or 'error' if the url could not be checked (e.g. a timeout), which is checked again by the next run.
+# ====================================================================================================================
+class Verifier:
+    def __init__(self, meta_path: str, workers: int = 16, samples: int = 4, timeout: float = 30.0,
+                 **client_kwargs):
+        """ Creates a verifier of uploaded image urls.
+
+        :param meta_path: Path to a metadata database file.
+        :param workers: Maximum number of concurrent requests.
+        :param samples: Number of randomly chosen zlib stored blocks to check in each image.
+        :param timeout: Timeout in seconds of each request.
+        :param client_kwargs: Pass optional keyword arguments to httpx.Client.
+        """
+        self.meta_path = meta_path
+        self.workers = workers
+        self.samples = samples
+
+        client_kwargs.setdefault('headers', {'User-Agent': USER_AGENT})
+        client_kwargs.setdefault('follow_redirects', True)
+        self.client = httpx.Client(timeout=timeout, limits=httpx.Limits(max_connections=workers), **client_kwargs)
+
+        self._conn = sqlite3.connect(meta_path)
+        with self._conn:
+            add_health_columns(self._conn)
+
+    def close(self):
+        self._conn.close()
+        self.client.close()
+
+    def run(self, recheck_after: Optional[float] = None,
+            on_result: Optional[Callable[[str, str, Optional[str]], None]] = None) -> dict:
+        """ Checks urls that have never been checked or could not be checked (status 'error'),
+            blocks until they are done. Returns number of urls of each status, e.g. {'ok': 90, 'bad': 2}.
+
+        :param recheck_after: If not None, urls that have been checked more than this number of seconds ago
+                              are checked again. Use 0 to check every url.
+        :param on_result: An optional callable that takes (url, status, error) of each checked url.
+        """
+        query = 'SELECT urls.rowid, url, width, height FROM urls JOIN images ON images.id = urls.images_id ' \
+                "WHERE checked_at IS NULL OR status = 'error'"
+        params = ()
+        if recheck_after is not None:
+            query += ' OR checked_at <= ?'
+            params = (time.time() - recheck_after,)
+        rows = self._conn.execute(query + ' ORDER BY urls.rowid;', params).fetchall()
+
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            futures = {executor.submit(self.verify, url, width, height): (rowid, url)
+                       for rowid, url, width, height in rows}
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    rowid, url = futures[future]
+                    status, error = self._save(rowid, future)
+                    if on_result is not None:
+                        on_result(url, status, error)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        return dict(self._conn.execute(
+            'SELECT status, COUNT() FROM urls WHERE status IS NOT NULL GROUP BY status;').fetchall())
+
+    def verify(self, url: str, width: int, height: int) -> Tuple[int, float]:
+        """ Checks a PngBin image by its url, raises VerifyError if it's not as expected.
+
+        :return: a tuple of (crc32, latency), CRC32 of IDAT chunk from the footer and seconds until the first response.
+        """
+        fobj = io.BytesIO()
+        length = Writer(width, height, fobj).result_length
+        header = fobj.getvalue()  # Writer writes the whole header right away.
+        stream_length = width * height * 4 + height  # length of all stored blocks data including filter bytes.
+        n_blocks = -(-stream_length // BLOCK_SIZE)
+
+        start = time.monotonic()
+        data, total = self._get_range(url, 0, len(header) + self._get_sample_length(0, width, stream_length) - 1)
+        latency = time.monotonic() - start
+        if total != length:
+            raise VerifyError(f'Length is {total} bytes, expected {length} bytes.')
+        if data[:len(header)] != header:
+            raise VerifyError('Header is not the same, the image might have been re-encoded.')
+        self._check_block(data[len(header):], 0, width, stream_length)
+
+        footer, _ = self._get_range(url, length - 20, length - 1)
+        if footer[8:] != FOOTER:
+            raise VerifyError('IEND chunk is not at the end of the image.')
+
+        for k in random.sample(range(1, n_blocks), min(self.samples, n_blocks - 1)):
+            first = len(header) + k * (BLOCK_SIZE + 5)
+            data, _ = self._get_range(url, first, first + self._get_sample_length(k, width, stream_length) - 1)
+            self._check_block(data, k, width, stream_length)
+
+        return int.from_bytes(footer[4:8], 'big'), latency
+
+    def _get_range(self, url: str, first: int, last: int) -> Tuple[bytes, int]:
+        """ returns a tuple of (content, total length) of a range request. """
+        response = self.client.get(url, headers={'Range': f'bytes={first}-{last}'})
+        if response.status_code != 206:
+            raise VerifyError(f'Expected 206 response, got {response.status_code}.')
+        content_range = response.headers.get('Content-Range', '')
+        try:
+            total = int(content_range.rsplit('/', 1)[1])
+        except (IndexError, ValueError):
+            raise VerifyError(f'Invalid Content-Range header: {content_range!r}')
+        if len(response.content) != last - first + 1:
+            raise VerifyError(f'Expected {last - first + 1} bytes of range {first}-{last}, '
+                              f'got {len(response.content)} bytes.')
+        return response.content, total
+
+    @staticmethod
+    def _get_sample_length(k: int, width: int, stream_length: int) -> int:
+        """ returns length in bytes of a sample of k-th zlib stored block,
+            which is its header and enough data to have at least one filter byte. """
+        return 5 + min(stream_length - k * BLOCK_SIZE, width * 4 + 1)
+
+    @staticmethod
+    def _check_block(data: bytes, k: int, width: int, stream_length: int):
+        """ checks a sample of k-th zlib stored block, raises VerifyError if it's invalid. """
+        n = stream_length - k * BLOCK_SIZE  # length that is left from this block.
+        if n > BLOCK_SIZE:
+            expected = b'\x00\xff\xff\x00\x00'
+        else:
+            expected = b'\x01' + n.to_bytes(2, 'little') + (BLOCK_SIZE - n).to_bytes(2, 'little')
+        if data[:5] != expected:
+            raise VerifyError(f'Invalid zlib stored block header at block {k}.')
+
+        row = width * 4 + 1
+        first = k * BLOCK_SIZE  # position of the first byte of this block in all blocks data.
+        for i in range(-first % row, len(data) - 5, row):
+            if data[5 + i] != 0:
+                raise VerifyError(f'Invalid filter byte at block {k}.')
+
+    def _save(self, rowid: int, future: concurrent.futures.Future) -> Tuple[str, Optional[str]]:
+        """ writes a result of verify() to `urls` table, returns a tuple of (status, error). """
+        crc32 = latency = None
+        try:
+            crc32, latency = future.result()
+            previous = self._conn.execute(
+                "SELECT crc32 FROM urls WHERE crc32 IS NOT NULL AND (rowid=? OR status='ok' AND images_id="
+                "(SELECT images_id FROM urls WHERE rowid=?));", (rowid, rowid)
+            ).fetchall()
+            if any(x[0] != crc32 for x in previous):
+                raise VerifyError('Checksum is not the same as the previous check or the other urls of the image.')
+            status, error = 'ok', None
+        except VerifyError as e:
+            status, error = 'bad', f'{type(e).__name__}: {e}'
+        except httpx.HTTPError as e:  # e.g. a timeout, the url is checked again by the next run().
+            status, error = 'error', f'{type(e).__name__}: {e}'
+
+        with self._conn:
+            self._conn.execute(
+                'UPDATE urls SET status=?, error=?, checked_at=?, latency=?, crc32=COALESCE(crc32, ?) WHERE rowid=?;',
+                (status, error, time.time(), latency, crc32, rowid)
+            )
+        return status, error
@@ -0,0 +1,212 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+import threading
+import hashlib
+import sqlite3
+import time
+import os
+
+
+# ====================================================================================================================
+# A local on-disk cache of whole (decrypted) PngBin files for PBFuse.
+#
+# Files get into the cache only by being prefetched or pinned, never as a side effect of a normal read.
+# Fetching runs in a background thread pool with a bounded number of workers.
+# Pinned files are never evicted, other resident files are evicted in least recently opened order
+# whenever their total size exceeds `max_size`.
+# Each resident file is stored with the row of `files` table it was fetched by, (offset, length, images_id),
+# a resident file whose row has been changed since (e.g. by an incremental pack) is stale and fetched again.
+#
+# The cache directory layout:
+#   index.db    = An sqlite database that keeps track of resident and pinned files.
+#   XX...XX     = Content of a resident file, named by the SHA-1 hex digest of its path.
+#   XX...XX.part = Content of a file that is being fetched.
+# ====================================================================================================================
+class Cache:
+    _CREATE_SQL = """
+    CREATE TABLE IF NOT EXISTS "entries" (
+        "path"  TEXT NOT NULL PRIMARY KEY,
+        "size"  INTEGER NOT NULL,
+        "atime" REAL NOT NULL,
+        "offset"    INTEGER,
+        "images_id" INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS "pins" (
+        "path"  TEXT NOT NULL PRIMARY KEY
+    );
+    """
+
+    def __init__(self, cache_dir: str, max_size: int, workers: int,
+                 fetch: Callable[[Tuple[int, int, int]], Iterator[bytes]]):
+        """ Creates a local cache instance.
+
+        :param cache_dir: Path to a directory that stores cached files. It will be created if it doesn't exist.
+        :param max_size: Maximum total size in bytes of resident files that are not pinned.
+        :param workers: Maximum number of files to be fetched concurrently.
+        :param fetch: A callable that takes a row (offset, length, images_id) of a file
+                      and returns an iterator of bytes of the whole file content.
+        """
+        if workers < 1:
+            raise ValueError('`workers` must have a value of at least 1.')
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._fetch = fetch
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(self.cache_dir, 'index.db'), check_same_thread=False)
+        with self._conn:
+            self._conn.executescript(self._CREATE_SQL)
+            columns = [x[1] for x in self._conn.execute('PRAGMA table_info(entries);')]
+            for name in ['offset', 'images_id']:  # added to existing index databases, their entries are stale.
+                if name not in columns:
+                    self._conn.execute(f'ALTER TABLE entries ADD COLUMN "{name}" INTEGER;')
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pbfuse-prefetch')
+        self._jobs = {}  # path -> [bytes_done, bytes_total, state], for queued and fetching files only.
+        self._errors = deque(maxlen=32)  # (path, message) of the latest failed fetches.
+
+    def close(self):
+        """ Cancels queued fetches, waits for running fetches and closes the index database. """
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            self._conn.close()
+
+    def open(self, path: str, row: Tuple[int, int, int]) -> Optional[int]:
+        """ Returns a read-only file descriptor of a resident file or None if `path` is not resident,
+            a stale file that was not fetched by the same `row` (offset, length, images_id) is removed. """
+        with self._lock:
+            if not self._is_resident(path, row):
+                return None
+            with self._conn:
+                self._conn.execute('UPDATE entries SET atime=? WHERE path=?;', (time.time(), path))
+        try:
+            return os.open(self._get_file(path), os.O_RDONLY)
+        except FileNotFoundError:
+            with self._lock, self._conn:
+                self._conn.execute('DELETE FROM entries WHERE path=?;', (path,))
+            return None
+
+    def enqueue(self, items: Iterable[Tuple[str, Tuple[int, int, int]]], pin: bool = False) -> int:
+        """ Queues files to be fetched into the cache, files that are already resident or queued are skipped.
+
+        :param items: An iterable of tuple (path, row) of files, `row` is (offset, length, images_id).
+        :param pin: If True, also pins the files so they will never be evicted.
+        :return: Number of newly queued files.
+        """
+        n = 0
+        with self._lock:
+            for path, row in items:
+                if pin:
+                    with self._conn:
+                        self._conn.execute('INSERT OR IGNORE INTO pins (path) VALUES (?);', (path,))
+                if path in self._jobs:
+                    continue
+                if self._is_resident(path, row):
+                    continue
+                self._jobs[path] = [0, row[1], 'queued']
+                self._executor.submit(self._job, path, row)
+                n += 1
+        return n
+
+    def unpin(self, paths: Iterable[str]) -> int:
+        """ Unpins files and makes them evictable again, returns number of unpinned files. """
+        with self._lock, self._conn:
+            n = sum(self._conn.execute('DELETE FROM pins WHERE path=?;', (x,)).rowcount for x in paths)
+        self._evict()
+        return n
+
+    def status(self) -> str:
+        """ Returns a human-readable text report of cache residency and prefetching progress. """
+        with self._lock:
+            jobs = sorted(self._jobs.items())
+            errors = list(self._errors)
+            rows = self._conn.execute(
+                'SELECT e.path, e.size, p.path IS NOT NULL FROM entries e LEFT JOIN pins p ON e.path=p.path '
+                'ORDER BY e.path;').fetchall()
+            pending_pins = self._conn.execute(
+                'SELECT COUNT() FROM pins WHERE path NOT IN (SELECT path FROM entries);').fetchone()[0]
+
+        total = sum(x[1] for x in rows)
+        pinned = sum(x[1] for x in rows if x[2])
+        lines = [
+            f'cache_dir: {os.path.abspath(self.cache_dir)}',
+            f'resident: {len(rows)} files, {total} bytes',
+            f'pinned: {sum(1 for x in rows if x[2])} files, {pinned} bytes ({pending_pins} not yet resident)',
+            f'limit (unpinned): {self.max_size} bytes',
+            f'queued: {sum(1 for _, x in jobs if x[2] == "queued")}, '
+            f'fetching: {sum(1 for _, x in jobs if x[2] == "fetching")}',
+            ''
+        ]
+        for path, (done, size, state) in jobs:
+            lines.append(f'[{state}] {done / size if size else 1.0:.1%} {done}/{size} {path}')
+        for path, message in errors:
+            lines.append(f'[error] {path}: {message}')
+        for path, size, is_pinned in rows:
+            lines.append(f'[{"pinned" if is_pinned else "cached"}] {size} {path}')
+        return '\n'.join(lines) + '\n'
+
+    def _get_file(self, path: str) -> str:
+        """ returns a local file path that stores the content of `path`. """
+        return os.path.join(self.cache_dir, hashlib.sha1(path.encode('utf-8')).hexdigest())
+
+    def _is_resident(self, path: str, row: Tuple[int, int, int]) -> bool:
+        """ returns True if `path` is resident and was fetched by `row`, otherwise removes its stale entry if any.
+            call it with `_lock` held. """
+        entry = self._conn.execute('SELECT offset, size, images_id FROM entries WHERE path=?;', (path,)).fetchone()
+        if entry is None:
+            return False
+        if entry == tuple(row):
+            return True
+        with self._conn:
+            self._conn.execute('DELETE FROM entries WHERE path=?;', (path,))
+        try:
+            os.remove(self._get_file(path))
+        except FileNotFoundError:
+            pass
+        return False
+
+    def _job(self, path: str, row: Tuple[int, int, int]):
+        """ Fetches a whole file into the cache, runs in the executor. """
+        job = self._jobs[path]
+        job[2] = 'fetching'
+        file = self._get_file(path)
+        size = row[1]
+        try:
+            with open(file + '.part', 'wb') as fobj:
+                for chunk in self._fetch(row):
+                    fobj.write(chunk)
+                    job[0] += len(chunk)
+            if job[0] != size:
+                raise EOFError(f'Fetched {job[0]} bytes (Expected: {size} bytes).')
+            os.replace(file + '.part', file)
+            with self._lock, self._conn:
+                self._conn.execute('INSERT OR REPLACE INTO entries (path, size, atime, offset, images_id) '
+                                   'VALUES (?, ?, ?, ?, ?);', (path, size, time.time(), row[0], row[2]))
+        except Exception as e:
+            self._errors.append((path, f'{type(e).__name__}: {e}'))
+            if os.path.exists(file + '.part'):
+                os.remove(file + '.part')
+        finally:
+            with self._lock:
+                del self._jobs[path]
+        self._evict()
+
+    def _evict(self):
+        """ Removes least recently opened unpinned files until their total size is within `max_size`. """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT path, size FROM entries WHERE path NOT IN (SELECT path FROM pins) ORDER BY atime DESC;'
+            ).fetchall()
+            total = sum(x[1] for x in rows)
+            with self._conn:
+                while rows and total > self.max_size:
+                    path, size = rows.pop()
+                    self._conn.execute('DELETE FROM entries WHERE path=?;', (path,))
+                    try:
+                        os.remove(self._get_file(path))
+                    except FileNotFoundError:
+                        pass
+                    total -= size
@@ -0,0 +1,103 @@
+from contextlib import contextmanager
+from typing import Iterator
+import threading
+import logging
+import random
+import bisect
+import time
+
+
+# ====================================================================================================================
+# Per-operation instrumentation for PBFuse.
+#
+# Each operation has a latency histogram with fixed bucket bounds (in milliseconds), and there are plain counters
+# for everything else (bytes served, cache hits, HTTP retries, etc.).
+# A `sample_rate` fraction of measured operations is also logged at DEBUG level to the "pbfuse" logger,
+# this replaces unconditional print() calls which are too costly on the hot path.
+# ====================================================================================================================
+class Stats:
+    BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)  # in milliseconds.
+
+    def __init__(self, sample_rate: float = 0.0):
+        """ Creates an empty instrumentation instance.
+
+        :param sample_rate: A fraction (0.0 to 1.0) of measured operations to be logged at DEBUG level.
+        """
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ValueError('`sample_rate` must have a value between (0.0 <= sample_rate <= 1.0).')
+
+        self.sample_rate = sample_rate
+        self.logger = logging.getLogger('pbfuse')
+        self.started = time.time()
+
+        self._lock = threading.Lock()
+        self._histograms = {}  # operation -> list of bucket counts, the last item counts values above all bounds.
+        self._totals = {}  # operation -> [count, sum of milliseconds, max milliseconds]
+        self._counters = {}
+
+    @contextmanager
+    def measure(self, operation: str, *detail) -> Iterator[None]:
+        """ Measures the latency of the enclosed block as `operation`, even if it raises an exception. """
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            ms = (time.perf_counter() - t) * 1000
+            self.record(operation, ms)
+            if self.sample_rate and random.random() < self.sample_rate:
+                self.logger.debug('%s %.3fms %s', operation, ms, ' '.join(map(str, detail)))
+
+    def record(self, operation: str, ms: float):
+        """ Adds a latency value in milliseconds of `operation`. """
+        with self._lock:
+            if operation not in self._histograms:
+                self._histograms[operation] = [0] * (len(self.BUCKETS) + 1)
+                self._totals[operation] = [0, 0.0, 0.0]
+            self._histograms[operation][bisect.bisect_left(self.BUCKETS, ms)] += 1
+            total = self._totals[operation]
+            total[0] += 1
+            total[1] += ms
+            total[2] = max(total[2], ms)
+
+    def add(self, counter: str, n: int = 1):
+        """ Adds `n` to a counter. """
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + n
+
+    def get(self, counter: str) -> int:
+        return self._counters.get(counter, 0)
+
+    def report(self) -> str:
+        """ Returns a human-readable text report of all counters and latency histograms. """
+        with self._lock:
+            counters = dict(self._counters)
+            totals = {k: list(v) for k, v in self._totals.items()}
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+
+        lines = [f'uptime: {time.time() - self.started:.0f}s']
+        for name, value in sorted(counters.items()):
+            lines.append(f'{name}: {value}')
+        for hit, miss in [('cache_hits', 'cache_misses'), ('reader_hits', 'reader_misses')]:
+            n = counters.get(hit, 0) + counters.get(miss, 0)
+            lines.append(f'{hit[:-5]}_hit_ratio: {counters.get(hit, 0) / n if n else 0.0:.2%}')
+
+        for operation, (count, total, maximum) in sorted(totals.items()):
+            histogram = histograms[operation]
+            lines.append('')
+            lines.append(f'[{operation}] count={count} mean={total / count:.3f}ms '
+                         f'p50<={self._percentile(histogram, count, 0.50)} '
+                         f'p90<={self._percentile(histogram, count, 0.90)} '
+                         f'p99<={self._percentile(histogram, count, 0.99)} max={maximum:.3f}ms')
+            for bound, n in zip(self.BUCKETS + (float('inf'),), histogram):
+                if n:
+                    lines.append(f'  <={bound}ms: {n}')
+        return '\n'.join(lines) + '\n'
+
+    def _percentile(self, histogram: list, count: int, q: float) -> str:
+        """ returns the upper bound of the bucket that the `q` quantile falls in. """
+        n = 0
+        for bound, x in zip(self.BUCKETS + (float('inf'),), histogram):
+            n += x
+            if n >= count * q:
+                return f'{bound}ms'
+        return 'infms'
@@ -1,10 +1,14 @@
-from pngbin import ChainReader
+from pngbin import ChainReader, HeaderCache, Index, InfoProvider
+
+from .Cache import Cache
+from .Stats import Stats
 
 from fuse import Fuse
 import fuse
 import requests
 
-from errno import EACCES, ENOENT
+from errno import EACCES, ENOENT, EROFS
+import logging
 import sqlite3
 import stat
 import os
@@ -15,6 +19,12 @@ fuse.feature_assert('stateful_files', 'has_init')
 
 DEFAULT_USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0'
 
+# A virtual directory for controlling the local cache.
+# Write line-separated paths (files or directories) to `prefetch`, `pin` or `unpin` to enqueue the operations,
+# read `status` for cache residency and prefetching progress, and read `stats` for operation latency and counters.
+CONTROL_DIR = '/.pbfuse'
+CONTROL_FILES = ('prefetch', 'pin', 'unpin', 'status', 'stats')
+
 
 class PBFuse(Fuse):
     def __init__(self, *args, **kwargs):
@@ -23,10 +33,19 @@ class PBFuse(Fuse):
 
         # options from `-o` and their default values
         self.meta_db = 'meta.db'
+        self.index_file = None
         self.header_file = None
+        self.cache_dir = '.pbfuse_cache'
+        self.cache_size = 1024
+        self.prefetch_workers = 4
+        self.debug_sample = 0.0
 
         # these will be initialized in fsinit()
         self.conn = None  # the connection for database file
+        self.index = None  # the memory-mapped index of database file, used instead of `conn` if given
+        self.info = None  # the provider of image info for readers
+        self.cache = None  # the local cache for prefetched and pinned files
+        self.stats = None  # the operation latency instrumentation
         self.defstat = {}  # default (directory) stat
         self.statfs_ = fuse.StatVfs()  # returned object for statfs()
 
@@ -41,6 +60,25 @@ class PBFuse(Fuse):
         self.conn.create_function("_PATH", 2, self._sqlite_path_func)
         self.file_class.conn = self.conn
         self.file_class.session = self.session
+        if self.index_file:
+            self.index = Index(self.index_file)
+            if self.index.is_outdated(self.meta_db):
+                logging.getLogger('pbfuse').warning('Index file "%s" is older than database file "%s", '
+                                                    'run "pngbin index" again.', self.index_file, self.meta_db)
+        self.file_class.index = self.index
+        headers = HeaderCache()  # the header of each image is checked before it's read, see ChainReader.
+
+        def get_fobj(urls):
+            if not urls:
+                raise NetReaderError('The image has no urls.')
+            return headers.wrap(urls[0], self.file_class._get_stream(urls[0]))
+        self.info = InfoProvider(self.meta_db, get_fobj, index=self.index)
+        self.file_class.info = self.info
+
+        self.stats = Stats(float(self.debug_sample))
+        self.file_class.stats = self.stats
+        self.cache = Cache(self.cache_dir, int(self.cache_size) * 1048576, int(self.prefetch_workers), self._fetch)
+        self.file_class.cache = self.cache
         
         m = os.stat(self.meta_db)
         self.defstat = {
@@ -48,9 +86,12 @@ class PBFuse(Fuse):
             'st_uid': os.getuid(), 'st_gid': os.getgid(),
             'st_atime': m.st_atime, 'st_mtime': m.st_mtime, 'st_ctime': m.st_ctime}
         
-        cur = self.conn.cursor()
-        sum_length = cur.execute('SELECT SUM(length) FROM files;').fetchone()[0]
-        count_length = cur.execute('SELECT COUNT(length) FROM files;').fetchone()[0]
+        if self.index is not None:
+            sum_length, count_length = self.index.total_length, self.index.file_count
+        else:
+            cur = self.conn.cursor()
+            sum_length = cur.execute('SELECT SUM(length) FROM files;').fetchone()[0] or 0
+            count_length = cur.execute('SELECT COUNT(length) FROM files;').fetchone()[0]
 
         self.statfs_.f_bsize = 1048576
         self.statfs_.f_frsize = 4096
@@ -58,12 +99,46 @@ class PBFuse(Fuse):
         self.statfs_.f_files = count_length
         self.statfs_.f_flag = os.ST_RDONLY
 
+    def fsdestroy(self):
+        if self.cache is not None:
+            self.cache.close()
+        if self.info is not None:
+            self.info.close()
+        if self.index is not None:
+            self.index.close()
+
     def getattr(self, path):
+        with self.stats.measure('getattr', path):
+            return self._getattr(path)
+
+    def readdir(self, path, offset):
+        with self.stats.measure('readdir', path):
+            return (yield from self._readdir(path, offset))
+
+    def _getattr(self, path):
         st = fuse.Stat(**self.defstat)
-        if path == '/':
-            return st  # if root, just return default stat
+        if path == '/' or path == CONTROL_DIR:
+            return st  # if root or control directory, just return default stat
+        if path.startswith(CONTROL_DIR + '/'):
+            name = path[len(CONTROL_DIR) + 1:]
+            if name not in CONTROL_FILES:
+                return -ENOENT
+            st.st_mode = stat.S_IFREG | (0o444 if name in ['status', 'stats'] else 0o666)
+            st.st_nlink = 1
+            st.st_size = len(self.control_data(name))
+            return st
         path = path.removeprefix('/') # discard the leading slash, if any
-            
+
+        if self.index is not None:
+            row = self.index.lookup(path)
+            if row is not None:
+                st.st_mode = stat.S_IFREG | 0o555
+                st.st_nlink = 1
+                st.st_size = row[1]
+            elif self.index.stat_dir(path + '/') is None:
+                return -ENOENT
+            return st
+
         cur = self.conn.cursor()
         cur.execute('SELECT path, length FROM files WHERE path LIKE ?;', (path + '%',))
         for full_path, length in cur:
@@ -78,17 +153,27 @@ class PBFuse(Fuse):
             return st
         return -ENOENT
     
-    def readdir(self, path, _):
+    def _readdir(self, path, _):
+        if path == CONTROL_DIR:
+            for name in CONTROL_FILES:
+                yield fuse.Direntry(name, type=stat.S_IFREG)
+            return
+        if path == '/':
+            yield fuse.Direntry(CONTROL_DIR[1:], type=stat.S_IFDIR)
+
         if not path.endswith('/'):
             path += '/'
         path = path.removeprefix('/')  # discard the leading slash, if any
-        
-        cur = self.conn.cursor()
-        cur.execute('SELECT _PATH(path, :u) '
-                    'FROM files '
-                    'WHERE path LIKE :v '
-                    'GROUP BY _PATH(path, :u)',
-                    {'u': len(path), 'v': path + '%'})
+
+        if self.index is not None:
+            cur = ((name,) for name, _, _ in self.index.listdir(path))
+        else:
+            cur = self.conn.cursor()
+            cur.execute('SELECT _PATH(path, :u) '
+                        'FROM files '
+                        'WHERE path LIKE :v '
+                        'GROUP BY _PATH(path, :u)',
+                        {'u': len(path), 'v': path + '%'})
         name = None
         for (name,) in cur:
             if name.endswith('/'):
@@ -110,35 +195,150 @@ class PBFuse(Fuse):
     def statfs(self):
         return self.statfs_
 
+    def truncate(self, path, size):
+        if path.startswith(CONTROL_DIR + '/'):
+            return 0  # control files are always empty, so `echo path > .pbfuse/pin` works.
+        return -EROFS
+
+    def control_data(self, name):
+        """ Returns the content of a control file when it is read. """
+        if name == 'status':
+            return self.cache.status().encode('utf-8')
+        if name == 'stats':
+            return self.stats.report().encode('utf-8')
+        return b''
+
+    def control(self, name, data):
+        """ Executes a control operation, `data` is line-separated paths of files or directories. """
+        paths = [x.strip().removeprefix('/') for x in data.decode('utf-8').splitlines() if x.strip()]
+        if name == 'unpin':
+            self.cache.unpin(path for path, _ in self._expand(paths))
+        elif name in ['prefetch', 'pin']:
+            self.cache.enqueue(self._expand(paths), pin=name == 'pin')
+
+    def _expand(self, paths):
+        """ Yields (path, (offset, length, images_id)) of all files matched by `paths`,
+            a directory path matches its whole subtree. """
+        if self.index is not None:
+            for path in paths:
+                prefix = path.rstrip('/') + '/' if path.rstrip('/') else ''
+                row = self.index.lookup(path)
+                if row is not None:
+                    yield path, row
+                for full_path, offset, length, images_id in self.index.iter_files(prefix):
+                    yield full_path, (offset, length, images_id)
+            return
+
+        cur = self.conn.cursor()
+        for path in paths:
+            prefix = path.rstrip('/') + '/' if path.rstrip('/') else ''
+            cur.execute('SELECT path, offset, length, images_id FROM files WHERE path=? OR path LIKE ?;',
+                        (path, prefix + '%'))
+            for full_path, *row in cur.fetchall():
+                if full_path == path or full_path.startswith(prefix):
+                    yield full_path, tuple(row)
+
+    def _fetch(self, row):
+        """ Yields the whole content of a file by its row (offset, length, images_id) in chunks,
+            used by the local cache from its worker threads. """
+        offset, length, images_id = row
+        if length == 0:
+            return
+        reader = ChainReader(
+            self.info.iter_info(images_id, offset, length), offset, length, decrypt=True, auto_close=True,
+            fallback=True)
+        try:
+            while reader.bytes_left > 0:
+                yield reader.read(1048576)
+        finally:
+            reader.close()
+
+    class ControlFile:
+        fs = None
+
+        def __init__(self, path, flags, *_):
+            self._name = path[len(CONTROL_DIR) + 1:]
+            self._buffer = bytearray()
+            self._data = self.fs.control_data(self._name)
+            self.direct_io = True  # content length is not known ahead of time.
+
+        def read(self, length, offset):
+            return self._data[offset:offset + length]
+
+        def write(self, buf, offset):
+            if self._name in ['status', 'stats']:
+                return -EACCES
+            self._buffer[offset:offset + len(buf)] = buf
+            return len(buf)
+
+        def release(self, flags):
+            if self._buffer:
+                self.fs.control(self._name, bytes(self._buffer))
+
     class PBFuseFile:
         conn = None
+        index = None
+        info = None
         session = None
-        
+        cache = None
+        stats = None
+        fs = None
+
+        def __new__(cls, path, flags, *_):
+            if path.startswith(CONTROL_DIR + '/'):
+                return cls.fs.ControlFile(path, flags)  # not an instance of `cls`, so __init__ is not called.
+            return super().__new__(cls)
+
         def __init__(self, path, flags, *_):
+            with self.stats.measure('open', path, flags):
+                self._open(path, flags)
+
+        def read(self, length, offset):
+            with self.stats.measure('read', self._path, length, offset):
+                data = self._read(length, offset)
+            self.stats.add('bytes_served', len(data))
+            return data
+
+        def release(self, flags):
+            with self.stats.measure('release', self._path, flags, len(self.readers)):
+                self._release(flags)
+
+        def write(self, buf, offset):
+            return -EROFS
+
+        def _open(self, path, flags):
             self._path = path
-            print('open:', self._path, flags)
-            
+
             # https://github.com/mafintosh/fuse-bindings/issues/25
             # assert flags == os.O_RDONLY or flags == 32768, flags
             
             self.readers = {}
             path = path.removeprefix('/')  # discard the leading slash, if any
-            cur = self.conn.cursor()
-            cur.execute('SELECT offset, length, images_id FROM files WHERE path=?;', (path,))
-            row = cur.fetchone()
+            if self.index is not None:
+                row = self.index.lookup(path)
+            else:
+                cur = self.conn.cursor()
+                cur.execute('SELECT offset, length, images_id FROM files WHERE path=?;', (path,))
+                row = cur.fetchone()
             if row is None:
                 raise FileNotFoundError(path)
             self.offset, self.length, self.images_id = row
+            self.fd = self.cache.open(path, row)  # a file descriptor if the file is resident in the local cache.
+            self.stats.add('cache_misses' if self.fd is None else 'cache_hits')
+
+        def _read(self, length, offset):
+            if self.fd is not None:
+                return os.pread(self.fd, length, offset)
 
-        def read(self, length, offset):
             reader = self.readers.get(offset, None)
             if reader is None:
-                print('read:', self._path, (length, offset))
-
+                self.stats.add('reader_misses')
                 reader = ChainReader(
-                    self._get_info(self.images_id),
-                    self.offset + offset, self.length - offset, decrypt=True, auto_close=True)
+                    self.info.iter_info(self.images_id, self.offset + offset, self.length - offset),
+                    self.offset + offset, self.length - offset, decrypt=True, auto_close=True, fallback=True)
                 self.readers[offset] = reader
+            else:
+                self.stats.add('reader_hits')
 
             data = reader.read(length)
 
@@ -151,26 +351,30 @@ class PBFuse(Fuse):
             
             return data
 
-        def release(self, flags):
-            print('rlse:', self._path, (flags, len(self.readers)))
-            
+        def _release(self, flags):
             for reader in self.readers.values():
                 reader.close()
+            if self.fd is not None:
+                os.close(self.fd)
 
-        def _get_stream(self, url):
+        @classmethod
+        def _get_stream(cls, url):
             def _fobj(first, last):
-                headers = {'Range': f'bytes={first}-{last}'}
+                headers = {'Range': f'bytes={first}-{"" if last is None else last}'}
                 err = None
-                for _ in range(3):  # if failed, retries two more tries.
+                for i in range(3):  # if failed, retries two more tries.
+                    cls.stats.add('http_requests')
+                    if i > 0:
+                        cls.stats.add('http_retries')
                     try:
-                        response = self.session.get(url, headers=headers, stream=True, timeout=30.0)
+                        response = cls.session.get(url, headers=headers, stream=True, timeout=30.0)
                         if response.status_code != 206:
                             raise NetReaderError('Invalid Status Code (Expect 206): ' + str(response.status_code))
                         ct = response.headers.get('Content-Type', '')
                         if ct != 'image/png':
                             raise NetReaderError('Invalid Content-Type Header: ' + ct)
                         cl = response.headers.get('Content-Length', '')
-                        if cl != str((last - first) + 1):
+                        if last is not None and cl != str((last - first) + 1):  # None is to the end (InflateReader).
                             raise NetReaderError('Invalid Content-Length Header: ' + cl)
                         return response.raw
                     except requests.RequestException as e:
@@ -180,27 +384,10 @@ class PBFuse(Fuse):
 
             return _fobj
 
-        def _get_info(self, images_id):
-            cur = self.conn.cursor()
-            while True:
-                cur.execute("SELECT key, iv, width, height FROM images WHERE id=?", (images_id,))
-                key, iv, width, height = cur.fetchone()
-
-                cur.execute("SELECT url FROM urls WHERE images_id=?", (images_id,))
-                url = cur.fetchone()[0]
-
-                yield {
-                    'width': width,
-                    'height': height,
-                    'key': key,
-                    'iv': iv,
-                    'fobj': self._get_stream(url)
-                }
-                images_id += 1
-
-
     def main(self, *args, **kwargs):
         self.file_class = self.PBFuseFile
+        self.file_class.fs = self
+        self.ControlFile.fs = self
         return Fuse.main(self, *args, **kwargs)
 
 
@@ -216,9 +403,25 @@ def main():
     pbf.parser.add_option(
         mountopt="meta_db", metavar="PATH", default='meta.db',
         help='Path to sqlite database file contains the metadata of PngBin images. (default: "%default")')
+    pbf.parser.add_option(
+        mountopt="index_file", metavar="PATH", default=None,
+        help='Path to an index file created by "pngbin index" from the database file, '
+             'for faster mounting and lookups.')
     pbf.parser.add_option(
         mountopt="header_file", metavar="PATH", default=None,
         help='Path to line-separated "key: value" text file for request headers.')
+    pbf.parser.add_option(
+        mountopt="cache_dir", metavar="PATH", default='.pbfuse_cache',
+        help='Path to a directory for prefetched and pinned files. (default: "%default")')
+    pbf.parser.add_option(
+        mountopt="cache_size", metavar="MIB", default=1024,
+        help='Maximum size in MiB of cached files that are not pinned. (default: %default)')
+    pbf.parser.add_option(
+        mountopt="debug_sample", metavar="RATE", default=0.0,
+        help='Fraction (0.0 to 1.0) of operations to be logged at DEBUG level. (default: %default)')
+    pbf.parser.add_option(
+        mountopt="prefetch_workers", metavar="N", default=4,
+        help='Maximum number of files to be prefetched concurrently. (default: %default)')
     pbf.parse(values=pbf, errex=1)
 
     if pbf.fuse_args.mount_expected():
@@ -226,6 +429,8 @@ def main():
             exit(f'Database file "{pbf.meta_db}" does not exist or is not a file.')
         if pbf.header_file is not None and not os.path.isfile(pbf.header_file):
             exit(f'Header file "{pbf.header_file}" does not exist or is not a file.')
+        if pbf.index_file is not None and not os.path.isfile(pbf.index_file):
+            exit(f'Index file "{pbf.index_file}" does not exist or is not a file.')
         
         if pbf.header_file:
             with open(pbf.header_file, 'r') as fobj:
@@ -234,6 +439,13 @@ def main():
                     pbf.session.headers[key.strip()] = value.strip()
         if 'User-Agent' not in pbf.session.headers:
             pbf.session.headers['User-Agent'] = DEFAULT_USER_AGENT
+        if float(pbf.debug_sample) > 0:
+            # only pbfuse logs at DEBUG level, other loggers (e.g. urllib3) would log every request.
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(asctime)s %(name)s: %(message)s'))
+            logger = logging.getLogger('pbfuse')
+            logger.addHandler(handler)
+            logger.setLevel(logging.DEBUG)
 
     pbf.main()
 
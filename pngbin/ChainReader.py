@@ -2,6 +2,8 @@ from typing import Iterator
 
 from . import Reader
 from . import DecryptReader
+from .Reader import InvalidPngError, read_header, parse_header
+from .InflateReader import InflateReader, InflateDecryptReader
 
 
 # ====================================================================================================================
@@ -9,6 +11,10 @@ from . import DecryptReader
 #
 # This class uses either Reader or DecryptReader as a reader class based on `decrypt` parameter.
 # This means most of the requirements are going to be the same as those classes.
+# If `fallback` is True, an image that has been recompressed is read with InflateReader or InflateDecryptReader
+# instead, so its callable `fobj` has to accept `last_offset` of None. Whether an image has been recompressed
+# is checked by its header before it's read (see parse_header), so wrap a callable `fobj` with HeaderCache
+# to read the header of each url only once.
 #
 # Note:
 #   If you specify `offset` or `length` parameters too large and you don't have enough PngBin file to cover it,
@@ -16,12 +22,15 @@ from . import DecryptReader
 # ====================================================================================================================
 class ChainReader:
     def __init__(self, info: Iterator[dict], offset: int, length: int,
-                 decrypt: bool = False, auto_close: bool = False):
+                 decrypt: bool = False, auto_close: bool = False, fallback: bool = False,
+                 check_header: bool = False):
         """ Creates a reader instance that joins multiple PngBin image files and read like they are just a single image.
 
         :param info:
             An iterator of dict-type, each item must yield with the only keys of `width`, `height`, and `fobj`
             as the same as expected in Reader and DecryptReader constructor parameters.
+            An optional `checkpoints` key is the Checkpoints of the image for InflateReader.
+            `width` and `height` can be omitted, they are then read from the header of the image.
             The class will read in order that it yields, from first to last, from end of one file to start of next file.
         :param offset:
             Data-offset of the combined PngBin files.
@@ -34,6 +43,13 @@ class ChainReader:
         :param auto_close:
             If True, calls `fobj.close()` on each iteration when skipped, the final byte of each PngBin file is read,
             or `length` bytes have been read (`bytes_left` == 0). It is a no-op if `fobj` does not have `close()`.
+        :param fallback:
+            If True, images that have been recompressed are read with InflateReader,
+            as well as images that Reader raises InvalidPngError on.
+        :param check_header:
+            If True, the header of each image is read and checked against its `width` and `height` before it's read,
+            which raises InvalidPngError early if the image is not what the metadata says (e.g. outdated metadata).
+            It is always checked if `fallback` is True.
         """
         if offset < 0:
             raise ValueError('`offset` cannot be less than 0.')
@@ -44,7 +60,11 @@ class ChainReader:
         self._offset = offset
         self._left = length
         self._reader_cls = DecryptReader if decrypt else Reader
+        self._inflate_cls = InflateDecryptReader if decrypt else InflateReader
         self._auto_close = auto_close
+        self._fallback = fallback
+        self._check_header = check_header or fallback
+        self._stored = None  # whether the current image has not been recompressed, None if its header isn't read.
 
         while True:  # skips until `offset` is within range.
             self._info = self._get_next_info()
@@ -73,11 +93,33 @@ class ChainReader:
         """
         if not 0 <= size <= self._left:
             size = self._left  # if out of range, changes the `size` value to read all that left.
-        buffer = bytearray()
-        while len(buffer) < size:
-            b = self._reader.read(size - len(buffer))
-            buffer.extend(b)
-            self._left -= len(b)
+        buffer = bytearray(size)
+        self.readinto(buffer)
+        return bytes(buffer)
+
+    def readinto(self, b) -> int:
+        """ reads and decrypts data into a pre-allocated writable bytes-like object `b`,
+            this avoids creating new objects when the same buffer is reused for every read.
+
+        :param b: writable bytes-like object, reads up to `len(b)` bytes or all the left bytes, whichever is less.
+        :return: number of bytes read into `b`.
+        """
+        view = memoryview(b).cast('B')
+        size = min(len(view), self._left)
+        pos = 0
+        while pos < size:
+            try:
+                n = self._reader.readinto(view[pos:size])
+            except InvalidPngError:
+                if not self._fallback or isinstance(self._reader, InflateReader):
+                    raise
+                if callable(self._info['fobj']):
+                    self._reader.close()
+                self._offset += self._reader_left - self._left  # reads again from where the failed read started.
+                self._reader = self._get_reader(inflate=True)
+                continue
+            pos += n
+            self._left -= n
             if self._left == 0:
                 if self._auto_close:
                     self._reader.close()
@@ -90,7 +132,7 @@ class ChainReader:
                 self._offset = 0  # From now on it always starts at offset 0.
                 self._info = self._get_next_info()
                 self._reader = self._get_reader()
-        return bytes(buffer)
+        return size
 
     def close(self):
         self._reader.close()
@@ -98,10 +140,38 @@ class ChainReader:
     def _get_next_info(self) -> dict:
         """ returns the next dict of `info`. """
         try:
-            return next(self._iter_info)
+            info = next(self._iter_info)
         except StopIteration:
             raise EOFError('`info` does not have enough items to read.')
+        self._stored = None
+        if 'width' not in info or 'height' not in info:  # skipped images are only read when it's needed.
+            width, height, self._stored = parse_header(read_header(info['fobj']))
+            info = dict(info, width=width, height=height)
+        return info
+
+    def _check_info(self):
+        """ reads the header of the current image if it hasn't been read, and checks it against the current info. """
+        if self._stored is None:
+            width, height, self._stored = parse_header(read_header(self._info['fobj']))
+            if (width, height) != (self._info['width'], self._info['height']):
+                raise InvalidPngError(f'The image is {width}x{height}, '
+                                      f'expected {self._info["width"]}x{self._info["height"]}.')
+        if not self._stored and not self._fallback:
+            raise InvalidPngError('The image has been recompressed.')
 
-    def _get_reader(self) -> (Reader, DecryptReader):
-        """ returns Reader or DecryptReader instance based on `decrypt` constructor parameter. """
-        return self._reader_cls(**self._info, offset=self._offset, length=self._left)
+    def _get_reader(self, inflate: bool = False) -> Reader:
+        """ returns Reader or DecryptReader instance based on `decrypt` constructor parameter,
+            or InflateReader or InflateDecryptReader if `inflate` is True or the image has been recompressed. """
+        info = dict(self._info)
+        checkpoints = info.pop('checkpoints', None)
+        self._reader_left = self._left  # `_left` when the reader is created.
+        if not inflate and self._check_header:
+            self._check_info()
+            inflate = not self._stored
+        if not inflate:
+            try:
+                return self._reader_cls(**info, offset=self._offset, length=self._left)
+            except InvalidPngError:
+                if not self._fallback:
+                    raise
+        return self._inflate_cls(**info, offset=self._offset, length=self._left, checkpoints=checkpoints)
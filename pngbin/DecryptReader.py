@@ -56,6 +56,8 @@ class DecryptReader(Reader):
         self._decryptor = Cipher(algorithms.AES(key), modes.CBC(_iv), backend=openssl_backend).decryptor()
 
         self._block_buffer = bytearray()  # For storing temporary decrypted bytes from a block.
+        self._cipher_buffer = bytearray()  # Reusable buffers for reading and decrypting, see _decrypt().
+        self._plain_buffer = bytearray()
         self.__left += rem  # Adjusts the state for the next line's read method.
         self.read(rem)  # Reads and discards initial decrypted bytes and stores the rest to temporary buffer.
 
@@ -72,20 +74,42 @@ class DecryptReader(Reader):
         """
         if not 0 <= size <= self.__left:
             size = self.__left  # if out of range, changes the `size` value to read all that left.
-        buffer = bytearray()
-        while len(buffer) < size:
-            n = size - len(buffer)
-            if self._block_buffer:  # Appends bytes that left in the block buffer first.
+        buffer = bytearray(size)
+        self.readinto(buffer)
+        return bytes(buffer)
+
+    def readinto(self, b) -> int:
+        """ reads fobj and decrypts into a pre-allocated writable bytes-like object `b`.
+
+        :param b: writable bytes-like object, reads up to `len(b)` bytes or all the left bytes, whichever is less.
+        :return: number of bytes read into `b`.
+        """
+        view = memoryview(b).cast('B')
+        size = min(len(view), self.__left)
+        pos = 0
+        while pos < size:
+            n = size - pos
+            if self._block_buffer:  # Copies bytes that left in the block buffer first.
                 n = min(n, len(self._block_buffer))
-                buffer.extend(self._block_buffer[:n])
+                view[pos:pos + n] = self._block_buffer[:n]
                 del self._block_buffer[:n]
             else:
                 m = (math.ceil(n / 16) * 16) - n  # A block size complementary (m+n is always divisible by 16).
-                blocks = self._decryptor.update(super().read(n + m))  # reads and decrypts in blocks.
+                blocks = self._decrypt(n + m)  # reads and decrypts in blocks.
+                view[pos:pos + n] = blocks[:n]  # Copies `n` bytes to `b` ...
                 if m > 0:
-                    buffer.extend(blocks[:n])  # Appends `n` bytes to `buffer` ...
                     self._block_buffer.extend(blocks[n:])  # ... And puts the rest (`m` bytes) to temp. block buffer.
-                else:
-                    buffer.extend(blocks)
+            pos += n
             self.__left -= n
-        return bytes(buffer)
+        return size
+
+    def _decrypt(self, size: int) -> memoryview:
+        """ reads and decrypts `size` bytes (divisible by 16) using reusable buffers, returns a view of the result.
+            The view is only valid until the next call. """
+        if len(self._cipher_buffer) < size:
+            self._cipher_buffer = bytearray(size)
+            self._plain_buffer = bytearray(size + 15)  # `update_into` requires extra space of block size - 1.
+        cipher_view = memoryview(self._cipher_buffer)[:size]
+        super()._readinto(cipher_view)
+        n = self._decryptor.update_into(cipher_view, self._plain_buffer)
+        return memoryview(self._plain_buffer)[:n]
@@ -0,0 +1,70 @@
+import threading
+import io
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from .Reader import HEADER_LENGTH
+
+
+# ====================================================================================================================
+# Caches the header (the first HEADER_LENGTH bytes) of PngBin image files by their url.
+#
+# A callable `fobj` that is wrapped by this class answers reads within the header from the cache,
+# so Reader.open() and ChainReader(fallback=True or check_header=True) only read the header of each url once.
+# Headers are kept in a bounded LRU cache of about 100 bytes per url, it can be shared between threads.
+# ====================================================================================================================
+class HeaderCache:
+    def __init__(self, size: int = 4096):
+        """ Creates an empty header cache.
+
+        :param size: Maximum number of cached headers.
+        """
+        self.size = size
+        self._cache = OrderedDict()  # url -> header
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, url: str) -> Optional[bytes]:
+        """ returns the cached header of `url`, or None if it's not cached. """
+        with self._lock:
+            header = self._cache.get(url)
+            if header is not None:
+                self._cache.move_to_end(url)
+            return header
+
+    def put(self, url: str, header: bytes):
+        with self._lock:
+            self._cache[url] = header
+            self._cache.move_to_end(url)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+
+    def discard(self, url: str):
+        """ removes the cached header of `url` if any, e.g. after the image has been replaced. """
+        with self._lock:
+            self._cache.pop(url, None)
+
+    def wrap(self, url: str, fobj: Callable) -> Callable:
+        """ returns a callable `fobj` of the same image that reads within the header from the cache,
+            the whole header is read with `fobj` and cached the first time. Other reads are passed to `fobj`.
+
+        :param url: url of the image, which is the key of its header.
+        :param fobj: A callable `fobj` for Reader of the image at `url`.
+        """
+        def _fobj(first_offset: int, last_offset: Optional[int]):
+            if last_offset is None or last_offset >= HEADER_LENGTH:
+                return fobj(first_offset, last_offset)
+            header = self.get(url)
+            if header is None:
+                f = fobj(0, HEADER_LENGTH - 1)
+                try:
+                    header = f.read(HEADER_LENGTH)
+                finally:
+                    if hasattr(f, 'close'):
+                        f.close()
+                if len(header) == HEADER_LENGTH:  # a short read is not cached.
+                    self.put(url, header)
+            return io.BytesIO(header[first_offset:last_offset + 1])
+        return _fobj
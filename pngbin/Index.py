@@ -0,0 +1,289 @@
+import bisect
+import struct
+import sqlite3
+import mmap
+import os
+from typing import Callable, Iterator, List, Optional, Tuple
+
+MAGIC = b'PBINDEX\x00'
+VERSION = 1
+
+# Fixed-size records of each section, all integers are little-endian.
+# A string is (offset, length) of its UTF-8 bytes in `strings` section, keys and ivs are stored there too.
+_HEADER = struct.Struct('<8sIqQQ' + 'QQ' * 6)  # magic, version, mtime_ns and size of meta.db, total length,
+#                                                then (offset, count) of strings, files, dirs, children, images, urls.
+_FILE = struct.Struct('<QIQQqQ')  # path, path length, offset, length, images_id, total length of the files before it.
+_DIR = struct.Struct('<QIQQQQ')  # path, path length, first file, last file (exclusive), first child, children count.
+_CHILD = struct.Struct('<q')  # index of a file, or bitwise NOT (~) of index of a directory.
+_IMAGE = struct.Struct('<qIIQQIQIQI')  # id, width, height, start, key, key length, iv, iv length, first url, count.
+_URL = struct.Struct('<QI')  # url, url length.
+
+
+class _Column:
+    def __init__(self, length: Callable[[], int], get: Callable[[int], object]):
+        """ A read-only sequence of `length()` items that are got by `get(i)`, so a section can be searched
+            with bisect without reading the whole section. """
+        self._length = length
+        self._get = get
+
+    def __len__(self):
+        return self._length()
+
+    def __getitem__(self, i):
+        return self._get(i)
+
+
+# ====================================================================================================================
+# A compact read-only binary index of a metadata database file, which is used through mmap.
+#
+# Everything a reader needs is compiled by build() into sorted fixed-size records, so opening an index is nearly
+# instant no matter how many files there are, and lookups are binary searches over the mapped pages:
+#   files    = Every file sorted by path (UTF-8 bytes, the same order as sqlite), with its offset, length, images_id.
+#              Files of a directory subtree are always adjacent, so its size and count are two lookups.
+#   dirs     = Every directory sorted by path with a trailing slash ("" for the root directory).
+#   children = Entries of each directory sorted by name, directory names have a trailing slash.
+#   images   = Every image sorted by id with its key, iv, dimension and `start`, the data-offset of the image
+#              in all images data that are chained in order of id (sum of capacities of the images before it).
+#   urls     = Urls of each image, the ones that are known to work and have lower latency come first.
+# An index never changes once it's built (build() replaces the file), so it can be shared by any number of threads
+# without locks. It doesn't follow changes of the metadata database file, use is_outdated() to check.
+# ====================================================================================================================
+class Index:
+    def __init__(self, path: str):
+        """ Opens an index file created by Index.build().
+
+        :param path: Path to an index file.
+        """
+        self.path = path
+        with open(path, 'rb') as fobj:
+            self._mm = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            header = _HEADER.unpack_from(self._mm, 0)
+        except struct.error:
+            header = (b'', 0)
+        if header[0] != MAGIC or header[1] != VERSION:
+            self._mm.close()
+            raise ValueError(f'"{path}" is not a PngBin index file of version {VERSION}.')
+
+        self._meta_stat = header[2:4]
+        self.total_length = header[4]  # total length in bytes of all files.
+        self._sections = [header[i:i + 2] for i in range(5, len(header), 2)]
+        self._paths = _Column(lambda: self._sections[1][1], lambda i: self._get_bytes(*self._get(1, _FILE, i)[:2]))
+        self._dirs = _Column(lambda: self._sections[2][1], lambda i: self._get_bytes(*self._get(2, _DIR, i)[:2]))
+        self._ids = _Column(lambda: self._sections[4][1], lambda i: self._get(4, _IMAGE, i)[0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+        return False
+
+    def close(self):
+        self._mm.close()
+
+    @property
+    def file_count(self) -> int:
+        return self._sections[1][1]
+
+    @property
+    def image_count(self) -> int:
+        return self._sections[4][1]
+
+    def is_outdated(self, meta_path: str) -> bool:
+        """ Returns True if the metadata database file has been modified since this index was built. """
+        st = os.stat(meta_path)
+        return (st.st_mtime_ns, st.st_size) != self._meta_stat
+
+    def lookup(self, path: str) -> Optional[Tuple[int, int, int]]:
+        """ Returns (offset, length, images_id) of a file by its path, or None if there's no such file. """
+        key = path.encode('utf-8')
+        i = bisect.bisect_left(self._paths, key)
+        if i < len(self._paths) and self._paths[i] == key:
+            return self._get(1, _FILE, i)[2:5]
+        return None
+
+    def stat_dir(self, path: str) -> Optional[Tuple[int, int]]:
+        """ Returns (total length, number of files) of a directory subtree, or None if there's no such directory.
+
+        :param path: Path of a directory with a trailing slash, or "" for the root directory.
+        """
+        i = self._find_dir(path)
+        if i is None:
+            return None
+        _, _, lo, hi, _, _ = self._get(2, _DIR, i)
+        return self._get_cumulative(hi) - self._get_cumulative(lo), hi - lo
+
+    def listdir(self, path: str, after: str = '', limit: int = -1) -> Iterator[Tuple[str, int, int]]:
+        """ Yields (name, size, count) of entries of a directory ordered by name, starting after `after`,
+            like rows of `dir_entries` table. Yields nothing if there's no such directory.
+
+        :param path: Path of a directory with a trailing slash, or "" for the root directory.
+        :param after: Name of the entry to start after, directory names have a trailing slash.
+        :param limit: Maximum number of entries to yield, < 0 for all entries.
+        """
+        i = self._find_dir(path)
+        if i is None:
+            return
+        _, _, _, _, first, count = self._get(2, _DIR, i)
+        n = len(path.encode('utf-8'))
+
+        def _get_child(k):
+            target, = self._get(3, _CHILD, first + k)
+            return target, self._paths[target][n:] if target >= 0 else self._dirs[~target][n:]
+
+        start = bisect.bisect_right(_Column(lambda: count, lambda k: _get_child(k)[1]), after.encode('utf-8'))
+        for k in range(start, count if limit < 0 else min(count, start + limit)):
+            target, name = _get_child(k)
+            if target >= 0:
+                yield name.decode('utf-8'), self._get(1, _FILE, target)[3], 1
+            else:
+                _, _, lo, hi, _, _ = self._get(2, _DIR, ~target)
+                yield name.decode('utf-8'), self._get_cumulative(hi) - self._get_cumulative(lo), hi - lo
+
+    def iter_files(self, prefix: str = '') -> Iterator[Tuple[str, int, int, int]]:
+        """ Yields (path, offset, length, images_id) of every file whose path starts with `prefix` ordered by path. """
+        key = prefix.encode('utf-8')
+        for i in range(bisect.bisect_left(self._paths, key), len(self._paths)):
+            path, n, offset, length, images_id, _ = self._get(1, _FILE, i)
+            path = self._get_bytes(path, n)
+            if not path.startswith(key):
+                return
+            yield path.decode('utf-8'), offset, length, images_id
+
+    def get_image(self, images_id: int) -> Tuple[bytes, bytes, int, int, int, List[str]]:
+        """ Returns (key, iv, width, height, start, urls) of an image, raises KeyError if there's no such image. """
+        i = bisect.bisect_left(self._ids, images_id)
+        if i == len(self._ids) or self._ids[i] != images_id:
+            raise KeyError(images_id)
+        return self._get_image(i)
+
+    def iter_images(self, images_id: int) -> Iterator[Tuple[int, bytes, bytes, int, int, int, List[str]]]:
+        """ Yields (id, key, iv, width, height, start, urls) of an image and all the images chained after it. """
+        self.get_image(images_id)  # raises KeyError early.
+        for i in range(bisect.bisect_left(self._ids, images_id), len(self._ids)):
+            yield (self._ids[i],) + self._get_image(i)
+
+    def position(self, images_id: int, offset: int) -> int:
+        """ Converts data-offset of an image to data-offset in all images data that are chained in order of id. """
+        return self.get_image(images_id)[4] + offset
+
+    def _find_dir(self, path: str) -> Optional[int]:
+        key = path.encode('utf-8')
+        i = bisect.bisect_left(self._dirs, key)
+        if i < len(self._dirs) and self._dirs[i] == key:
+            return i
+        return None
+
+    def _get(self, section: int, record: struct.Struct, i: int) -> tuple:
+        return record.unpack_from(self._mm, self._sections[section][0] + i * record.size)
+
+    def _get_bytes(self, offset: int, length: int) -> bytes:
+        start = self._sections[0][0] + offset
+        return self._mm[start:start + length]
+
+    def _get_cumulative(self, i: int) -> int:
+        """ returns total length of all files before i-th file. """
+        if i == len(self._paths):
+            return self.total_length
+        return self._get(1, _FILE, i)[5]
+
+    def _get_image(self, i: int) -> Tuple[bytes, bytes, int, int, int, List[str]]:
+        _, width, height, start, key, key_n, iv, iv_n, first, count = self._get(4, _IMAGE, i)
+        urls = [self._get_bytes(*self._get(5, _URL, k)).decode('utf-8') for k in range(first, first + count)]
+        return self._get_bytes(key, key_n), self._get_bytes(iv, iv_n), width, height, start, urls
+
+    @staticmethod
+    def build(meta_path: str, path: str) -> int:
+        """ Compiles a metadata database file into an index file, returns the number of files.
+            The index is written to a temporary file first and then replaces `path`,
+            so processes that have the old one opened keep reading it.
+
+        :param meta_path: Path to a metadata database file.
+        :param path: Path to the index file, it will be overwritten if exists.
+        """
+        st = os.stat(meta_path)
+        conn = sqlite3.connect(f'file:{meta_path}?mode=ro', uri=True)
+        try:
+            files = conn.execute('SELECT path, offset, length, images_id FROM files ORDER BY path;').fetchall()
+            images = conn.execute('SELECT id, key, iv, width, height FROM images ORDER BY id;').fetchall()
+            columns = [x[1] for x in conn.execute('PRAGMA table_info(urls);')]
+            order = "status IS 'bad', latency IS NULL, latency, " if 'latency' in columns else ''
+            urls = conn.execute(f'SELECT images_id, url FROM urls ORDER BY images_id, {order}rowid;').fetchall()
+        finally:
+            conn.close()
+
+        strings = bytearray()
+
+        def _add_bytes(b):
+            strings.extend(b)
+            return len(strings) - len(b), len(b)
+
+        paths = [x[0].encode('utf-8') for x in files]
+        file_records = bytearray()
+        total = 0
+        for p, (_, offset, length, images_id) in zip(paths, files):
+            file_records += _FILE.pack(*_add_bytes(p), offset, length, images_id, total)
+            total += length
+
+        dirs = {b''}
+        for p in paths:
+            i = p.find(b'/')
+            while i >= 0:
+                dirs.add(p[:i + 1])
+                i = p.find(b'/', i + 1)
+        dirs = sorted(dirs)
+        children = {d: [] for d in dirs}
+        for i, p in enumerate(paths):
+            children[p[:p.rfind(b'/') + 1]].append((p, i))
+        for i, d in enumerate(dirs[1:], 1):
+            children[d[:d.rfind(b'/', 0, -1) + 1]].append((d, ~i))
+
+        dir_records, child_records = bytearray(), bytearray()
+        n_children = 0
+        for d in dirs:
+            lo = bisect.bisect_left(paths, d)
+            hi = bisect.bisect_left(paths, d[:-1] + b'0') if d else len(paths)  # "0" comes right after "/".
+            entries = sorted(children[d])
+            dir_records += _DIR.pack(*_add_bytes(d), lo, hi, n_children, len(entries))
+            for _, target in entries:
+                child_records += _CHILD.pack(target)
+            n_children += len(entries)
+        del children
+
+        url_map = {}
+        for images_id, url in urls:
+            url_map.setdefault(images_id, []).append(url)
+        image_records, url_records = bytearray(), bytearray()
+        n_urls = start = 0
+        for images_id, key, iv, width, height in images:
+            image_urls = url_map.get(images_id, [])
+            image_records += _IMAGE.pack(images_id, width, height, start, *_add_bytes(key), *_add_bytes(iv),
+                                         n_urls, len(image_urls))
+            for url in image_urls:
+                url_records += _URL.pack(*_add_bytes(url.encode('utf-8')))
+            n_urls += len(image_urls)
+            start += width * height * 4
+
+        sections = [
+            (strings, len(strings)), (file_records, len(files)), (dir_records, len(dirs)),
+            (child_records, n_children), (image_records, len(images)), (url_records, n_urls)
+        ]
+        fields, pos = [], _HEADER.size
+        for data, count in sections:
+            fields += [pos, count]
+            pos += len(data)
+
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as fobj:
+                fobj.write(_HEADER.pack(MAGIC, VERSION, st.st_mtime_ns, st.st_size, total, *fields))
+                for data, _ in sections:
+                    fobj.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return len(files)
@@ -0,0 +1,319 @@
+import threading
+import bisect
+import struct
+import zlib
+from typing import NamedTuple, Optional
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from .Reader import Reader, InvalidPngError, IncompleteRead, SIGNATURE
+from .DecryptReader import DecryptReader
+
+READ_SIZE = 2**16  # maximum length in bytes of compressed data that is read from `fobj` at once.
+BATCH_SIZE = 2**22  # 4MiB, approximate length in bytes of data that is unfiltered at once.
+CHECKPOINT_INTERVAL = 2**22  # 4MiB, approximate length in bytes of data between two checkpoints.
+
+
+class _Checkpoint(NamedTuple):
+    row: int  # index of the next row to be decompressed.
+    png_offset: int  # png-offset of the next compressed byte to be read.
+    idat_left: int  # length in bytes of IDAT chunk data after `png_offset`, -1 if there are no more IDAT chunks.
+    inflater: 'zlib._Decompress'  # a copy of the zlib decompressor, which has to be copied again to be used.
+    tail: bytes  # compressed bytes that have been read but not decompressed yet.
+    prev: bytes  # the unfiltered row before `row`.
+
+
+# ====================================================================================================================
+# Checkpoints of a recompressed PngBin image, which are added by InflateReader while it inflates the image
+# so that the next readers can resume near their offset instead of inflating from the start.
+#
+# Each checkpoint has a copy of the zlib decompressor (about 40KiB) and a row of the image,
+# the same instance should only be used for the same image and can be shared between threads.
+# ====================================================================================================================
+class Checkpoints:
+    def __init__(self, interval: int = CHECKPOINT_INTERVAL):
+        """ Creates an empty list of checkpoints.
+
+        :param interval: approximate length in bytes of data between two checkpoints.
+        """
+        self.interval = interval
+        self._rows = []  # sorted row of each checkpoint.
+        self._items = []  # _Checkpoint of each row.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def find(self, row: int) -> Optional[_Checkpoint]:
+        """ returns the last checkpoint at or before `row`, or None if there's no such checkpoint. """
+        with self._lock:
+            i = bisect.bisect_right(self._rows, row)
+            return self._items[i - 1] if i else None
+
+    def add(self, checkpoint: _Checkpoint):
+        with self._lock:
+            i = bisect.bisect_left(self._rows, checkpoint.row)
+            if i == len(self._rows) or self._rows[i] != checkpoint.row:
+                self._rows.insert(i, checkpoint.row)
+                self._items.insert(i, checkpoint)
+
+
+# ====================================================================================================================
+# Use this class to read data from a PngBin image file that has been recompressed, e.g. by an image host.
+#
+# Reader only understands the exact layout of zlib stored blocks that Writer writes, but a host can re-encode
+# the image with real deflate and any filter method without changing its pixels. This class inflates the IDAT chunks
+# incrementally from the start of the image (or the nearest checkpoint) and reverses the filter of each row with NumPy,
+# so it has to inflate everything before `offset` and is much slower than Reader.
+#
+# Rows are unfiltered in batches, rows that use the filter of None, Sub or Up are done one row at a time,
+# and a batch that has Average or Paeth rows is done along its anti-diagonals (a wavefront),
+# since each pixel of those rows depends on the pixel on its left.
+#
+# Only 8-bit RGBA non-interlaced images of the same width and height are supported.
+# This class is derived from Reader class, So consult Its documentation for parameter details,
+# the exception is that a callable `fobj` is called with `last_offset` of None, which means to the end of the file.
+# ====================================================================================================================
+class InflateReader(Reader):
+    _stored_only = False
+
+    def __init__(self, width: int, height: int, fobj, offset: int = 0, length: int = 0,
+                 checkpoints: Optional[Checkpoints] = None):
+        """ Creates a reader instance of a recompressed PngBin image file.
+
+        :param checkpoints: Checkpoints of this image to resume from and to add to, if None, none are used.
+        """
+        if not 0 < width < 2**32:
+            raise ValueError('width must have a value between (0 < width < 2**32).')
+        if not 0 < height < 2**32:
+            raise ValueError('height must have a value between (0 < height < 2**32).')
+        if not 0 <= offset < width * height * 4:
+            raise ValueError('offset must have a value between (0 <= offset < width * height * 4).')
+
+        self._width, self._height = width, height
+        self._left = (self._width * self._height * 4) - offset  # length in bytes that left to be read.
+        if 0 < length < self._left:
+            self._left = length  # uses `length` if it's in a proper range.
+
+        if checkpoints is not None or not hasattr(self, '_checkpoints'):
+            self._checkpoints = checkpoints  # InflateDecryptReader sets it before this constructor is called.
+        self._batch_rows = max(1, BATCH_SIZE // (width * 4))  # checkpoints are at multiples of this.
+        self._checkpoint_batches = max(1, round(self._checkpoints.interval / (self._batch_rows * width * 4))) \
+            if self._checkpoints is not None else 0
+
+        checkpoint = self._checkpoints.find(offset // (width * 4)) if self._checkpoints is not None else None
+        if checkpoint is not None:
+            self._row = checkpoint.row
+            self._png_offset = checkpoint.png_offset
+            self._idat_left = checkpoint.idat_left
+            self._inflater = checkpoint.inflater.copy()
+            self._tail = checkpoint.tail
+            self._prev = np.frombuffer(checkpoint.prev, np.uint8)
+        else:
+            self._row = 0
+            self._png_offset = 0
+            self._idat_left = 0
+            self._inflater = zlib.decompressobj()
+            self._tail = b''
+            self._prev = np.zeros(width * 4, np.uint8)
+
+        if callable(fobj):
+            self._fobj = fobj(self._png_offset, None)
+            if not hasattr(self._fobj, 'read'):
+                raise AttributeError('`fobj` must return file-like object that has read method attribute.')
+        elif hasattr(fobj, 'read') and hasattr(fobj, 'seek'):
+            self._fobj = fobj
+            self._fobj.seek(self._png_offset, 0)
+        else:
+            raise AttributeError('`fobj` must be callable or file-like object '
+                                 'that has read and seek method attributes.')
+        if checkpoint is None:
+            self._read_head()
+
+        self._buffer = memoryview(b'')  # unfiltered data that has not been read yet.
+        self._skip = offset - self._row * width * 4  # length in bytes of unfiltered data to be discarded.
+
+    def _readinto(self, view: memoryview) -> int:
+        """ reads exactly `len(view)` bytes of data into `view`, which must not be more than `bytes_left`. """
+        size = len(view)
+        pos = 0
+        while pos < size:
+            if not self._buffer:
+                self._buffer = self._inflate_batch()
+                if self._skip:
+                    n = min(self._skip, len(self._buffer))
+                    self._buffer = self._buffer[n:]
+                    self._skip -= n
+                continue
+            n = min(size - pos, len(self._buffer))
+            view[pos:pos + n] = self._buffer[:n]
+            self._buffer = self._buffer[n:]
+            pos += n
+            self._left -= n
+        return size
+
+    def _inflate_batch(self) -> memoryview:
+        """ inflates and unfilters the next batch of rows, returns their data. """
+        rows = min(self._batch_rows, self._height - self._row)
+        if rows <= 0:
+            raise IncompleteRead('There are no more rows in the image.')
+        stride = self._width * 4 + 1
+        need = rows * stride
+        parts = []
+        n = 0
+        try:
+            while n < need:
+                if self._inflater.eof:
+                    raise IncompleteRead(f'The zlib stream ends at row {self._row + n // stride}.')
+                data = self._tail or self._read_idat()
+                if not data:
+                    raise IncompleteRead(f'The IDAT chunks end at row {self._row + n // stride}.')
+                out = self._inflater.decompress(data, need - n)
+                self._tail = self._inflater.unconsumed_tail
+                parts.append(out)
+                n += len(out)
+        except zlib.error as e:
+            raise InvalidPngError(f'Invalid zlib detected ({e}).')
+
+        batch = np.frombuffer(b''.join(parts), np.uint8).reshape(rows, stride)
+        types = batch[:, 0]
+        if types.max() > 4:
+            raise InvalidPngError('Invalid Filter detected.')
+        data = _unfilter(batch[:, 1:], types, self._prev)
+        self._prev = data[-1]
+        self._row += rows
+        data = np.ascontiguousarray(data)
+
+        if self._checkpoint_batches and self._row < self._height and \
+                (self._row // self._batch_rows) % self._checkpoint_batches == 0:
+            self._checkpoints.add(_Checkpoint(self._row, self._png_offset, self._idat_left, self._inflater.copy(),
+                                              self._tail, self._prev.tobytes()))
+        return memoryview(data).cast('B')
+
+    def _read_idat(self) -> bytes:
+        """ reads and returns the next compressed bytes of IDAT chunks, or b'' if there are no more. """
+        while self._idat_left == 0:
+            _, length, type_ = struct.unpack('>4sI4s', self._read(12))  # CRC32 of the previous chunk is ignored.
+            self._idat_left = length if type_ == b'IDAT' else -1
+        if self._idat_left < 0:
+            return b''
+        data = self._read(min(READ_SIZE, self._idat_left))
+        self._idat_left -= len(data)
+        return data
+
+    def _read_head(self):
+        """ reads and verifies PNG signature and IHDR chunk, skips other chunks until the first IDAT chunk.
+            if failed, raises InvalidPngError. """
+        if self._read(8) != SIGNATURE:
+            raise InvalidPngError('Invalid PNG signature.')
+        while True:
+            length, type_ = struct.unpack('>I4s', self._read(8))
+            if type_ == b'IDAT':
+                self._idat_left = length
+                return
+            data = self._read(length + 4)  # includes CRC32.
+            if type_ == b'IHDR':
+                width, height, depth, color, _, _, interlace = struct.unpack('>IIBBBBB', data[:13])
+                if (width, height) != (self._width, self._height):
+                    raise InvalidPngError(f'The image is {width}x{height}, '
+                                          f'expected {self._width}x{self._height}.')
+                if (depth, color, interlace) != (8, 6, 0):
+                    raise InvalidPngError('Only 8-bit RGBA non-interlaced images are supported.')
+            elif type_ == b'IEND':
+                raise InvalidPngError('There is no IDAT chunk in the image.')
+
+    def _read(self, size: int) -> bytes:
+        """ reads exactly `size` bytes of `fobj`, raises IncompleteRead if it has no more data. """
+        buffer = bytearray(size)
+        n = self._read_exactly(memoryview(buffer))
+        if n != size:
+            raise IncompleteRead(
+                f'The length of returning bytes is not equal to what requested. (Expected: {size}, Got: {n})'
+            )
+        self._png_offset += size
+        return bytes(buffer)
+
+
+# ====================================================================================================================
+# Use this class to read an encrypted PngBin image file that has been recompressed.
+#
+# This is DecryptReader that reads with InflateReader instead of Reader, So consult their documentation.
+# ====================================================================================================================
+class InflateDecryptReader(DecryptReader, InflateReader):
+    def __init__(self, width: int, height: int, fobj, key: bytes, iv: bytes, offset: int = 0, length: int = 0,
+                 checkpoints: Optional[Checkpoints] = None):
+        """ Creates a reader instance for decrypting an encrypted and recompressed PngBin image file. """
+        self._checkpoints = checkpoints
+        super().__init__(width, height, fobj, key, iv, offset, length)
+
+
+def _unfilter(data: np.ndarray, types: np.ndarray, prev: np.ndarray) -> np.ndarray:
+    """ reverses the filter of each row of a batch.
+
+    :param data: filtered rows without filter bytes, an uint8 array of (rows, width * 4).
+    :param types: filter type of each row.
+    :param prev: the unfiltered row before the batch.
+    :return: an uint8 array of unfiltered rows.
+    """
+    if not types.any():
+        return data
+    if types.max() <= 2:
+        out = np.empty_like(data)
+        last = prev
+        for i, t in enumerate(types.tolist()):
+            if t == 0:
+                out[i] = data[i]
+            elif t == 1:
+                np.cumsum(data[i].reshape(-1, 4), axis=0, dtype=np.uint8, out=out[i].reshape(-1, 4))
+            else:
+                np.add(data[i], last, out=out[i])
+            last = out[i]
+        return out
+    return _unfilter_wavefront(data, types, prev)
+
+
+def _unfilter_wavefront(data: np.ndarray, types: np.ndarray, prev: np.ndarray) -> np.ndarray:
+    """ reverses the filter of any rows along the anti-diagonals of the batch.
+
+        Pixel (r, c) depends on (r, c-1), (r-1, c) and (r-1, c-1), so pixels of the same r + c are independent.
+        Pixels are stored by anti-diagonal, pixel (r, c) is at s[r + c, r], so each step works on contiguous slices.
+        Row 0 is `prev` and column 0 of each row is a zero pixel.
+    """
+    rows, n = data.shape
+    width = n // 4
+    s = np.zeros((rows + width + 1, rows + 1, 4), np.int16)
+    f = np.zeros_like(s)
+    strides = ((rows + 2) * 8, (rows + 1) * 8, 2)  # strides of (r, c, channel) in `s` of int16.
+    pixels = as_strided(s, (rows + 1, width + 1, 4), strides)
+    pixels[0, 1:] = prev.reshape(width, 4)
+    as_strided(f, (rows + 1, width + 1, 4), strides)[1:, 1:] = data.reshape(rows, width, 4)
+
+    t = np.concatenate(([0], types))
+    masks = [np.repeat((t == k)[:, None], 4, axis=1).astype(np.int16) for k in range(5)]
+    counts = np.cumsum([t == k for k in range(5)], axis=1).tolist()  # counts[k][r] = rows of type k in [0, r].
+    for j in range(2, rows + width + 1):
+        lo, hi = max(1, j - width), min(rows, j - 1) + 1  # rows that have a pixel on this anti-diagonal.
+        a = s[j - 1, lo:hi]  # left.
+        b = s[j - 1, lo - 1:hi - 1]  # up.
+        c = s[j - 2, lo - 1:hi - 1]  # up-left.
+        x = f[j, lo:hi].copy()
+        for k in range(1, 5):
+            m = counts[k][hi - 1] - counts[k][lo - 1]
+            if not m:
+                continue
+            if k == 1:  # Sub.
+                y = a
+            elif k == 2:  # Up.
+                y = b
+            elif k == 3:  # Average.
+                y = (a + b) >> 1
+            else:  # Paeth, `da` and `db` are p - a and p - b, where p = a + b - c.
+                da, db = b - c, a - c
+                pc = np.abs(da + db)
+                pa, pb = np.abs(da), np.abs(db)
+                is_a = (pa <= pb) & (pa <= pc)
+                y = c + is_a * db + np.greater(pb <= pc, is_a) * da
+            x += y if m == hi - lo else masks[k][lo:hi] * y
+        np.bitwise_and(x, 0xff, out=s[j, lo:hi])
+    return np.ascontiguousarray(pixels[1:, 1:]).reshape(rows, n).astype(np.uint8)
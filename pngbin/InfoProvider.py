@@ -0,0 +1,213 @@
+import threading
+import sqlite3
+import queue
+import os
+from collections import OrderedDict
+from typing import Callable, Iterator, List, Optional
+
+from .Index import Index
+from .InflateReader import Checkpoints
+
+# Images of a run that starts at image `:id` (or the first image after it) and follows the order of id,
+# until the run has at least `:left` bytes of data, with urls of each image (one row per url).
+_RUN_SQL = """
+WITH RECURSIVE "run"("id", "end") AS (
+    SELECT id, width * height * 4 FROM images WHERE id = {anchor}
+    UNION ALL
+    SELECT i.id, run."end" + i.width * i.height * 4
+    FROM run JOIN images i ON i.id = (SELECT MIN(id) FROM images WHERE id > run.id)
+    WHERE run."end" < :left
+)
+SELECT i.id, i.key, i.iv, i.width, i.height, u.url
+FROM run JOIN images i ON i.id = run.id LEFT JOIN urls u ON u.images_id = i.id
+ORDER BY i.id, {order}u.rowid;
+"""
+
+
+class _Image:
+    __slots__ = ('id', 'key', 'iv', 'width', 'height', 'urls', 'next_id')
+
+    def __init__(self, id_: int, key: bytes, iv: bytes, width: int, height: int):
+        """ A cached record of an image, `next_id` is None until the image after it is known. """
+        self.id = id_
+        self.key = key
+        self.iv = iv
+        self.width = width
+        self.height = height
+        self.urls = []
+        self.next_id = None
+
+
+# ====================================================================================================================
+# Provides `info` iterators of ChainReader(decrypt=True) from a metadata database file.
+#
+# All the images that a range of data spans are fetched with one query, which follows the order of id
+# (ids don't have to be contiguous), so opening a reader on a file that spans many images costs one query.
+# Image records are kept in a bounded LRU cache that is shared by every reader, so reading files
+# in the same images again costs no query at all. The cache is cleared whenever the database file (or its
+# write-ahead log) is modified, so urls that are registered later are seen, and images without urls are not cached.
+# It can be shared between threads, each query borrows
+# a read-only connection from a small pool of idle connections, so short-lived threads don't leak connections.
+# If `index` is given, images are looked up in it instead, which doesn't need the cache.
+# Each `info` also has Checkpoints of its image for ChainReader(fallback=True), which are kept for the images
+# that have been yielded most recently, so recompressed images don't have to be inflated from the start every time.
+# ====================================================================================================================
+class InfoProvider:
+    def __init__(self, meta_path: str, get_fobj: Callable[[List[str]], Callable], cache_size: int = 4096,
+                 index: Optional[Index] = None, checkpoints_size: int = 64, pool_size: int = 4):
+        """ Creates an info provider of a metadata database file.
+
+        :param meta_path: Path to a metadata database file.
+        :param get_fobj: A callable that takes urls of an image and returns its `fobj` callable for Reader.
+        :param cache_size: Maximum number of cached image records.
+        :param index: An optional Index of the same metadata database file to look up images in instead.
+        :param checkpoints_size: Maximum number of images whose Checkpoints are kept.
+        :param pool_size: Maximum number of idle connections to keep, more connections are created when needed
+                          but the extra ones are closed when they are put back.
+        """
+        self.meta_path = meta_path
+        self.get_fobj = get_fobj
+        self.cache_size = cache_size
+        self.index = index
+        self.checkpoints_size = checkpoints_size
+
+        self._cache = OrderedDict()  # id -> _Image
+        self._checkpoints = OrderedDict()  # id -> Checkpoints
+        self._lock = threading.Lock()
+        self._idle = queue.LifoQueue(maxsize=pool_size)
+        self._order = None
+        self._stamp = None  # (mtime, size) of the database file and its write-ahead log when the cache was cleared.
+        self._generation = 0  # incremented whenever the cache is cleared.
+
+    def close(self):
+        """ Closes the idle connections, connections that are in use are closed when they are put back. """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def iter_info(self, images_id: int, offset: int = 0, length: int = 0) -> Iterator[dict]:
+        """ Yields `info` dicts for ChainReader(decrypt=True) starting at an image, use the same `offset`
+            and `length` as ChainReader so that all the images it needs are fetched at once.
+
+        :param images_id: Id of the first image, raises KeyError if there's no such image.
+        :param offset: Data-offset of the first image that is going to be read.
+        :param length: Length in bytes that is going to be read, if <= 0, images are fetched as they are needed.
+        """
+        if self.index is not None:
+            for id_, key, iv, width, height, _, urls in self.index.iter_images(images_id):
+                yield {'width': width, 'height': height, 'key': key, 'iv': iv, 'fobj': self.get_fobj(urls),
+                       'checkpoints': self._get_checkpoints(id_)}
+            return
+
+        self._refresh()
+        left = offset + max(length, 1)  # length in bytes of data that is still needed from the current image.
+        image = self._get(images_id) or self._fetch(images_id, left)
+        if image is None:
+            raise KeyError(images_id)
+        while image is not None:
+            yield {'width': image.width, 'height': image.height, 'key': image.key, 'iv': image.iv,
+                   'fobj': self.get_fobj(image.urls), 'checkpoints': self._get_checkpoints(image.id)}
+            left = max(left - image.width * image.height * 4, 1)
+            if image.next_id is None:
+                image = self._fetch(image.id, left, after=True)
+            else:
+                image = self._get(image.next_id) or self._fetch(image.next_id, left)
+
+    def _get(self, images_id: int) -> Optional[_Image]:
+        with self._lock:
+            image = self._cache.get(images_id)
+            if image is not None:
+                self._cache.move_to_end(images_id)
+            return image
+
+    def _get_checkpoints(self, images_id: int) -> Checkpoints:
+        with self._lock:
+            checkpoints = self._checkpoints.get(images_id)
+            if checkpoints is None:
+                checkpoints = self._checkpoints[images_id] = Checkpoints()
+                while len(self._checkpoints) > self.checkpoints_size:
+                    self._checkpoints.popitem(last=False)
+            else:
+                self._checkpoints.move_to_end(images_id)
+            return checkpoints
+
+    def _fetch(self, images_id: int, left: int, after: bool = False) -> Optional[_Image]:
+        """ Fetches and caches a run of images that has at least `left` bytes of data,
+            which starts at `images_id` or the first image after it if `after` is True.
+            Returns the first image of the run or None if there's no such image. """
+        generation = self._refresh()
+        conn = self._get_conn()
+        try:
+            order = self._order
+            if order is None:
+                # urls that are known to work and have lower latency come first, if they have been verified.
+                columns = [x[1] for x in conn.execute('PRAGMA table_info(urls);')]
+                order = "u.status IS 'bad', u.latency IS NULL, u.latency, " if 'latency' in columns else ''
+                self._order = order
+            anchor = '(SELECT MIN(id) FROM images WHERE id > :id)' if after else ':id'
+            rows = conn.execute(_RUN_SQL.format(anchor=anchor, order=order),
+                                {'id': images_id, 'left': left}).fetchall()
+        finally:
+            self._put_conn(conn)
+
+        run = []
+        for id_, key, iv, width, height, url in rows:
+            if not run or run[-1].id != id_:
+                if run:
+                    run[-1].next_id = id_
+                run.append(_Image(id_, key, iv, width, height))
+            if url is not None:
+                run[-1].urls.append(url)
+        if not run:
+            return None
+
+        with self._lock:
+            if generation != self._generation:
+                return run[0]  # the database file has been modified during the query, it might be outdated.
+            if after and images_id in self._cache:
+                self._cache[images_id].next_id = run[0].id
+            for image in run:
+                cached = self._cache.get(image.id)
+                if cached is not None and image.next_id is None:
+                    image.next_id = cached.next_id
+                if image.urls:  # an image without urls is fetched again until it has some.
+                    self._cache[image.id] = image
+                    self._cache.move_to_end(image.id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return run[0]
+
+    def _get_conn(self) -> sqlite3.Connection:
+        """ takes an idle connection out of the pool or creates a new one, put it back with _put_conn(). """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return sqlite3.connect(f'file:{self.meta_path}?mode=ro', uri=True, check_same_thread=False)
+
+    def _refresh(self) -> int:
+        """ clears the cache if the database file has been modified since the last time, returns the generation. """
+        stamp = []
+        for path in [self.meta_path, self.meta_path + '-wal']:
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                stamp.append(None)
+        stamp = tuple(stamp)
+        with self._lock:
+            if stamp != self._stamp:
+                self._stamp = stamp
+                self._generation += 1
+                self._cache.clear()
+                self._order = None  # `urls` table might have new health columns.
+            return self._generation
+
+    def _put_conn(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
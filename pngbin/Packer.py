@@ -0,0 +1,481 @@
+import threading
+import itertools
+import functools
+import hashlib
+import bisect
+import sqlite3
+import queue
+import time
+import os
+from typing import IO, Callable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from .ChainWriter import ChainWriter
+from .meta import connect_meta
+
+BUFFER_SIZE = 4 * 2**20  # 4MiB
+BUFFER_COUNT = 2  # one is being read into while the other is being written.
+BATCH_SIZE = 1000  # number of `files` rows inserted at once.
+PROGRESS_INTERVAL = 1.0  # minimum seconds between two progress callbacks.
+ALIGN = object()  # a marker of the layout that the next file starts at the next image.
+
+_INSERT_SQL = {
+    'files': 'INSERT INTO files (offset, length, path, images_id) VALUES (?, ?, ?, ?);',
+    'blobs': 'INSERT OR IGNORE INTO blobs (hash, offset, length, images_id) VALUES (?, ?, ?, ?);',
+    'manifest': 'INSERT OR REPLACE INTO manifest (path, size, mtime, hash) VALUES (?, ?, ?, ?);',
+    'seen': 'INSERT INTO temp.seen (path) VALUES (?);',
+}
+_UPSERT_FILES_SQL = 'INSERT INTO files (offset, length, path, images_id) VALUES (?, ?, ?, ?) ' \
+                    'ON CONFLICT(path) DO UPDATE SET offset=excluded.offset, length=excluded.length, ' \
+                    'images_id=excluded.images_id;'
+
+
+class PackResult(NamedTuple):
+    files: int  # number of files that have been added or updated, including duplicates.
+    bytes: int  # number of bytes that have been written to images, including null-bytes of the optimized layout.
+    images: int  # number of images that have been created.
+    duplicates: int  # number of files that point at the same data as a packed file.
+    unchanged: int  # number of files that have been skipped by an incremental pack.
+    removed: int  # number of files that have been removed by `prune`.
+
+
+# ====================================================================================================================
+# Use this class to convert a whole directory of files into a chain of encrypted PngBin images
+# and add their metadata to a metadata database file.
+#
+# Files are read by a background thread into reused buffers, while the main thread encrypts and writes them,
+# so reading the input files and encrypting overlap. Files are deduplicated by their content hashes in `blobs` table,
+# a file that has been packed before is not written again. Image numbers start after the largest `id` in `images` table,
+# and everything is added to the metadata database file in a single transaction,
+# so the file is left untouched if packing fails.
+#
+# The size and modification time of every packed file are kept in `manifest` table,
+# an incremental pack skips files that are the same as the last time without reading them,
+# and updates `files` rows of the changed ones to point at their new data.
+# ====================================================================================================================
+class Packer:
+    def __init__(self, meta_path: str, width: int = 2508, height: int = 2508, output_dir: Optional[str] = None,
+                 fn_format: str = 'IMAGE_%02d.png', buffer_size: int = BUFFER_SIZE, dedup: bool = True,
+                 optimize_layout: bool = False, group_by_dir: bool = False):
+        """ Creates a packer of a metadata database file.
+
+        :param meta_path: Path to a metadata database file, it will be created if not exists.
+        :param width: Width of output images.
+        :param height: Height of output images, the multiple of `width` and `height` must be divisible by 4.
+        :param output_dir: Path to a directory to write output images to, it will be created if not exists.
+                           Not needed if every pack() call has `open_image`.
+        :param fn_format: Filename format of output images with exactly one `%d` placeholder for the image id.
+        :param buffer_size: Size in bytes of each read buffer.
+        :param dedup: If True, files that have the same contents as a packed file (by SHA-256 hash)
+                      are not written again, they point at the same range of data instead.
+        :param optimize_layout: If True, files are reordered so that as few files as possible span more images
+                                than they need, by best-fit decreasing bin packing. The unused space at the end of
+                                images is filled with null-bytes. This needs sizes of all files before the first
+                                file is read.
+        :param group_by_dir: If True, the optimized layout keeps files of the same directory in adjacent images,
+                             which may leave more unused space.
+        """
+        if width * height % 4 != 0:
+            raise ValueError('The multiple of `width` and `height` must be divisible by 4.')
+
+        self.meta_path = meta_path
+        self.width, self.height = width, height
+        self.output_dir = output_dir
+        self.fn_format = fn_format
+        self.buffer_size = buffer_size
+        self.dedup = dedup
+        self.optimize_layout = optimize_layout
+        self.group_by_dir = group_by_dir
+
+    @property
+    def capacity(self) -> int:
+        """ Length in bytes of data each image can contain. """
+        return self.width * self.height * 4
+
+    def pack(self, input_dir: str, open_image: Optional[Callable[[str], IO[bytes]]] = None,
+             on_finish: Optional[Callable] = None, on_progress: Optional[Callable[[int, int, float], None]] = None,
+             incremental: bool = False, prune: bool = False) -> PackResult:
+        """ Packs every file in `input_dir` and its subdirectories, empty directories are ignored.
+
+        :param input_dir: Path to a directory of input files.
+        :param open_image: A callable that takes an image file name and returns a writable file object,
+                           it's closed once the image is finished. Defaults to a new file in `output_dir`,
+                           the files that have been created are removed if packing fails.
+        :param on_finish: A callable that takes the database connection, called after the last image is closed
+                          and before the transaction is committed, e.g. to add urls of the images.
+        :param on_progress: A callable that takes (number of files, number of bytes, elapsed seconds),
+                            called at most every `PROGRESS_INTERVAL` seconds and once at the end.
+        :param incremental: If True, files that have the same size and modification time as in `manifest` table
+                            are skipped, and files that have already been packed are updated instead of
+                            raising sqlite3.IntegrityError.
+        :param prune: If True, `files` rows of every path that is not in `input_dir` are removed.
+        """
+        created = []  # paths of image files created by _open_file().
+        if open_image is None:
+            os.makedirs(self.output_dir, exist_ok=True)
+            open_image = functools.partial(self._open_file, created=created)
+
+        committed = False
+        conn = connect_meta(self.meta_path)
+        reader = _FileReader(self._iter_files(os.path.abspath(input_dir)), self.buffer_size, self.meta_path,
+                             self.dedup, incremental,
+                             (self.capacity, self.group_by_dir) if self.optimize_layout else None)
+        images = {}
+        try:
+            start_id = (conn.execute('SELECT MAX(id) FROM images;').fetchone()[0] or 0) + 1
+
+            def on_writer_created(w):
+                conn.execute('INSERT INTO images (id, key, iv, width, height, name) VALUES (?, ?, ?, ?, ?, ?);',
+                             (images['id'], w.key, w.iv, self.width, self.height, images['name']))
+
+            with conn:
+                if prune:
+                    conn.execute('CREATE TEMP TABLE IF NOT EXISTS seen ("path" TEXT NOT NULL PRIMARY KEY);')
+                    conn.execute('DELETE FROM temp.seen;')
+                counts = self._write(conn, reader, _InfoIterator(self, start_id, open_image, images),
+                                     on_writer_created, on_progress, incremental, prune)
+                if 'fobj' in images:
+                    images.pop('fobj').close()  # ChainWriter only finishes the last image, but does not close.
+
+                removed = 0
+                if prune:
+                    removed = conn.execute('DELETE FROM files WHERE path NOT IN (SELECT path FROM temp.seen);').rowcount
+                    conn.execute('DELETE FROM manifest WHERE path NOT IN (SELECT path FROM temp.seen);')
+                if callable(on_finish):
+                    on_finish(conn)
+            committed = True
+            return PackResult(counts[0], counts[1], images['id'] - start_id + 1 if 'id' in images else 0,
+                              counts[2], counts[3], removed)
+        finally:
+            reader.close()
+            conn.close()
+            if 'fobj' in images:
+                images['fobj'].close()
+            if not committed:  # their ids are not in the database file, the next run would create them again.
+                for path in created:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+    def _write(self, conn, reader: '_FileReader', info: '_InfoIterator', on_writer_created: Callable,
+               on_progress: Optional[Callable], incremental: bool, prune: bool) -> Tuple[int, int, int, int]:
+        """ writes every changed file of `reader` to a chain writer and inserts their rows.
+            returns a tuple of (number of files, number of bytes, number of duplicates, number of unchanged). """
+        start = last_progress = time.monotonic()
+        pending = {'files': [], 'blobs': [], 'manifest': [], 'seen': []}
+        files_sql = _UPSERT_FILES_SQL if incremental else _INSERT_SQL['files']
+        n_files = n_duplicates = n_unchanged = 0
+        with ChainWriter(info, True, on_writer_created) as writer:
+            for entry in reader:
+                if entry is ALIGN:
+                    self._pad(writer)
+                    continue
+                if prune:
+                    pending['seen'].append((entry.path,))
+                if entry.unchanged:
+                    n_unchanged += 1
+                elif entry.duplicate is None:
+                    first = writer.tell()
+                    for view in reader.iter_chunks():
+                        writer.write(view)
+                    row = self._get_row(first, writer.tell() - first, info.start_id)
+                    if reader.digest:
+                        pending['blobs'].append((reader.digest, *row))
+                    self._add_file(pending, entry, row, reader.digest)
+                    n_files += 1
+                else:
+                    self._insert_rows(conn, pending, files_sql)  # the blob might be one of the pending rows.
+                    row = conn.execute('SELECT offset, length, images_id FROM blobs WHERE hash=?;',
+                                       (entry.duplicate,)).fetchone()
+                    self._add_file(pending, entry, row, entry.duplicate)
+                    n_files += 1
+                    n_duplicates += 1
+                if len(pending['files']) + len(pending['seen']) >= BATCH_SIZE:
+                    self._insert_rows(conn, pending, files_sql)
+
+                now = time.monotonic()
+                if callable(on_progress) and now - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = now
+                    on_progress(n_files + n_unchanged, writer.tell(), now - start)
+            self._insert_rows(conn, pending, files_sql)
+            n_bytes = writer.tell()
+        if callable(on_progress):
+            on_progress(n_files + n_unchanged, n_bytes, time.monotonic() - start)
+        return n_files, n_bytes, n_duplicates, n_unchanged
+
+    def _pad(self, writer: ChainWriter):
+        """ writes null-bytes until the end of the current image. """
+        left = -writer.tell() % self.capacity
+        zeros = bytes(min(left, self.buffer_size))
+        while left > 0:
+            left -= writer.write(zeros[:left])
+
+    def _get_row(self, first: int, length: int, start_id: int) -> Tuple[int, int, int]:
+        """ returns (offset, length, images_id) of a file written at `first` of the chain that starts at `start_id`.
+            An empty file at the start of an image that might never be created is put at the end of the image
+            before it instead, or at the start of the last image of the earlier packs when nothing is written yet. """
+        if length == 0 and first % self.capacity == 0:
+            if first > 0:
+                return self.capacity, 0, start_id + first // self.capacity - 1
+            if start_id > 1:
+                return 0, 0, start_id - 1
+        return first % self.capacity, length, start_id + first // self.capacity
+
+    @staticmethod
+    def _add_file(pending: dict, entry: '_Entry', row: tuple, digest: Optional[bytes]):
+        """ adds `files` and `manifest` rows of a file, `row` is its (offset, length, images_id). """
+        pending['files'].append((row[0], row[1], entry.path, row[2]))
+        pending['manifest'].append((entry.path, row[1], entry.mtime, digest))
+
+    @staticmethod
+    def _insert_rows(conn, pending: dict, files_sql: str):
+        for table, rows in pending.items():
+            if rows:
+                conn.executemany(files_sql if table == 'files' else _INSERT_SQL[table], rows)
+                rows.clear()
+
+    def _open_file(self, name: str, created: List[str]) -> IO[bytes]:
+        """ creates a new image file in `output_dir` and appends its path to `created`. """
+        path = os.path.join(self.output_dir, name)
+        fobj = open(path, 'xb')
+        created.append(path)
+        return fobj
+
+    @staticmethod
+    def _iter_files(abs_input_dir: str) -> Iterator[Tuple[str, str]]:
+        """ yields (absolute path, relative path) of every file in sorted order. """
+        for parent, dirnames, filenames in os.walk(abs_input_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                abs_path = os.path.join(parent, filename)
+                yield abs_path, os.path.relpath(abs_path, abs_input_dir).replace('\\', '/')
+
+
+class _InfoIterator:
+    def __init__(self, packer: Packer, start_id: int, open_image: Callable, images: dict):
+        """ An iterator of ChainWriter `info`, opens each image by `open_image` and closes the previous one.
+            The current image is kept in `images` dict as `id`, `name` and `fobj`. """
+        self.start_id = start_id
+        self._packer = packer
+        self._open_image = open_image
+        self._images = images
+        self._ids = itertools.count(start_id)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> dict:
+        if 'fobj' in self._images:
+            self._images['fobj'].close()
+        img_id = next(self._ids)
+        name = self._packer.fn_format % img_id
+        self._images.update(id=img_id, name=name, fobj=self._open_image(name))
+        return {'fobj': self._images['fobj'], 'width': self._packer.width, 'height': self._packer.height}
+
+
+class _Entry(NamedTuple):
+    path: str  # relative path.
+    mtime: int  # modification time in nanoseconds.
+    duplicate: Optional[bytes]  # hash of a blob that has the same contents.
+    unchanged: bool  # True if it's the same as in `manifest` table.
+
+
+class _FileReader:
+    def __init__(self, files: Iterator[Tuple[str, str]], buffer_size: int, meta_path: str,
+                 dedup: bool = False, incremental: bool = False, layout: Optional[Tuple[int, bool]] = None):
+        """ Reads files in a background thread into `BUFFER_COUNT` reused buffers.
+
+            Iterating this object yields _Entry of each file, or ALIGN if the layout is optimized.
+            If it's neither a duplicate nor unchanged, iter_chunks() must be used to iterate through its contents,
+            otherwise it has no contents to iterate.
+
+        :param meta_path: Path to a metadata database file to look up `blobs` and `manifest` tables.
+        :param dedup: If True, files are hashed and looked up in `blobs` table to find duplicates.
+                      Only files of the same length as a blob are hashed before they are read.
+        :param incremental: If True, files are looked up in `manifest` table to find unchanged ones.
+        :param layout: If not None, a tuple of (capacity, group_by_dir) to reorder files by _plan_layout().
+        """
+        self.digest = None  # SHA-256 hash of the last file read by iter_chunks(), None if not hashed or empty.
+
+        self._files = files
+        self._meta_path = meta_path
+        self._dedup = dedup
+        self._incremental = incremental
+        self._layout = layout
+        self._sizes = set()  # lengths of files that have been read in this run.
+        self._digests = set()  # hashes of files that have been read in this run.
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        self._stop = threading.Event()
+        for _ in range(BUFFER_COUNT):
+            self._free.put(memoryview(bytearray(buffer_size)))
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def __iter__(self) -> Iterator[_Entry]:
+        while True:
+            item = self._get()
+            if item is None:
+                return
+            yield item
+
+    def iter_chunks(self) -> Iterator[memoryview]:
+        """ yields chunks of the current file, each chunk is only valid until the next one is requested. """
+        while True:
+            item = self._get()
+            if isinstance(item, bytes):
+                self.digest = item or None
+                return
+            buffer, n = item
+            yield buffer[:n]
+            self._free.put(buffer)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _get(self):
+        item = self._filled.get()
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    def _read(self):
+        """ puts _Entry of every file (or ALIGN), followed by (buffer, length) chunks and its hash
+            (or an empty bytes) if it's neither a duplicate nor unchanged, then None at the end. """
+        conn = sqlite3.connect(self._meta_path) if self._dedup or self._incremental else None
+        try:
+            items = self._iter_entries(conn)
+            if self._layout:
+                items = _plan_layout(items, *self._layout)
+            for item in items:
+                if item is ALIGN or item[1].unchanged:
+                    self._filled.put(item if item is ALIGN else item[1])
+                    continue
+                abs_path, entry, size = item
+                with open(abs_path, 'rb', buffering=0) as fobj:
+                    if not self._read_file(fobj, entry, size, conn if self._dedup else None):
+                        return
+            self._filled.put(None)
+        except Exception as e:
+            self._filled.put(e)
+        finally:
+            if conn:
+                conn.close()
+
+    def _iter_entries(self, conn: Optional[sqlite3.Connection]) -> Iterator[Tuple[str, _Entry, int]]:
+        """ yields (absolute path, _Entry, size) of every file. """
+        for abs_path, rel_path in self._files:
+            st = os.stat(abs_path)
+            unchanged = False
+            if self._incremental:
+                row = conn.execute('SELECT size, mtime FROM manifest WHERE path=?;', (rel_path,)).fetchone()
+                unchanged = row == (st.st_size, st.st_mtime_ns)
+            yield abs_path, _Entry(rel_path, st.st_mtime_ns, None, unchanged), st.st_size
+
+    def _read_file(self, fobj, entry: _Entry, size: int, conn: Optional[sqlite3.Connection]) -> bool:
+        """ reads a file, looks for a duplicate if `conn` is not None. returns False if close() has been called. """
+        digest = None
+        if conn:
+            if size and (size in self._sizes or
+                         conn.execute('SELECT 1 FROM blobs WHERE length=? LIMIT 1;', (size,)).fetchone()):
+                digest = self._hash(fobj)
+                if digest is None:
+                    return False
+                if digest in self._digests or \
+                        conn.execute('SELECT 1 FROM blobs WHERE hash=?;', (digest,)).fetchone():
+                    self._filled.put(entry._replace(duplicate=digest))
+                    return True
+                fobj.seek(0)
+
+        self._filled.put(entry)
+        h = hashlib.sha256() if conn and digest is None else None
+        length = 0
+        while True:
+            buffer = self._get_free()
+            if buffer is None:
+                return False
+            n = fobj.readinto(buffer)
+            if not n:
+                self._free.put(buffer)
+                break
+            if h:
+                h.update(buffer[:n])
+            length += n
+            self._filled.put((buffer, n))
+
+        if conn and length:
+            digest = digest or h.digest()
+            self._sizes.add(length)
+            self._digests.add(digest)
+        else:
+            digest = None
+        self._filled.put(digest or b'')
+        return True
+
+    def _hash(self, fobj) -> Optional[bytes]:
+        """ returns SHA-256 hash of the whole file, or None if close() has been called. """
+        buffer = self._get_free()
+        if buffer is None:
+            return None
+        h = hashlib.sha256()
+        try:
+            while True:
+                n = fobj.readinto(buffer)
+                if not n:
+                    return h.digest()
+                h.update(buffer[:n])
+        finally:
+            self._free.put(buffer)
+
+    def _get_free(self) -> Optional[memoryview]:
+        """ returns a free buffer, or None if close() has been called. """
+        while not self._stop.is_set():
+            try:
+                return self._free.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+
+def _plan_layout(items: Iterator[Tuple[str, _Entry, int]], capacity: int,
+                 group_by_dir: bool = False) -> Iterator[Union[Tuple[str, _Entry, int], object]]:
+    """ Reorders (absolute path, _Entry, size) of files so that as few files as possible span more images
+        than they need, yields them with ALIGN between bins. Unchanged and empty files take no space,
+        they are yielded first.
+
+        A bin is a run of files that starts at the start of an image. A file of `size` needs `size % capacity` bytes
+        of the space left in the last image of a bin to not span one more image than it needs, a file that is
+        a multiple of an image needs a new bin. Files are sorted by that length in decreasing order and put into
+        the bin with the least space left that fits them (best-fit decreasing), or a new bin.
+        If `group_by_dir` is True, each directory is planned separately, only the last bin of the previous
+        directory is left open for it.
+    """
+    bins = []  # lists of items.
+    space = []  # sorted (space left, bin index) of open bins.
+    groups = itertools.groupby(items, key=lambda x: os.path.dirname(x[1].path)) if group_by_dir else [(None, items)]
+    for _, group in groups:
+        if group_by_dir and space:
+            space = [x for x in space if x[1] == len(bins) - 1]
+        sizes = ((0 if item[1].unchanged else item[2], item) for item in group)
+        for size, item in sorted(sizes, key=lambda x: x[0] % capacity or x[0] and capacity, reverse=True):
+            if size == 0:
+                yield item
+                continue
+
+            need = size % capacity
+            i = bisect.bisect_left(space, (need, -1))
+            if need == 0 or i == len(space):
+                bins.append([item])
+                if need:
+                    bisect.insort(space, (capacity - need, len(bins) - 1))
+            else:
+                left, index = space.pop(i)
+                bins[index].append(item)
+                if left > need:
+                    bisect.insort(space, (left - need, index))
+
+    for i, bin_items in enumerate(bins):
+        if i:
+            yield ALIGN
+        yield from bin_items
@@ -1,7 +1,13 @@
 import math
 import struct
+import zlib
 from typing import Tuple, Union
 
+from .Writer import Writer
+
+SIGNATURE = b'\x89PNG\r\n\x1a\n'
+HEADER_LENGTH = 43  # length in bytes of PNG signature, IHDR chunk, IDAT length and name, and zlib header.
+
 
 # ====================================================================================================================
 # Use this class to read data from a PngBin image file.
@@ -12,8 +18,12 @@ from typing import Tuple, Union
 #                 Maximum offset is the value of 4 x width x height - 1.
 #   png-offset = A zero-based index offset of the whole png file.
 #                Maximum offset is the length in bytes of png file subtracts by 1.
+#
+# Use Reader.open(fobj) to create a reader whose width and height are read from the header of the image file instead.
 # ====================================================================================================================
 class Reader:
+    _stored_only = True  # False if the class can read images that have been recompressed.
+
     def __init__(self, width: int, height: int, fobj, offset: int = 0, length: int = 0):
         """ Creates a PngBin reader instance with offset seeking capability.
 
@@ -64,6 +74,19 @@ class Reader:
             raise AttributeError('`fobj` must be callable or file-like object '
                                  'that has read and seek method attributes.')
 
+    @classmethod
+    def open(cls, fobj, *args, **kwargs) -> 'Reader':
+        """ Creates a reader instance whose width and height are read from the header of the image file,
+            the other parameters are the same as the constructor's. `fobj` is read twice, for the header and
+            for the data, wrap a callable `fobj` with HeaderCache to read the header only once per url.
+            if the image is not a PngBin image, or it has been recompressed (see InflateReader),
+            raises InvalidPngError.
+        """
+        width, height, stored = parse_header(read_header(fobj))
+        if cls._stored_only and not stored:
+            raise InvalidPngError('The image has been recompressed.')
+        return cls(width, height, fobj, *args, **kwargs)
+
     @property
     def bytes_left(self) -> int:
         """ length in bytes that left to be read. """
@@ -77,15 +100,32 @@ class Reader:
         """
         if not 0 <= size <= self._left:
             size = self._left  # if out of range, changes the `size` value to read all that left.
-        buffer = bytearray()
-        while len(buffer) < size:
-            n = min(size - len(buffer), self._nextf, self._nextz)
-            c = self._fobj.read(n)
-            if len(c) != n:
+        buffer = bytearray(size)
+        self._readinto(memoryview(buffer))
+        return bytes(buffer)  # converts to bytes object before returns.
+
+    def readinto(self, b) -> int:
+        """ reads `fobj` into a pre-allocated writable bytes-like object `b`, this avoids creating new objects
+            when the same buffer is reused for every read.
+
+        :param b: writable bytes-like object, reads up to `len(b)` bytes or all the left bytes, whichever is less.
+        :return: number of bytes read into `b`.
+        """
+        view = memoryview(b).cast('B')
+        return self._readinto(view[:min(len(view), self._left)])
+
+    def _readinto(self, view: memoryview) -> int:
+        """ reads exactly `len(view)` bytes of data into `view`, which must not be more than `bytes_left`. """
+        size = len(view)
+        pos = 0
+        while pos < size:
+            n = min(size - pos, self._nextf, self._nextz)
+            c = self._read_exactly(view[pos:pos + n])
+            if c != n:
                 raise IncompleteRead(
-                    f'The length of returning bytes is not equal to what requested. (Expected: {n}, Got: {len(c)})'
+                    f'The length of returning bytes is not equal to what requested. (Expected: {n}, Got: {c})'
                 )
-            buffer.extend(c)
+            pos += n
             self._left -= n   # \
             self._nextf -= n  # -> counting down the 3 variables.
             self._nextz -= n  # /
@@ -101,7 +141,22 @@ class Reader:
                     self._nextf = self._width * 4  # resets countdown for next filter byte.
                     if self._nextf >= self._nextz:  # checks and adds that if zlib header bytes are in the way.
                         self._nextf += math.ceil(self._nextf / 0xffff) * 5
-        return bytes(buffer)  # converts to bytes object before returns.
+        return size
+
+    def _read_exactly(self, view: memoryview) -> int:
+        """ reads `fobj` until `view` is filled or `fobj` has no more data, returns number of bytes read. """
+        if not hasattr(self._fobj, 'readinto'):
+            c = self._fobj.read(len(view))
+            if len(c) == len(view):
+                view[:] = c
+            return len(c)
+        pos = 0
+        while pos < len(view):
+            n = self._fobj.readinto(view[pos:])
+            if not n:
+                break
+            pos += n
+        return pos
 
     def close(self):
         """ Calls close() on `fobj` if it has one. """
@@ -130,7 +185,7 @@ class Reader:
         o = offset + f  # offset includes filter bytes.
         c = (o // 0xffff) + 1  # number of zlib chunk headers that comes before offset.
         c *= 5  # each zlib chunk header has length of 5 bytes.
-        h = 41 + 2  # fixed header size + zlib main header size.
+        h = HEADER_LENGTH  # fixed header size + zlib main header size.
         p = h + c + o  # converted png-offset.
         if extra:
             nf = r - (offset % r)  # number of bytes from offset until next filter byte.
@@ -142,6 +197,42 @@ class Reader:
             return p
 
 
+def read_header(fobj) -> bytes:
+    """ reads and returns the first HEADER_LENGTH bytes of an image file, or less if the file is shorter.
+
+    :param fobj: the same as Reader's, a callable `fobj` is called with png-offsets of the header.
+    """
+    if callable(fobj):
+        f = fobj(0, HEADER_LENGTH - 1)
+        try:
+            return f.read(HEADER_LENGTH)
+        finally:
+            if hasattr(f, 'close'):
+                f.close()
+    fobj.seek(0, 0)
+    return fobj.read(HEADER_LENGTH)
+
+
+def parse_header(header: bytes) -> Tuple[int, int, bool]:
+    """ Checks the header of an image file from read_header() and returns a tuple of (width, height, stored).
+        `stored` is True if the rest of the header is exactly what Writer writes, which Reader can read,
+        otherwise, the image has been recompressed (e.g. by an image host) and only InflateReader can read it.
+        if it's not an 8-bit RGBA non-interlaced PNG file, raises InvalidPngError.
+    """
+    if len(header) < HEADER_LENGTH or header[:8] != SIGNATURE:
+        raise InvalidPngError('Invalid PNG signature.')
+    length, type_ = struct.unpack('>I4s', header[8:16])
+    if length != 13 or type_ != b'IHDR':
+        raise InvalidPngError('IHDR chunk is not the first chunk.')
+    if zlib.crc32(header[12:29]) != int.from_bytes(header[29:33], 'big'):
+        raise InvalidPngError('Invalid CRC32 of IHDR chunk.')
+    width, height, depth, color, compression, filter_, interlace = struct.unpack('>IIBBBBB', header[16:29])
+    if width == 0 or height == 0 or (depth, color, compression, filter_, interlace) != (8, 6, 0, 0, 0):
+        raise InvalidPngError('Only 8-bit RGBA non-interlaced images are supported.')
+    stored = header[33:] == Writer._calc_idat_len(width, height).to_bytes(4, 'big') + b'IDATx\x01'
+    return width, height, stored
+
+
 class InvalidPngError(Exception):
     """ Raises when Reader detects an invalid data in a PngBin file.
         This usually means that the image is not created by PngBin. """
@@ -0,0 +1,373 @@
+import concurrent.futures
+import itertools
+import threading
+import hashlib
+import sqlite3
+import time
+import zlib
+import io
+import os
+from typing import IO, Callable, List, NamedTuple, Optional, Tuple
+
+import requests
+import urllib3
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.backends.openssl import backend as openssl_backend
+
+from .Writer import Writer
+
+BLOCK_SIZE = 0xffff  # length in bytes of each zlib stored block, except the last one.
+FOOTER = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+
+# Results of every scrubbed image, so a scrub can be resumed where it has been stopped.
+#   scrub = Each image by its `images_id` and `name` in the metadata database file.
+#           status = 'ok', 'bad' (the image is corrupted) or 'error' (the image could not be read, it is tried again).
+#           seconds = time it took to stream and check the whole image, latency = seconds until the first byte.
+#           blobs = number of files whose decrypted data have been checked against their content hashes.
+SCRUB_CREATE_SQL = """
+CREATE TABLE IF NOT EXISTS "scrub" (
+	"images_id"	INTEGER NOT NULL,
+	"name"	TEXT NOT NULL,
+	"status"	TEXT NOT NULL,
+	"error"	TEXT,
+	"source"	TEXT,
+	"bytes"	INTEGER,
+	"seconds"	REAL,
+	"latency"	REAL,
+	"blobs"	INTEGER,
+	"checked_at"	REAL NOT NULL,
+	PRIMARY KEY("images_id")
+);
+"""
+
+# Images with their blobs that are entirely inside them (one row per blob), in the order of id and data-offset.
+_IMAGES_SQL = """
+SELECT i.id, i.name, i.key, i.iv, i.width, i.height, b.hash, b.offset, b.length
+FROM images i LEFT JOIN blobs b
+ON b.images_id = i.id AND b.length > 0 AND b.offset + b.length <= i.width * i.height * 4
+ORDER BY i.id, b.offset;
+"""
+
+# Non-empty files that do not fit in the chain of images from where they start.
+_BAD_FILES_SQL = """
+WITH "chain" AS (
+    SELECT id, width * height * 4 AS capacity, SUM(width * height * 4) OVER (ORDER BY id DESC) AS rest FROM images
+)
+SELECT f.path FROM files f LEFT JOIN chain c ON c.id = f.images_id
+WHERE f.length > 0 AND (c.id IS NULL OR f.offset < 0 OR f.offset >= c.capacity OR f.offset + f.length > c.rest)
+ORDER BY f.path;
+"""
+
+
+class ScrubError(Exception):
+    """ Raises when a PngBin image is not the image that has been written. """
+    pass
+
+
+class ScrubReport(NamedTuple):
+    images: int  # number of images in the metadata database file.
+    checked: int  # number of images that have been checked by this run.
+    ok: int  # number of images that are ok, including the ones checked by previous runs.
+    bad: int  # number of corrupted images.
+    errors: int  # number of images that could not be read.
+    bytes: int  # number of bytes of all checked images.
+    seconds: float  # sum of seconds it took to check each image.
+    blobs: int  # number of files whose decrypted data have been checked.
+    slowest: List[Tuple[str, float]]  # (name, seconds) of the slowest images.
+    failures: List[Tuple[str, str, str]]  # (name, status, error) of every image that is not ok.
+    bad_files: List[str]  # paths of files that do not fit in the chain of images.
+
+
+class _Image(NamedTuple):
+    id: int
+    name: str
+    key: bytes
+    iv: bytes
+    width: int
+    height: int
+    blobs: List[Tuple[bytes, int, int]]  # (hash, offset, length) of the blobs entirely inside this image.
+    urls: List[str]
+
+
+class _BlobChecker:
+    def __init__(self, blobs: List[Tuple[bytes, int, int]]):
+        """ Checks SHA-256 hashes of blobs in decrypted data of an image that is fed in order. """
+        self._blobs = blobs
+        self._k = 0  # index of the current blob.
+        self._hash = None  # hash object of the current blob, None if it hasn't been started.
+        self._pos = 0  # data-offset of the next fed data.
+
+    def update(self, data: bytes):
+        end = self._pos + len(data)
+        while self._k < len(self._blobs):
+            digest, offset, length = self._blobs[self._k]
+            if offset >= end:
+                break
+            if self._hash is None:
+                self._hash = hashlib.sha256()
+            self._hash.update(data[max(offset - self._pos, 0):min(offset + length, end) - self._pos])
+            if offset + length > end:
+                break  # continues in the next data.
+            if self._hash.digest() != digest:
+                raise ScrubError(f'Decrypted data at offset {offset} ({length} bytes) '
+                                 f'does not match the content hash of its file.')
+            self._hash = None
+            self._k += 1
+        self._pos = end
+
+
+# ====================================================================================================================
+# Checks every PngBin image in a metadata database file by streaming the whole image once,
+# `Reader` only reads the data and never checks it, so a corrupted image would only fail when its files are read.
+#
+# Each image is read from a local directory of images or from its urls, and in a single pass:
+#   - Total length must be the length of PngBin image of the known width and height.
+#   - PNG signature, IHDR chunk, IDAT length and zlib header must be exactly what Writer writes.
+#   - Every zlib stored block header and every filter byte.
+#   - CRC32 of IDAT chunk and Adler32 of the zlib stream must be the same as the footer, which ends with IEND chunk.
+#   - The data is decrypted, and every file that is entirely inside the image must match its content hash
+#     in `blobs` table (files of a pack with `dedup`).
+# Also, every file must start inside its image and end before the end of the chain of images.
+#
+# Images are checked concurrently and the result of each image is saved to a checkpoint database file right away,
+# so a scrub that has been stopped is resumed by running it again. Images that could not be read are tried again.
+# ====================================================================================================================
+class Scrubber:
+    def __init__(self, meta_path: str, checkpoint_path: str, image_dir: Optional[str] = None, workers: int = 4,
+                 timeout: float = 60.0):
+        """ Creates a scrubber of a metadata database file.
+
+        :param meta_path: Path to a metadata database file.
+        :param checkpoint_path: Path to a database file to save the results to, it will be created if not exists.
+                                It must only be used with the same metadata database file.
+        :param image_dir: A directory that contains images by their names, if None, images are read from their urls.
+        :param workers: Maximum number of images that are checked at the same time.
+        :param timeout: Timeout in seconds of each request if images are read from their urls.
+        """
+        self.meta_path = meta_path
+        self.image_dir = image_dir
+        self.workers = workers
+        self.timeout = timeout
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sessions = []  # a requests session of each worker thread.
+        self._meta = sqlite3.connect(f'file:{meta_path}?mode=ro', uri=True)
+        self._conn = sqlite3.connect(checkpoint_path)
+        with self._conn:
+            self._conn.executescript(SCRUB_CREATE_SQL)
+
+    def close(self):
+        for session in self._sessions:
+            session.close()
+        self._meta.close()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def run(self, retry: bool = False, restart: bool = False,
+            on_result: Optional[Callable[[str, str, Optional[str], int, float], None]] = None) -> ScrubReport:
+        """ Checks images that have not been checked yet, blocks until they are done and returns a report.
+
+        :param retry: If True, images that are not ok are checked again.
+        :param restart: If True, every image is checked again.
+        :param on_result: An optional callable that takes (name, status, error, bytes, seconds) of each checked image.
+        """
+        with self._conn:
+            if restart:
+                self._conn.execute('DELETE FROM scrub;')
+            elif retry:
+                self._conn.execute("DELETE FROM scrub WHERE status != 'ok';")
+            else:
+                self._conn.execute("DELETE FROM scrub WHERE status = 'error';")
+        done = set(self._conn.execute('SELECT images_id, name FROM scrub;').fetchall())
+
+        checked = 0
+        images = (x for x in self._iter_images() if (x.id, x.name) not in done)
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            # Images are submitted as workers become free, so blobs of only a few images are in memory at once.
+            futures = {executor.submit(self.check, x): x for x in itertools.islice(images, self.workers * 2)}
+            try:
+                while futures:
+                    finished, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        image = futures.pop(future)
+                        row = self._save(image, future)
+                        checked += 1
+                        if on_result is not None:
+                            on_result(image.name, *row[:2], *row[3:5])
+                    for image in itertools.islice(images, len(finished)):
+                        futures[executor.submit(self.check, image)] = image
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        return self.report(checked)
+
+    def report(self, checked: int = 0, n_slowest: int = 10) -> ScrubReport:
+        """ Returns a report of every result in the checkpoint database file.
+
+        :param checked: Number of images that have been checked by the caller.
+        :param n_slowest: Number of the slowest images to report.
+        """
+        counts = dict(self._conn.execute('SELECT status, COUNT() FROM scrub GROUP BY status;').fetchall())
+        n_bytes, seconds, blobs = self._conn.execute(
+            'SELECT TOTAL(bytes), TOTAL(seconds), TOTAL(blobs) FROM scrub;').fetchone()
+        slowest = self._conn.execute('SELECT name, seconds FROM scrub WHERE seconds IS NOT NULL '
+                                     'ORDER BY seconds DESC LIMIT ?;', (n_slowest,)).fetchall()
+        failures = self._conn.execute("SELECT name, status, error FROM scrub WHERE status != 'ok' "
+                                      "ORDER BY images_id;").fetchall()
+        return ScrubReport(
+            images=self._meta.execute('SELECT COUNT() FROM images;').fetchone()[0],
+            checked=checked,
+            ok=counts.get('ok', 0),
+            bad=counts.get('bad', 0),
+            errors=counts.get('error', 0),
+            bytes=int(n_bytes),
+            seconds=seconds,
+            blobs=int(blobs),
+            slowest=slowest,
+            failures=failures,
+            bad_files=[x[0] for x in self._meta.execute(_BAD_FILES_SQL)],
+        )
+
+    def check(self, image: _Image) -> Tuple[str, int, float, float, int]:
+        """ Streams and checks a whole image, raises ScrubError if it's corrupted.
+
+        :return: a tuple of (source, bytes, seconds, latency, blobs), where the image has been read from,
+                 its length, seconds it took, seconds until the first byte and number of checked blobs.
+        """
+        start = time.monotonic()
+        source, fobj = self._open(image)
+        try:
+            latency = time.monotonic() - start
+            n = self._check_stream(fobj, image)
+        finally:
+            fobj.close()
+        return source, n, time.monotonic() - start, latency, len(image.blobs)
+
+    def _iter_images(self):
+        """ yields _Image of every image in the order of id. """
+        has_blobs = self._meta.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='blobs';").fetchone() is not None
+        query = _IMAGES_SQL if has_blobs else 'SELECT id, name, key, iv, width, height, NULL, NULL, NULL ' \
+                                              'FROM images ORDER BY id;'
+        for id_, rows in itertools.groupby(self._meta.execute(query), key=lambda x: x[0]):
+            rows = list(rows)
+            urls = [x[0] for x in self._meta.execute('SELECT url FROM urls WHERE images_id=? ORDER BY rowid;', (id_,))]
+            yield _Image(*rows[0][:6], [x[6:] for x in rows if x[6] is not None], urls)
+
+    def _open(self, image: _Image) -> Tuple[str, IO[bytes]]:
+        """ returns a tuple of (source, file-like object) of an image, tries each url in order until one responds. """
+        if self.image_dir is not None:
+            path = os.path.join(self.image_dir, image.name)
+            return path, open(path, 'rb')
+
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            with self._lock:
+                self._sessions.append(session)
+        if not image.urls:
+            raise OSError('The image has no urls.')
+        for i, url in enumerate(image.urls):
+            try:
+                response = session.get(url, stream=True, timeout=self.timeout)
+                response.raise_for_status()
+            except requests.RequestException:
+                if i == len(image.urls) - 1:
+                    raise
+                continue
+            response.raw.decode_content = True
+            return url, response.raw
+
+    @staticmethod
+    def _check_stream(fobj: IO[bytes], image: _Image) -> int:
+        """ checks a whole image from `fobj` in a single pass, returns its length in bytes. """
+        def read(size: int) -> bytes:
+            b = fobj.read(size)
+            while len(b) < size:
+                more = fobj.read(size - len(b))
+                if not more:
+                    raise ScrubError(f'The image ends at {length - left + len(b)} bytes, expected {length} bytes.')
+                b += more
+            return b
+
+        width, height = image.width, image.height
+        head = io.BytesIO()
+        length = Writer(width, height, head).result_length
+        header = head.getvalue()  # Writer writes the whole header right away.
+        left = length
+
+        if read(len(header)) != header:
+            raise ScrubError('Header is not the same, the image might have been re-encoded.')
+        left -= len(header)
+
+        decryptor = None
+        if len(image.key) == 32 and len(image.iv) == 16:
+            decryptor = Cipher(algorithms.AES(image.key), modes.CBC(image.iv), backend=openssl_backend).decryptor()
+        blobs = _BlobChecker(image.blobs)
+
+        crc32 = zlib.crc32(header[-6:])  # IDAT name and zlib header.
+        adler32 = 1
+        stream_length = width * height * 4 + height  # length of all stored blocks data including filter bytes.
+        row = width * 4 + 1
+        pos = 0  # position in all stored blocks data.
+        while pos < stream_length:
+            n = min(stream_length - pos, BLOCK_SIZE)
+            if stream_length - pos > BLOCK_SIZE:
+                expected = b'\x00\xff\xff\x00\x00'
+            else:
+                expected = b'\x01' + n.to_bytes(2, 'little') + (BLOCK_SIZE - n).to_bytes(2, 'little')
+            block = read(5 + n)
+            left -= len(block)
+            if block[:5] != expected:
+                raise ScrubError(f'Invalid zlib stored block header at block {pos // BLOCK_SIZE}.')
+            crc32 = zlib.crc32(block, crc32)
+            data = memoryview(block)[5:]
+            adler32 = zlib.adler32(data, adler32)
+
+            first = -pos % row  # position of the first filter byte in this block.
+            if any(block[5 + first::row]):
+                raise ScrubError(f'Invalid filter byte at block {pos // BLOCK_SIZE}.')
+            if decryptor is not None:
+                for i in range(first - row if first else 0, n, row):
+                    blobs.update(decryptor.update(data[max(i + 1, 0):i + row]))
+            pos += n
+
+        footer = read(20)
+        left -= len(footer)
+        if int.from_bytes(footer[:4], 'big') != adler32:
+            raise ScrubError('Adler32 of zlib stream is not the same as the footer.')
+        if int.from_bytes(footer[4:8], 'big') != zlib.crc32(footer[:4], crc32):
+            raise ScrubError('CRC32 of IDAT chunk is not the same as the footer.')
+        if footer[8:] != FOOTER:
+            raise ScrubError('IEND chunk is not at the end of the image.')
+        if fobj.read(1):
+            raise ScrubError(f'The image is longer than {length} bytes.')
+        return length
+
+    def _save(self, image: _Image, future: concurrent.futures.Future) -> tuple:
+        """ writes a result of check() to `scrub` table, returns the row without images_id and name. """
+        source = n_bytes = seconds = latency = blobs = None
+        try:
+            source, n_bytes, seconds, latency, blobs = future.result()
+            status, error = 'ok', None
+        except ScrubError as e:
+            status, error = 'bad', str(e)
+        except (OSError, requests.RequestException, urllib3.exceptions.HTTPError) as e:
+            # urllib3 errors are raised while streaming `response.raw`, e.g. when the connection is dropped.
+            status, error = 'error', f'{type(e).__name__}: {e}'
+
+        row = (status, error, source, n_bytes, seconds, latency, blobs, time.time())
+        with self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO scrub (images_id, name, status, error, source, bytes, seconds, '
+                               'latency, blobs, checked_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);',
+                               (image.id, image.name, *row))
+        return row
@@ -2,8 +2,14 @@ from .Writer import Writer
 from .Reader import Reader, InvalidPngError, IncompleteRead
 from .EncryptWriter import EncryptWriter
 from .DecryptReader import DecryptReader
+from .InflateReader import InflateReader, InflateDecryptReader, Checkpoints
 from .ChainWriter import ChainWriter
 from .ChainReader import ChainReader
+from .Packer import Packer
+from .Index import Index
+from .InfoProvider import InfoProvider
+from .HeaderCache import HeaderCache
+from .Scrubber import Scrubber, ScrubError
 
 __all__ = [
     'Writer',
@@ -12,6 +18,15 @@ __all__ = [
     'IncompleteRead',
     'EncryptWriter',
     'DecryptReader',
+    'InflateReader',
+    'InflateDecryptReader',
+    'Checkpoints',
     'ChainWriter',
-    'ChainReader'
+    'ChainReader',
+    'Packer',
+    'Index',
+    'InfoProvider',
+    'HeaderCache',
+    'Scrubber',
+    'ScrubError'
 ]
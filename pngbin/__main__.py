@@ -0,0 +1,310 @@
+from pngbin.Packer import Packer, BUFFER_SIZE
+from pngbin.Index import Index
+from pngbin.Scrubber import Scrubber
+from pngbin.meta import connect_meta, read_urls, register_urls
+
+import argparse
+import time
+import sys
+import os
+
+
+def _get_args(argv):
+    commands = {
+        'pack': (
+            {
+                'help': 'Convert a directory of files into PngBin images and a metadata database file.',
+                'description': 'Convert a whole directory of files into a chain of encrypted PngBin images '
+                               'and add their metadata to a metadata database file.'
+            },
+            [
+                (
+                    ['input_dir'],
+                    {
+                        'help': 'A directory that contains files to convert, empty directories are ignored.'
+                    }
+                ),
+                (
+                    ['--meta_db', '-m'],
+                    {
+                        'default': 'meta.db',
+                        'help': 'An sqlite database file to add the metadata to, created if not exists. '
+                                '(default: "meta.db")'
+                    }
+                ),
+                (
+                    ['--output_dir', '-o'],
+                    {
+                        'default': 'images',
+                        'help': 'A directory to write output images to, created if not exists. (default: "images")'
+                    }
+                ),
+                (
+                    ['--width', '-W'],
+                    {
+                        'default': 2508,
+                        'type': int,
+                        'help': 'Width of output images. (default: 2508)'
+                    }
+                ),
+                (
+                    ['--height', '-H'],
+                    {
+                        'default': 2508,
+                        'type': int,
+                        'help': 'Height of output images. (default: 2508)'
+                    }
+                ),
+                (
+                    ['--fn_format', '-f'],
+                    {
+                        'default': 'IMAGE_%02d.png',
+                        'help': 'Filename format of output images with exactly one %%d placeholder '
+                                'as the image id. (default: "IMAGE_%%02d.png")'
+                    }
+                ),
+                (
+                    ['--buffer_size', '-b'],
+                    {
+                        'default': BUFFER_SIZE // 1024,
+                        'type': int,
+                        'help': f'Size in KiB of each read buffer. (default: {BUFFER_SIZE // 1024})'
+                    }
+                ),
+                (
+                    ['--no_dedup'],
+                    {
+                        'action': 'store_true',
+                        'help': 'Write every file even if the same contents have been packed before.'
+                    }
+                ),
+                (
+                    ['--incremental', '-i'],
+                    {
+                        'action': 'store_true',
+                        'help': 'Only pack files that are new or have been changed since the last pack, '
+                                'by their size and modification time.'
+                    }
+                ),
+                (
+                    ['--prune'],
+                    {
+                        'action': 'store_true',
+                        'help': 'Remove every file from the database file that is not in the input directory.'
+                    }
+                ),
+                (
+                    ['--optimize_layout'],
+                    {
+                        'action': 'store_true',
+                        'help': 'Reorder files so that as few files as possible span more images '
+                                'than they need, the unused space is filled with null-bytes.'
+                    }
+                ),
+                (
+                    ['--group_by_dir'],
+                    {
+                        'action': 'store_true',
+                        'help': 'Keep files of the same directory in adjacent images when the layout is optimized.'
+                    }
+                )
+            ]
+        ),
+        'index': (
+            {
+                'help': 'Compile a metadata database file into a memory-mapped index file.',
+                'description': 'Compile a metadata database file into a read-only binary index file, '
+                               'which pbfuse and webuis can use instead for fast startup and lookups. '
+                               'Run it again whenever the database file is changed.'
+            },
+            [
+                (
+                    ['--meta_db', '-m'],
+                    {
+                        'default': 'meta.db',
+                        'help': 'An sqlite database file contains the metadata of PngBin images. (default: "meta.db")'
+                    }
+                ),
+                (
+                    ['--output', '-o'],
+                    {
+                        'default': 'meta.idx',
+                        'help': 'Path to the index file, overwritten if exists. (default: "meta.idx")'
+                    }
+                )
+            ]
+        ),
+        'register': (
+            {
+                'help': 'Add uploaded image urls to a metadata database file.',
+                'description': 'Add uploaded image urls to a metadata database file in one transaction. '
+                               'Each line of a urls file is tab-separated "name url [status [latency]]", '
+                               'an image can have more than one url (mirrors). '
+                               'The old urls.txt format of the Uploader (name, url, empty line) is also accepted.'
+            },
+            [
+                (
+                    ['urls_file'],
+                    {
+                        'nargs': '+',
+                        'help': 'Text files of uploaded image urls.'
+                    }
+                ),
+                (
+                    ['--meta_db', '-m'],
+                    {
+                        'default': 'meta.db',
+                        'help': 'An sqlite database file contains the metadata of PngBin images. (default: "meta.db")'
+                    }
+                )
+            ]
+        ),
+        'scrub': (
+            {
+                'help': 'Check every PngBin image of a metadata database file for corruption.',
+                'description': 'Stream every PngBin image of a metadata database file and check its structure, '
+                               'CRC32 and Adler32, and the content hashes of the files inside it. '
+                               'Results are saved to a checkpoint file, run it again to resume a stopped scrub.'
+            },
+            [
+                (
+                    ['--meta_db', '-m'],
+                    {
+                        'default': 'meta.db',
+                        'help': 'An sqlite database file contains the metadata of PngBin images. (default: "meta.db")'
+                    }
+                ),
+                (
+                    ['--image_dir', '-d'],
+                    {
+                        'help': 'A directory that contains the images, if not given, images are read from their urls.'
+                    }
+                ),
+                (
+                    ['--checkpoint', '-c'],
+                    {
+                        'default': 'scrub.db',
+                        'help': 'An sqlite database file to save the results to, created if not exists. '
+                                '(default: "scrub.db")'
+                    }
+                ),
+                (
+                    ['--workers', '-w'],
+                    {
+                        'default': 4,
+                        'type': int,
+                        'help': 'Number of images that are checked at the same time. (default: 4)'
+                    }
+                ),
+                (
+                    ['--retry'],
+                    {
+                        'action': 'store_true',
+                        'help': 'Check the images that are not ok again.'
+                    }
+                ),
+                (
+                    ['--restart'],
+                    {
+                        'action': 'store_true',
+                        'help': 'Check every image again.'
+                    }
+                )
+            ]
+        )
+    }
+
+    parser = argparse.ArgumentParser(prog='pngbin', description='PngBin command line tools.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, args in commands.items():
+        subparser = subparsers.add_parser(name, **args[0])
+        for arg in args[1]:
+            subparser.add_argument(*arg[0], **arg[1])
+    return parser.parse_args(argv)
+
+
+def _print_progress(n_files: int, n_bytes: int, elapsed: float):
+    mib = n_bytes / 2**20
+    print(f'{n_files} files, {mib:.1f} MiB, {mib / elapsed if elapsed else 0:.1f} MiB/s', end='\r')
+
+
+def pack(cfg):
+    assert os.path.isdir(cfg.input_dir), f'Input directory "{cfg.input_dir}" does not exist.'
+    assert cfg.fn_format.count('%') == 1, 'Filename format must have exactly one %d placeholder.'
+
+    packer = Packer(cfg.meta_db, cfg.width, cfg.height, cfg.output_dir, cfg.fn_format, cfg.buffer_size * 1024,
+                    not cfg.no_dedup, cfg.optimize_layout, cfg.group_by_dir)
+    result = packer.pack(cfg.input_dir, on_progress=_print_progress, incremental=cfg.incremental, prune=cfg.prune)
+    print(f'\nPacked {result.files} files ({result.bytes} bytes) into {result.images} images, '
+          f'{result.duplicates} files are duplicates, {result.unchanged} files are unchanged, '
+          f'{result.removed} files are removed.')
+
+
+def index(cfg):
+    assert os.path.isfile(cfg.meta_db), f'Database file "{cfg.meta_db}" does not exist.'
+
+    n = Index.build(cfg.meta_db, cfg.output)
+    print(f'Indexed {n} files into "{cfg.output}".')
+
+
+def register(cfg):
+    assert os.path.isfile(cfg.meta_db), f'Database file "{cfg.meta_db}" does not exist.'
+    for path in cfg.urls_file:
+        assert os.path.isfile(path), f'Urls file "{path}" does not exist.'
+
+    conn = connect_meta(cfg.meta_db)
+    try:
+        with conn:
+            n, unknown = register_urls(conn, (x for path in cfg.urls_file for x in read_urls(path)))
+    finally:
+        conn.close()
+    print(f'Registered {n} urls.')
+    if unknown:
+        print(f'{len(unknown)} images are not in the database file: {", ".join(unknown)}')
+
+
+def scrub(cfg):
+    assert os.path.isfile(cfg.meta_db), f'Database file "{cfg.meta_db}" does not exist.'
+    assert cfg.image_dir is None or os.path.isdir(cfg.image_dir), f'Directory "{cfg.image_dir}" does not exist.'
+
+    start = time.monotonic()
+    n_images = n_bytes = 0
+
+    def on_result(name, status, error, length, seconds):
+        nonlocal n_images, n_bytes
+        n_images += 1
+        n_bytes += length or 0
+        if status != 'ok':
+            print(f'{name}: {status}, {error}')
+        mib = n_bytes / 2**20
+        elapsed = time.monotonic() - start
+        print(f'{n_images} images, {mib:.1f} MiB, {mib / elapsed if elapsed else 0:.1f} MiB/s', end='\r')
+
+    with Scrubber(cfg.meta_db, cfg.checkpoint, cfg.image_dir, cfg.workers) as scrubber:
+        report = scrubber.run(cfg.retry, cfg.restart, on_result)
+    mib = report.bytes / 2**20
+    print(f'\nChecked {report.checked} images in {time.monotonic() - start:.1f} seconds, '
+          f'{report.ok + report.bad + report.errors} of {report.images} images have been checked so far: '
+          f'{report.ok} ok, {report.bad} bad, {report.errors} could not be read.')
+    print(f'{mib:.1f} MiB, {mib / report.seconds if report.seconds else 0:.1f} MiB/s per image, '
+          f'{report.blobs} files have been checked against their content hashes.')
+    if report.slowest:
+        print('Slowest images: ' + ', '.join(f'{name} ({seconds:.2f}s)' for name, seconds in report.slowest))
+    for name, status, error in report.failures:
+        print(f'{status.upper()} {name}: {error}')
+    for path in report.bad_files:
+        print(f'BAD FILE {path}: does not fit in the chain of images.')
+
+
+def main(argv=None):
+    cfg = _get_args(sys.argv[1:] if argv is None else argv)
+    {
+        'pack': pack,
+        'index': index,
+        'register': register,
+        'scrub': scrub,
+    }[cfg.command](cfg)
+
+
+if __name__ == '__main__':
+    main()
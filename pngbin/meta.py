@@ -0,0 +1,175 @@
+import itertools
+import sqlite3
+from typing import Iterable, Iterator, List, Tuple
+
+
+# The schema of a metadata database file, which maps files to ranges of data in a chain of PngBin images.
+#   images = Each PngBin image in the order they are chained by `id`, with its AES key, iv and dimension.
+#   files = Each file by its path, starts at data-offset `offset` of image `images_id` and spans `length` bytes.
+#   urls = Where each image has been uploaded to, an image can have more than one url.
+META_CREATE_SQL = """
+CREATE TABLE "images" (
+	"id"	INTEGER,
+	"key"	BLOB NOT NULL,
+	"iv"	BLOB NOT NULL,
+	"width"	INTEGER NOT NULL,
+	"height"	INTEGER NOT NULL,
+	"name"	TEXT NOT NULL,
+	PRIMARY KEY("id")
+);
+CREATE TABLE "files" (
+	"offset"	INTEGER NOT NULL,
+	"length"	INTEGER NOT NULL,
+	"path"	TEXT NOT NULL UNIQUE,
+	"images_id"	INTEGER NOT NULL,
+	FOREIGN KEY("images_id") REFERENCES "images"("id")
+);
+CREATE TABLE "urls" (
+	"url"	TEXT NOT NULL UNIQUE,
+	"images_id"	INTEGER NOT NULL,
+	FOREIGN KEY("images_id") REFERENCES "images"("id")
+);
+CREATE UNIQUE INDEX "idx_files_path" ON "files" (
+	"path"
+);
+CREATE INDEX "idx_urls_images_id" ON "urls" (
+	"images_id"
+);
+"""
+
+# Content hashes of packed files, so a file that has the same contents as a packed one
+# only needs a new `files` row pointing at the same range of data, this table is added to existing files.
+#   blobs = SHA-256 `hash` of a file's contents and where they are, `length` is indexed to find candidates.
+BLOBS_CREATE_SQL = """
+CREATE TABLE IF NOT EXISTS "blobs" (
+	"hash"	BLOB NOT NULL,
+	"offset"	INTEGER NOT NULL,
+	"length"	INTEGER NOT NULL,
+	"images_id"	INTEGER NOT NULL,
+	PRIMARY KEY("hash"),
+	FOREIGN KEY("images_id") REFERENCES "images"("id")
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS "idx_blobs_length" ON "blobs" (
+	"length"
+);
+"""
+
+# Size and modification time of packed files when they were packed, so an incremental pack
+# only needs to read files that have been changed since then, this table is added to existing files.
+#   manifest = Each packed file by its `path` (the same as in `files`), `mtime` is in nanoseconds.
+MANIFEST_CREATE_SQL = """
+CREATE TABLE IF NOT EXISTS "manifest" (
+	"path"	TEXT NOT NULL,
+	"size"	INTEGER NOT NULL,
+	"mtime"	INTEGER NOT NULL,
+	"hash"	BLOB,
+	PRIMARY KEY("path")
+) WITHOUT ROWID;
+"""
+
+# Images are looked up by `name` when their uploaded urls are registered, this index is added to existing files.
+IMAGES_NAME_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS "idx_images_name" ON "images" (
+	"name"
+);
+"""
+
+# Optional health columns of `urls` table, they are added to existing files when they're first needed.
+#   status = 'ok', 'bad' or 'error' (could not be checked), latency = seconds until the first response,
+#   by whoever checked the url last.
+URLS_HEALTH_COLUMNS = {
+    'status': 'TEXT',  # 'ok', 'bad' or 'error'.
+    'error': 'TEXT',
+    'checked_at': 'REAL',  # unix time.
+    'latency': 'REAL',  # seconds until the first response.
+    'crc32': 'INTEGER',  # CRC32 of IDAT chunk from the footer.
+}
+
+
+def connect_meta(path: str, **kwargs) -> sqlite3.Connection:
+    """ Opens a metadata database file, its tables are created if it doesn't have them yet,
+        including the tables that are added to existing files.
+
+    :param path: Path to a metadata database file, it will be created if not exists.
+    :param kwargs: Pass optional keyword arguments to sqlite3.connect.
+    """
+    conn = sqlite3.connect(path, **kwargs)
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='images';").fetchone() is None:
+            with conn:
+                conn.executescript(META_CREATE_SQL)
+        with conn:
+            conn.executescript(BLOBS_CREATE_SQL)
+            conn.executescript(MANIFEST_CREATE_SQL)
+            conn.executescript(IMAGES_NAME_INDEX_SQL)
+    except BaseException:
+        conn.close()
+        raise
+    return conn
+
+
+def add_health_columns(conn: sqlite3.Connection):
+    """ Adds URLS_HEALTH_COLUMNS to `urls` table if it doesn't have them yet (without committing). """
+    columns = [x[1] for x in conn.execute('PRAGMA table_info(urls);')]
+    for name, type_ in URLS_HEALTH_COLUMNS.items():
+        if name not in columns:
+            conn.execute(f'ALTER TABLE urls ADD COLUMN "{name}" {type_};')
+
+
+def register_urls(conn: sqlite3.Connection, entries: Iterable[tuple]) -> Tuple[int, List[str]]:
+    """ Inserts uploaded image urls into `urls` table in bulk with `conn` (without committing).
+        Entries are joined with `images` by name all at once, so it should have `idx_images_name` index
+        (see connect_meta). Urls that are already in the table are ignored.
+        Returns a tuple of (number of inserted urls, names that are not in `images` table).
+
+    :param entries: An iterable of tuple (name, url) or (name, url, status, latency),
+                    an image can have any number of urls (mirrors). `status` and `latency` can be None,
+                    the health columns are added to `urls` table if any of them is not.
+    """
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS "new_urls" '
+                 '("name" TEXT NOT NULL, "url" TEXT NOT NULL, "status" TEXT, "latency" REAL);')
+    try:
+        conn.executemany('INSERT INTO temp.new_urls (name, url, status, latency) VALUES (?, ?, ?, ?);',
+                         (tuple(x) + (None,) * (4 - len(x)) for x in entries))
+        health = conn.execute('SELECT 1 FROM temp.new_urls '
+                              'WHERE status IS NOT NULL OR latency IS NOT NULL LIMIT 1;').fetchone()
+        if health:
+            add_health_columns(conn)
+        columns = ', status, latency' if health else ''
+        cur = conn.execute(f'INSERT OR IGNORE INTO urls (url, images_id{columns}) '
+                           f'SELECT n.url, i.id{columns.replace(", ", ", n.")} '
+                           f'FROM temp.new_urls n JOIN images i ON i.name = n.name ORDER BY n.rowid;')
+        unknown = [x[0] for x in conn.execute('SELECT DISTINCT name FROM temp.new_urls '
+                                              'WHERE name NOT IN (SELECT name FROM images) ORDER BY rowid;')]
+        return cur.rowcount, unknown
+    finally:
+        conn.execute('DROP TABLE temp.new_urls;')
+
+
+def read_urls(path: str) -> Iterator[tuple]:
+    """ Yields (name, url) or (name, url, status, latency) entries from a text file for register_urls().
+
+        The file is either tab-separated lines of `name url [status [latency]]`, one line per url,
+        or the old urls.txt format of the Uploader (name, url, empty line), which is detected
+        by the first line having no tab.
+    """
+    with open(path, 'r', encoding='utf-8') as fobj:
+        lines = (x.strip() for x in fobj)
+        first = next(lines, '')
+        if first and '\t' not in first:
+            name = first
+            for url in lines:
+                yield name, url
+                next(lines, None)  # an empty line.
+                name = next(lines, '')
+                if not name:
+                    return
+            return
+
+        for line in itertools.chain([first], lines):
+            if not line:
+                continue
+            fields = line.split('\t')
+            if len(fields) > 3:
+                fields[3] = float(fields[3]) if fields[3] else None
+            yield tuple(x if x != '' else None for x in fields[:4])
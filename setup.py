@@ -22,5 +22,12 @@ setuptools.setup(
     license="MIT",
     install_requires=[
         "cryptography",
+        "numpy",
+        "requests",
     ],
+    entry_points={
+        "console_scripts": [
+            "pngbin=pngbin.__main__:main",
+        ],
+    },
 )
\ No newline at end of file
@@ -0,0 +1,554 @@
+from contextlib import contextmanager
+from collections import OrderedDict
+from typing import Callable, Hashable, Iterator, Optional
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import unicodedata
+import mimetypes
+import hashlib
+import secrets
+import sqlite3
+import queue
+import os
+
+import flask
+
+DEFAULT_CHUNK_SIZE = 2**20  # 1MiB
+
+
+class ConnectionPool:
+    def __init__(self, db_path: str, size: int = 8):
+        """ A pool of reusable read-only sqlite connections, which can be shared between request threads.
+
+        :param db_path: Path to an sqlite database file.
+        :param size: Maximum number of idle connections to keep, more connections are created when needed
+                     but the extra ones are closed when they are put back.
+        """
+        self.db_path = db_path
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._functions = []
+
+    def create_function(self, name: str, narg: int, func):
+        """ Registers a user-defined function to every connection of this pool. """
+        self._functions.append((name, narg, func))
+
+    def get(self) -> sqlite3.Connection:
+        """ Takes an idle connection out of the pool or creates a new one. """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True, check_same_thread=False)
+            for function in self._functions:
+                conn.create_function(*function)
+            return conn
+
+    def put(self, conn: sqlite3.Connection):
+        """ Puts a connection taken by get() back to the pool. """
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self.get()
+        try:
+            yield conn
+        finally:
+            self.put(conn)
+
+    def close(self):
+        """ Closes all idle connections. """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class LRUCache:
+    def __init__(self, max_size: int):
+        """ A thread-safe least recently used cache with a memory budget.
+
+        :param max_size: Maximum total size in bytes of cached values, as given to put().
+        """
+        self.max_size = max_size
+        self.size = 0
+        self._items = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key: Hashable, value, size: int):
+        """ Caches `value` which takes `size` bytes, it is not cached at all if `size` is larger than `max_size`. """
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= self._items.popitem(last=False)[1][1]
+
+
+# ====================================================================================================================
+# A materialized directory table of `files` in a metadata database file.
+#
+# Each row is an entry (file or sub-directory) of a directory, so listing a directory is an indexed range lookup
+# instead of a full table scan over `files`. Directory names end with a slash like they do in `files.path`.
+#   parent = path of the directory that contains this entry, with a trailing slash ("" for the root directory).
+#   name   = name of this entry, directories have a trailing slash.
+#   size   = length of the file, or total length of all files in the directory subtree.
+#   count  = 1 for a file, or number of all files in the directory subtree.
+# `dir_index_info` has a `stale` flag, which triggers set on any change of `files` table (including renames,
+# moves and same-size changes by any writer), so checking whether the table is outdated doesn't read `files`.
+# ====================================================================================================================
+DIR_INDEX_SQL = """
+DROP TABLE IF EXISTS "dir_entries";
+DROP TABLE IF EXISTS "dir_index_info";
+DROP TRIGGER IF EXISTS "dir_index_insert";
+DROP TRIGGER IF EXISTS "dir_index_update";
+DROP TRIGGER IF EXISTS "dir_index_delete";
+CREATE TABLE "dir_entries" (
+	"parent"	TEXT NOT NULL,
+	"name"	TEXT NOT NULL,
+	"size"	INTEGER NOT NULL,
+	"count"	INTEGER NOT NULL,
+	PRIMARY KEY("parent", "name")
+) WITHOUT ROWID;
+CREATE TABLE "dir_index_info" (
+	"stale"	INTEGER NOT NULL
+);
+INSERT INTO dir_index_info (stale) VALUES (0);
+CREATE TRIGGER "dir_index_insert" AFTER INSERT ON "files" BEGIN
+	UPDATE dir_index_info SET stale = 1 WHERE stale = 0;
+END;
+CREATE TRIGGER "dir_index_update" AFTER UPDATE OF "path", "length" ON "files" BEGIN
+	UPDATE dir_index_info SET stale = 1 WHERE stale = 0;
+END;
+CREATE TRIGGER "dir_index_delete" AFTER DELETE ON "files" BEGIN
+	UPDATE dir_index_info SET stale = 1 WHERE stale = 0;
+END;
+"""
+
+
+def build_dir_index(conn: sqlite3.Connection) -> int:
+    """ (Re)builds `dir_entries` table from `files` table in one transaction, returns the number of entries. """
+    entries = {}  # (parent, name) -> [size, count]
+    for path, length in conn.execute('SELECT path, length FROM files;'):
+        parent = ''
+        for name in path.split('/')[:-1]:
+            entry = entries.setdefault((parent, name + '/'), [0, 0])
+            entry[0] += length
+            entry[1] += 1
+            parent += name + '/'
+        entries[(parent, path.rsplit('/', 1)[-1])] = [length, 1]
+
+    with conn:
+        conn.executescript(DIR_INDEX_SQL)
+        conn.executemany('INSERT INTO dir_entries (parent, name, size, count) VALUES (?, ?, ?, ?);',
+                         ((k[0], k[1], v[0], v[1]) for k, v in entries.items()))
+    return len(entries)
+
+
+def has_dir_index(conn: sqlite3.Connection) -> bool:
+    """ Returns True if `dir_entries` table exists and is up-to-date with `files` table. """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='dir_index_info';").fetchone() is None:
+        return False
+    row = conn.execute('SELECT stale FROM dir_index_info;').fetchone()
+    return row is not None and row[0] == 0
+
+
+class DirIndexState:
+    def __init__(self, db_path: str):
+        """ Tells whether `dir_entries` table of a database file is up-to-date, which is checked by has_dir_index()
+            again whenever the database file (or its write-ahead log) has been modified since the last check.
+
+        :param db_path: Path to an sqlite database file.
+        """
+        self.db_path = db_path
+        self._stamp = None
+        self._usable = False
+        self._lock = threading.Lock()
+
+    def usable(self, conn: sqlite3.Connection) -> bool:
+        """ Returns True if `dir_entries` table can be used, `conn` is a connection to the database file. """
+        stamp = self._get_stamp()
+        if stamp != self._stamp:
+            with self._lock:
+                if stamp != self._stamp:
+                    self._usable = has_dir_index(conn)
+                    self._stamp = stamp
+        return self._usable
+
+    def _get_stamp(self) -> tuple:
+        stamp = []
+        for path in [self.db_path, self.db_path + '-wal']:
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+
+class PrefixReader:
+    def __init__(self, data: memoryview, length: int, open_rest: Callable):
+        """ A reader like ChainReader that reads the beginning of a range from memory (e.g. a prefetched header)
+            and only opens another reader for the rest of the range if it's read that far.
+
+        :param data: Cached bytes at the start of the range, bytes beyond `length` are ignored.
+        :param length: Length in bytes of the whole range.
+        :param open_rest: A callable that takes (first, length) relative to the start of the range
+                          and returns a reader like ChainReader.
+        """
+        self.data = data[:length]
+        self.length = length
+        self.open_rest = open_rest
+        self._pos = 0
+        self._reader = None
+
+    def readinto(self, b) -> int:
+        view = memoryview(b).cast('B')
+        if self._pos < len(self.data):
+            n = min(len(view), len(self.data) - self._pos)
+            view[:n] = self.data[self._pos:self._pos + n]
+        elif self._pos < self.length:
+            if self._reader is None:
+                self._reader = self.open_rest(self._pos, self.length - self._pos)
+            n = self._reader.readinto(view[:self.length - self._pos])
+        else:
+            n = 0
+        self._pos += n
+        return n
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+
+class SpanPrefetcher:
+    def __init__(self, spans: list, open_reader: Callable, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 workers: int = 4, depth: int = 4):
+        """ Reads many spans of data in order, while reading ahead the next spans concurrently.
+
+        Iterating this object yields an iterator of chunks of bytes for each span in the given order.
+        Up to `workers` spans are read at the same time, each of them buffers at most `depth` chunks,
+        so memory usage is bounded by about `workers * depth * chunk_size` bytes.
+
+        :param spans: A list of tuple (first, length) to be read, `first` can be any value `open_reader` accepts.
+        :param open_reader: A callable that takes (first, length) and returns a reader like ChainReader,
+                            it's called from a worker thread.
+        :param chunk_size: Maximum length in bytes of each chunk.
+        :param workers: Maximum number of spans to be read concurrently.
+        :param depth: Maximum number of buffered chunks of each span.
+        """
+        self.spans = spans
+        self.open_reader = open_reader
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.depth = depth
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='span-prefetch')
+        self._closed = threading.Event()
+
+    def __iter__(self) -> Iterator[Iterator[bytes]]:
+        queues = []
+        for i in range(min(self.workers, len(self.spans))):
+            queues.append(self._submit(*self.spans[i]))
+        for i in range(len(self.spans)):
+            yield self._iter_queue(queues[i])
+            queues[i] = None
+            if i + self.workers < len(self.spans):
+                queues.append(self._submit(*self.spans[i + self.workers]))
+
+    def close(self):
+        """ Stops reading, can be called before all spans are iterated. """
+        self._closed.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, first: int, length: int) -> queue.Queue:
+        q = queue.Queue(maxsize=self.depth)
+        self._executor.submit(self._job, q, first, length)
+        return q
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        """ returns False if this prefetcher is closed before `item` is put. """
+        while not self._closed.is_set():
+            try:
+                q.put(item, timeout=1.0)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _job(self, q: queue.Queue, first: int, length: int):
+        """ Reads a span into queue `q` as chunks, then None, or an exception if it fails. """
+        reader = None
+        try:
+            if length > 0:
+                reader = self.open_reader(first, length)
+            left = length
+            while left > 0:
+                buffer = bytearray(min(self.chunk_size, left))
+                n = _read_exactly(reader, memoryview(buffer), len(buffer))
+                left -= n
+                if not self._put(q, bytes(buffer)):
+                    return
+            self._put(q, None)
+        except Exception as e:
+            self._put(q, e)
+        finally:
+            if reader is not None:
+                reader.close()
+
+    @staticmethod
+    def _iter_queue(q: queue.Queue) -> Iterator[bytes]:
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+class ReaderStream:
+    def __init__(self, reader, length: int, chunk_size: int = DEFAULT_CHUNK_SIZE, on_close: Callable = None):
+        """ A WSGI response iterable that streams `length` bytes out of a reader in large chunks.
+
+        Data is read with `reader.readinto` into one buffer that is reused for every chunk, and the next chunk
+        is only read when the server asks for it, so a slow client never makes this read ahead.
+        The server calls close() when the response is done or aborted, which closes the reader and
+        then calls `on_close`.
+
+        :param reader: An object that has readinto(b) method (e.g. ChainReader), or None if `length` is 0.
+        :param length: Length in bytes to stream.
+        :param chunk_size: Maximum length in bytes of each chunk.
+        :param on_close: An optional callable that will be called once when this stream is closed.
+        """
+        self.reader = reader
+        self.length = length
+        self.chunk_size = chunk_size
+        self.on_close = on_close
+        self._is_closed = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        left = self.length
+        buffer = memoryview(bytearray(min(self.chunk_size, left)))
+        while left > 0:
+            n = self.reader.readinto(buffer[:left])
+            if n == 0:
+                raise EOFError(f'Reader has no more data. ({left} bytes left)')
+            left -= n
+            yield bytes(buffer[:n])  # a copy, the server may still hold the chunk when the buffer is reused.
+
+    def close(self):
+        if self._is_closed:
+            return
+        self._is_closed = True
+        try:
+            if self.reader is not None:
+                self.reader.close()
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+
+
+class MultipartStream:
+    def __init__(self, spans: list, total_length: int, content_type: str, boundary: str,
+                 open_reader: Callable, chunk_size: int = DEFAULT_CHUNK_SIZE, on_close: Callable = None):
+        """ A WSGI response iterable of a multipart/byteranges body.
+
+        :param spans: A list of tuple (first, last, parts), each span is read with only one reader from `first`
+                      to `last` (exclusive) and `parts` is a list of tuple (first, last) within that span.
+        :param total_length: Length in bytes of the whole file.
+        :param content_type: Content-Type of the file.
+        :param boundary: Multipart boundary string.
+        :param open_reader: A callable that takes (first, length) and returns a reader like ChainReader.
+        :param chunk_size: Maximum length in bytes of each chunk.
+        :param on_close: An optional callable that will be called once when this stream is closed.
+        """
+        self.spans = spans
+        self.total_length = total_length
+        self.content_type = content_type
+        self.boundary = boundary
+        self.open_reader = open_reader
+        self.chunk_size = chunk_size
+        self.on_close = on_close
+        self._reader = None
+        self._is_closed = False
+
+    def part_header(self, first: int, last: int) -> bytes:
+        return (f'\r\n--{self.boundary}\r\n'
+                f'Content-Type: {self.content_type}\r\n'
+                f'Content-Range: bytes {first}-{last - 1}/{self.total_length}\r\n\r\n').encode('latin-1')
+
+    def footer(self) -> bytes:
+        return f'\r\n--{self.boundary}--\r\n'.encode('latin-1')
+
+    def content_length(self) -> int:
+        parts = [x for span in self.spans for x in span[2]]
+        return sum(len(self.part_header(*x)) + x[1] - x[0] for x in parts) + len(self.footer())
+
+    def __iter__(self) -> Iterator[bytes]:
+        buffer = memoryview(bytearray(self.chunk_size))
+        for first, last, parts in self.spans:
+            self._reader = self.open_reader(first, last - first)
+            pos = first
+            for part_first, part_last in parts:
+                _read_exactly(self._reader, buffer, part_first - pos)  # skips the gap between two parts.
+                yield self.part_header(part_first, part_last)
+                left = part_last - part_first
+                while left > 0:
+                    n = _read_exactly(self._reader, buffer, min(left, len(buffer)))
+                    left -= n
+                    yield bytes(buffer[:n])
+                pos = part_last
+            self._reader.close()
+            self._reader = None
+        yield self.footer()
+
+    def close(self):
+        if self._is_closed:
+            return
+        self._is_closed = True
+        try:
+            if self._reader is not None:
+                self._reader.close()
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+
+
+def file_etag(*row) -> str:
+    """ Returns a strong ETag of a file from its metadata row (e.g. images_id, offset, length and key),
+        PngBin files are immutable as long as their rows in the database don't change. """
+    h = hashlib.sha1()
+    for x in row:
+        h.update(x if isinstance(x, bytes) else str(x).encode('utf-8'))
+        h.update(b'\x00')
+    return h.hexdigest()[:32]
+
+
+def range_response(total_length: int, etag: str, open_reader: Callable, name: str, as_attachment: bool = False,
+                   on_close: Callable = None, chunk_size: Optional[int] = None) -> flask.Response:
+    """ Creates a response of a file for the current request, a replacement for flask.send_file.
+        It supports conditional requests (If-None-Match and If-Range), single range and multiple ranges requests.
+        If the range is not satisfiable, raises an HTTPException with 416 status code.
+
+    :param total_length: Length in bytes of the whole file.
+    :param etag: A strong ETag of the file.
+    :param open_reader: A callable that takes (first, length) of the file and returns a reader like ChainReader.
+    :param name: File name for Content-Type and Content-Disposition headers.
+    :param as_attachment: If True, tells the browser to download the file instead of displaying it.
+    :param on_close: An optional callable that will be called once when the response is closed.
+    :param chunk_size: Maximum length in bytes of each chunk, defaults to DEFAULT_CHUNK_SIZE.
+    """
+    request = flask.request
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': f'"{etag}"',
+        'Content-Disposition': content_disposition(name, as_attachment)
+    }
+
+    if request.if_none_match and request.if_none_match.contains_weak(etag):
+        response = flask.Response(status=304, headers={'ETag': headers['ETag']})
+        if on_close is not None:
+            response.call_on_close(on_close)
+        return response
+
+    ranges = None
+    if request.range and request.range.units == 'bytes':
+        if_range = request.if_range
+        if not (if_range.date or if_range.etag) or if_range.etag == etag:  # If-Range with a date never matches.
+            ranges = _get_ranges(request.range.ranges, total_length)
+            if not ranges:
+                flask.abort(flask.Response(status=416, headers={'Content-Range': f'bytes */{total_length}'}))
+
+    if ranges and len(ranges) > 1:
+        boundary = secrets.token_hex(16)
+        stream = MultipartStream(
+            _coalesce(ranges, chunk_size), total_length, content_type, boundary, open_reader, chunk_size, on_close)
+        headers['Content-Length'] = str(stream.content_length())
+        return flask.Response(stream, status=206, headers=headers,
+                              content_type=f'multipart/byteranges; boundary={boundary}', direct_passthrough=True)
+
+    if ranges:
+        (first, last), = ranges
+        status = 206
+        headers['Content-Range'] = f'bytes {first}-{last - 1}/{total_length}'
+    else:
+        first, last = 0, total_length
+        status = 200
+
+    headers['Content-Length'] = str(last - first)
+    reader = open_reader(first, last - first) if last > first else None
+    return flask.Response(ReaderStream(reader, last - first, chunk_size, on_close), status=status, headers=headers,
+                          mimetype=content_type, direct_passthrough=True)
+
+
+def _get_ranges(ranges: list, length: int) -> list:
+    """ Converts werkzeug Range.ranges to sorted satisfiable ranges of tuple (first, last) with exclusive `last`,
+        overlapping and adjacent ranges are merged into one. """
+    result = []
+    for first, last in ranges:
+        if first < 0:  # suffix range, e.g. "bytes=-500"
+            first, last = max(length + first, 0), length
+        else:
+            last = length if last is None else min(last, length)
+        if first < last:
+            result.append((first, last))
+
+    result.sort()
+    merged = []
+    for first, last in result:
+        if merged and first <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def _coalesce(ranges: list, max_gap: int) -> list:
+    """ Groups sorted ranges into spans that can be read by a single reader,
+        ranges are grouped when the gap between them is at most `max_gap` bytes. """
+    spans = []
+    for first, last in ranges:
+        if spans and first - spans[-1][1] <= max_gap:
+            spans[-1][1] = last
+            spans[-1][2].append((first, last))
+        else:
+            spans.append([first, last, [(first, last)]])
+    return [tuple(x) for x in spans]
+
+
+def _read_exactly(reader, buffer: memoryview, size: int) -> int:
+    """ Reads `size` bytes (can be more than `len(buffer)`, the rest is discarded) into `buffer`. """
+    left = size
+    while left > 0:
+        n = reader.readinto(buffer[:min(left, len(buffer))])
+        if n == 0:
+            raise EOFError(f'Reader has no more data. ({left} bytes left)')
+        left -= n
+    return size
+
+
+def content_disposition(name: str, as_attachment: bool) -> str:
+    """ returns Content-Disposition header value with an ASCII file name and an UTF-8 file name (RFC 6266). """
+    ascii_name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+    ascii_name = ascii_name.replace('\\', '\\\\').replace('"', '\\"')
+    value = 'attachment' if as_attachment else 'inline'
+    return f'{value}; filename="{ascii_name}"; filename*=UTF-8\'\'{quote(name, safe="")}'
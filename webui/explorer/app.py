@@ -0,0 +1,473 @@
+from pngbin import ChainReader, HeaderCache, Index, InfoProvider
+from webui.common import ConnectionPool, SpanPrefetcher, DirIndexState, content_disposition, file_etag, range_response
+
+import flask
+import requests
+
+from urllib.parse import quote
+import tarfile
+import zipfile
+import sqlite3
+import time
+import os
+
+
+DARK_MODE = True  # if True, use dark theme in explorer webui.
+JSON_PAGE_SIZE = 1000  # default number of entries per page of a directory listing in JSON format.
+JSON_MAX_PAGE_SIZE = 10000
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; rv:78.0) Gecko/20100101 Firefox/78.0'
+EXT_TYPES = {  # Type: ['archive', 'audio', 'image', 'pdf', 'text', 'video']
+    '.m4a': 'audio', '.mp3': 'audio', '.oga': 'audio', '.ogg': 'audio', '.webma': 'audio', '.wav': 'audio',
+    '.7z': 'archive', '.zip': 'archive', '.rar': 'archive', '.gz': 'archive', '.tar': 'archive', '.gif': 'image',
+    '.ico': 'image', '.jpe': 'image', '.jpeg': 'image', '.jpg': 'image', '.png': 'image', '.svg': 'image',
+    '.webp': 'image', '.pdf': 'pdf', '.txt': 'text', '.atom': 'text', '.bat': 'text', '.bash': 'text', '.c': 'text',
+    '.cmd': 'text', '.coffee': 'text', '.css': 'text', '.hml': 'text', '.js': 'text', '.json': 'text', '.java': 'text',
+    '.less': 'text', '.markdown': 'text', '.md': 'text', '.php': 'text', '.pl': 'text', '.py': 'text', '.rb': 'text',
+    '.rss': 'text', '.sass': 'text', '.scpt': 'text', '.swift': 'text', '.scss': 'text', '.sh': 'text', '.xml': 'text',
+    '.yml': 'text', '.plist': 'text', '.htm': 'text', '.html': 'text', '.mhtm': 'text', '.mhtml': 'text',
+    '.xhtm': 'text', '.xhtml': 'text', '.mp4': 'video', '.m4v': 'video', '.ogv': 'video', '.webm': 'video',
+    '.3g2': 'video', '.3gp': 'video', '.3gp2': 'video', '.3gpp': 'video', '.mov': 'video', '.qt': 'video'
+}
+
+
+def create_app(meta_db: str = 'meta.db', header_file: str = None, chunk_size: int = 1024,
+               pool_size: int = 8, archive_workers: int = 4, index_file: str = None) -> flask.Flask:
+    """ Creates an Explorer WebUI application, which can be served by any WSGI server.
+
+    Every application has its own pool of sqlite connections, HTTP session and cache of image info,
+    so with a multi-process server (e.g. gunicorn) each worker process has its own ones.
+
+    :param meta_db: An sqlite database file contains the metadata of PngBin images.
+    :param header_file: Path to line separated "key: value" text file for request headers.
+    :param chunk_size: Size in KiB of each chunk when streaming a file.
+    :param pool_size: Maximum number of idle sqlite connections to keep.
+    :param archive_workers: Maximum number of images to be read concurrently when downloading a directory.
+    :param index_file: Path to an index file created by "pngbin index" from `meta_db`, if given,
+                       it's used instead of querying the database file.
+    :return: A Flask application.
+    """
+    assert os.path.isfile(meta_db), f'Database file "{meta_db}" does not exist.'
+    assert header_file is None or os.path.isfile(header_file), f'Header file "{header_file}" does not exist.'
+    assert index_file is None or os.path.isfile(index_file), f'Index file "{index_file}" does not exist.'
+
+    session = requests.Session()
+    if header_file:
+        with open(header_file, 'r') as fobj:
+            session.headers.update(line.strip().split(': ') for line in fobj if line.strip())
+
+    index = Index(index_file) if index_file else None
+    dir_index = DirIndexState(meta_db)  # if not usable, lists directories by scanning the whole `files` table.
+    use_dir_index = True
+    if index is None:
+        with sqlite3.connect(f'file:{meta_db}?mode=ro', uri=True) as conn:
+            use_dir_index = dir_index.usable(conn)
+        conn.close()
+
+    pool = ConnectionPool(meta_db, pool_size)
+    pool.create_function('_PATH', 2, _sqlite_path_func)
+
+    app = flask.Flask(__name__, static_url_path='/__static__')
+    app.config.update(META_DB=meta_db, CHUNK_SIZE=chunk_size * 1024, ARCHIVE_WORKERS=archive_workers)
+    headers = HeaderCache()  # the header of each image is checked before it's read, see ChainReader.
+
+    def get_fobj(urls):
+        if not urls:
+            raise NetReaderError('The image has no urls.')
+        return headers.wrap(urls[0], _get_stream(session, urls[0]))
+    info = InfoProvider(meta_db, get_fobj, index=index)
+    app.extensions['pngbin'] = {'pool': pool, 'session': session, 'index': index, 'info': info,
+                                'dir_index': dir_index}
+    app.teardown_appcontext(_close_conn)
+    app.add_url_rule('/', 'main', main)
+    app.add_url_rule('/<path:path>', 'main', main)
+
+    if not use_dir_index:
+        app.logger.warning('Directory table is missing or outdated, '
+                           'run with --build_index to make directory listings faster.')
+    if index is not None and index.is_outdated(meta_db):
+        app.logger.warning('Index file is older than the database file, run "pngbin index" again.')
+    return app
+
+
+class NetReaderError(Exception):
+    """ raises when error occurs during _get_stream(). """
+    pass
+
+
+def _get_stream(session, url):
+    def _fobj(first, last):
+        headers = {
+            'Range': f'bytes={first}-{"" if last is None else last}',
+            'User-Agent': USER_AGENT}
+        err = None
+        for _ in range(3):  # if failed, retries two more tries.
+            try:
+                response = session.get(url, headers=headers, stream=True, timeout=30.0)
+                if response.status_code != 206:
+                    raise NetReaderError('Invalid Status Code (Expect 206): ' + str(response.status_code))
+                ct = response.headers.get('Content-Type', '')
+                if ct != 'image/png':
+                    raise NetReaderError('Invalid Content-Type Header: ' + ct)
+                cl = response.headers.get('Content-Length', '')
+                if last is not None and cl != str((last - first) + 1):  # None is to the end (InflateReader).
+                    raise NetReaderError('Invalid Content-Length Header: ' + cl)
+                return response.raw
+            except requests.RequestException as e:
+                err = e
+        else:
+            raise err
+
+    return _fobj
+
+
+def _get_conn(g=True):
+    conn = flask.current_app.extensions['pngbin']['pool'].get()
+    if g:
+        flask.g.conn = conn
+    return conn
+
+
+def _close_conn(_=None):
+    conn = flask.g.pop('conn', None)
+    if conn is not None:
+        flask.current_app.extensions['pngbin']['pool'].put(conn)
+
+
+def _human_bytes(n):
+    for k, u in enumerate(['KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB']):
+        if n < 1024 ** (k + 2):
+            return '{:.2f} {}'.format(n / 1024 ** (k + 1), u)
+    else:
+        return '{:.2f} YB'.format(n / 1024 ** 8)
+
+
+def _sqlite_path_func(t, u):
+    t = t[u:]
+    i = t.find('/') + 1
+    return t[:i] if i else t
+
+
+def _iter_entries(path, after='', limit=-1):
+    """ Yields (name, size, count) of entries in directory `path` ordered by name, starting after `after`. """
+    index = flask.current_app.extensions['pngbin']['index']
+    if index is not None:
+        yield from index.listdir(path, after, limit)
+        return
+
+    conn = _get_conn()
+    cur = conn.cursor()
+    if flask.current_app.extensions['pngbin']['dir_index'].usable(conn):
+        cur.execute('SELECT name, size, count '
+                    'FROM dir_entries '
+                    'WHERE parent = ? AND name > ? '
+                    'ORDER BY name '
+                    'LIMIT ?',
+                    (path, after, limit))
+        yield from cur
+    else:
+        cur.execute('SELECT _PATH(path, :u) AS name, SUM(length), COUNT() '
+                    'FROM files '
+                    'WHERE path LIKE :v AND name > :a '
+                    'GROUP BY name '
+                    'ORDER BY name '
+                    'LIMIT :l',
+                    {'u': len(path), 'v': path + '%', 'a': after, 'l': limit})
+        yield from cur
+
+
+def page_explorer_json(path):
+    after = flask.request.args.get('after', '')
+    limit = flask.request.args.get('limit', '')
+    limit = min(int(limit), JSON_MAX_PAGE_SIZE) if limit.isdigit() and int(limit) > 0 else JSON_PAGE_SIZE
+
+    names, entries = [], []
+    for name, size, count in _iter_entries(path, after, limit + 1):
+        names.append(name)
+        entries.append({
+            'url': '/' + quote(path + name),
+            'name': name.rstrip('/'),
+            'type': 'dir' if name.endswith('/') else EXT_TYPES.get(os.path.splitext(name)[1], 'unknown'),
+            'size': size,
+            'count': count
+        })
+
+    if not entries and not after and path:
+        flask.abort(404)
+
+    has_next = len(entries) > limit
+    del entries[limit:]
+    return flask.jsonify({
+        'path': path,
+        'entries': entries,
+        'next': names[limit - 1] if has_next else None  # pass this as `after` to get the next page.
+    })
+
+
+def page_explorer(path):
+    if 'json' in flask.request.args:
+        return page_explorer_json(path)
+    if 'tar' in flask.request.args or 'zip' in flask.request.args:
+        return send_archive(path, 'zip' if 'zip' in flask.request.args else 'tar')
+
+    files, dirs = [], []
+    for name, size, count in _iter_entries(path):
+        data = {
+            'url': '/' + quote(path + name),
+            'name': name
+        }
+
+        if name.endswith('/'):
+            data['name'] = data['name'][:-1]
+            data['size'] = f'{_human_bytes(size)} ({count} files)'
+            dirs.append(data)
+        else:
+            ext = os.path.splitext(name)[1]
+            data['size'] = _human_bytes(size)
+            data['type'] = EXT_TYPES.get(ext, 'unknown')
+            files.append(data)
+
+    if not (files or dirs):
+        flask.abort(404)
+
+    parents, url = [], '/'
+    for name in (x for x in path.split('/') if x):
+        url += name + '/'
+        parents.append({
+            'url': quote(url),
+            'name': name
+        })
+
+    if 'ls' in flask.request.args:
+        host_url = flask.request.host_url[:-1]
+        return flask.Response(
+            '\n'.join(host_url + x['url'] for x in files),
+            headers={
+                'Content-Type': 'text/plain',
+                'Cache-Control': 'no-cache, no-store, must-revalidate, max-age=-1'
+            }
+        )
+
+    return flask.render_template('explorer.html', **{
+        'dirs': dirs,
+        'files': files,
+        'parents': parents,
+        'title': parents[-1]['name'] if parents else '/',
+        'theme': 'dark' if DARK_MODE else 'light'
+    })
+
+
+def send_file(path):
+    # The response is streamed after the request context is gone, so takes everything it needs now.
+    info = flask.current_app.extensions['pngbin']['info']
+    index = flask.current_app.extensions['pngbin']['index']
+    if index is not None:
+        row = index.lookup(path)
+        try:
+            row = row and row + (index.get_image(row[2])[0],)
+        except KeyError:
+            row = row + (None,)
+    else:
+        cur = _get_conn().cursor()
+        cur.execute('SELECT f.offset, f.length, f.images_id, i.key '
+                    'FROM files f LEFT JOIN images i ON i.id = f.images_id '
+                    'WHERE f.path=?;', (path,))
+        row = cur.fetchone()
+    if row is None or (row[3] is None and row[1] > 0):  # an empty file doesn't need its image.
+        flask.abort(404)
+
+    offset, length, images_id, key = row
+    return range_response(
+        length, file_etag(images_id, offset, length, key),
+        lambda first, n: ChainReader(
+            info.iter_info(images_id, offset + first, n), offset + first, n, decrypt=True, auto_close=True,
+            fallback=True),
+        name=os.path.split(path)[1],
+        as_attachment='dl' in flask.request.args,
+        chunk_size=flask.current_app.config['CHUNK_SIZE']
+    )
+
+
+class _ChunkCursor:
+    def __init__(self, chunks):
+        """ Splits an iterator of chunks of bytes into consecutive pieces of any length. """
+        self._chunks = chunks
+        self._chunk = b''
+        self._pos = 0
+
+    def take(self, n):
+        """ Yields the next `n` bytes as one or more pieces. """
+        while n > 0:
+            if self._pos == len(self._chunk):
+                self._chunk = next(self._chunks, None)
+                self._pos = 0
+                if self._chunk is None:
+                    raise EOFError(f'Span has no more data. ({n} bytes left)')
+            k = min(n, len(self._chunk) - self._pos)
+            yield self._chunk if k == len(self._chunk) else self._chunk[self._pos:self._pos + k]
+            self._pos += k
+            n -= k
+
+
+def _get_runs(cur, rows, max_gap, index=None):
+    """ Groups files into runs which can each be read with one ChainReader.
+
+    :param rows: A list of tuple (name, offset, length, images_id) ordered by images_id and offset.
+    :param max_gap: Maximum length in bytes of unused data between two files to be read through in the same run.
+    :param index: An Index to get positions of images from, instead of `cur`.
+    :return: A list of tuple (images_id, offset, length, members),
+             each member is a tuple (name, first, length) where `first` is relative to the start of the run.
+    """
+    if not rows:
+        return []
+
+    # Position of each image in the concatenated data of all images, to know gaps between files across images.
+    if index is not None:
+        starts = {}
+        for x in {x[3] for x in rows}:
+            try:
+                starts[x] = index.position(x, 0)
+            except KeyError:
+                pass
+    else:
+        cur.execute('SELECT id, width * height * 4 FROM images WHERE id BETWEEN ? AND ? ORDER BY id;',
+                    (rows[0][3], rows[-1][3]))
+        starts, pos = {}, 0
+        for images_id, capacity in cur:
+            starts[images_id] = pos
+            pos += capacity
+
+    runs = []
+    for name, offset, length, images_id in rows:
+        if images_id not in starts:
+            if length > 0:
+                raise KeyError(images_id)
+            # an empty file of an image that has never been created, it's read as the end of the last run.
+            if runs and runs[-1][0] in starts:
+                runs[-1][3].append((name, runs[-1][4] - runs[-1][5], 0))
+            else:
+                runs.append([images_id, 0, 0, [(name, 0, 0)], 0, 0])
+            continue
+        first = starts[images_id] + offset
+        if runs and runs[-1][0] in starts and 0 <= first - runs[-1][4] <= max_gap:
+            run = runs[-1]
+            run[3].append((name, first - run[5], length))
+            run[4] = max(run[4], first + length)
+            run[2] = run[4] - run[5]
+        else:
+            runs.append([images_id, offset, length, [(name, 0, length)], first + length, first])
+    return [tuple(x[:4]) for x in runs]
+
+
+def _iter_tar(runs, prefetcher, headers):
+    """ Yields a tar archive of the files of `runs` with their tar headers of `headers`. """
+    headers = iter(headers)
+    for (_, _, _, members), chunks in zip(runs, prefetcher):
+        cursor, pos = _ChunkCursor(chunks), 0
+        for name, first, length in members:
+            for _ in cursor.take(first - pos):
+                pass
+            yield next(headers)
+            yield from cursor.take(length)
+            yield b'\0' * (-length % tarfile.BLOCKSIZE)
+            pos = first + length
+    yield b'\0' * (tarfile.BLOCKSIZE * 2)
+
+
+class _ZipSink:
+    """ An unseekable file-like object that collects what zipfile writes. """
+    def __init__(self):
+        self.data = []
+
+    def write(self, b):
+        self.data.append(bytes(b))
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data, self.data = self.data, []
+        return data
+
+
+def _iter_zip(runs, prefetcher, date_time):
+    """ Yields a stored (uncompressed) zip archive of the files of `runs`. """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zf:
+        for (_, _, _, members), chunks in zip(runs, prefetcher):
+            cursor, pos = _ChunkCursor(chunks), 0
+            for name, first, length in members:
+                for _ in cursor.take(first - pos):
+                    pass
+                info = zipfile.ZipInfo(name, date_time)
+                info.file_size = length
+                with zf.open(info, 'w') as fobj:
+                    for piece in cursor.take(length):
+                        fobj.write(piece)
+                        yield from sink.pop()
+                yield from sink.pop()
+                pos = first + length
+    yield from sink.pop()
+
+
+def send_archive(path, fmt):
+    """ Streams all files under directory `path` as a tar or zip archive (`fmt`).
+        Files are read in order of where they are in the images, so adjacent files are read as one run,
+        and the next runs are read ahead concurrently. """
+    provider = flask.current_app.extensions['pngbin']['info']
+    index = flask.current_app.extensions['pngbin']['index']
+    chunk_size = flask.current_app.config['CHUNK_SIZE']
+
+    if index is not None:
+        cur = None
+        rows = sorted(((x[0][len(path):],) + x[1:] for x in index.iter_files(path)), key=lambda x: (x[3], x[1]))
+    else:
+        cur = _get_conn().cursor()
+        cur.execute('SELECT path, offset, length, images_id '
+                    'FROM files '
+                    'WHERE path LIKE ? '
+                    'ORDER BY images_id, offset;',
+                    (path + '%',))
+        rows = [(x[0][len(path):],) + x[1:] for x in cur if x[0].startswith(path)]
+    if not rows:
+        flask.abort(404)
+
+    runs = _get_runs(cur, rows, chunk_size, index)
+    prefetcher = SpanPrefetcher(
+        [((x[0], x[1]), x[2]) for x in runs],
+        lambda first, n: ChainReader(
+            provider.iter_info(first[0], first[1], n), first[1], n, decrypt=True, auto_close=True,
+            fallback=True),
+        chunk_size, flask.current_app.config['ARCHIVE_WORKERS']
+    )
+
+    now = time.time()
+    name = (path.rstrip('/').rsplit('/', 1)[-1] or 'root') + '.' + fmt
+    headers = {'Content-Disposition': content_disposition(name, as_attachment=True)}
+    if fmt == 'tar':
+        tar_headers = []
+        for _, _, _, members in runs:
+            for member, _, length in members:
+                info = tarfile.TarInfo(member)
+                info.size, info.mtime, info.mode = length, int(now), 0o644
+                tar_headers.append(info.tobuf(tarfile.PAX_FORMAT))
+        headers['Content-Length'] = str(
+            sum(len(x) for x in tar_headers) + sum(x[2] + (-x[2] % tarfile.BLOCKSIZE) for x in rows)
+            + tarfile.BLOCKSIZE * 2)
+        stream = _iter_tar(runs, prefetcher, tar_headers)
+        mimetype = 'application/x-tar'
+    else:
+        stream = _iter_zip(runs, prefetcher, time.localtime(now)[:6])
+        mimetype = 'application/zip'
+
+    response = flask.Response(stream, headers=headers, mimetype=mimetype, direct_passthrough=True)
+    response.call_on_close(prefetcher.close)
+    return response
+
+
+def main(path=''):
+    if path == '' or path.endswith('/'):
+        return page_explorer(path)
+    else:
+        return send_file(path)
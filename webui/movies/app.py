@@ -0,0 +1,559 @@
+from pngbin import ChainReader, HeaderCache, Index, InfoProvider
+from webui.common import ConnectionPool, LRUCache, PrefixReader, file_etag, range_response
+
+import flask
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+import threading
+import functools
+import binascii
+import base64
+import json
+import random
+import time
+import sqlite3
+import html
+import os
+
+
+ITEMS_PER_ROW = 5
+ITEMS_PER_PAGE = 15  # should be a multiple of `ITEMS_PER_ROW`
+THUMBNAIL_MAX_AGE = 10 * 60  # seconds for browsers to cache thumbnails before revalidating them by ETag.
+
+WEB_TITLE = 'PngBin Movies'
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; rv:78.0) Gecko/20100101 Firefox/78.0'
+
+# A full-text search index of movies (external content FTS5 table), ranked by bm25 with title weighted the most.
+# And an index for browsing all movies in order of (year DESC, path ASC) with keyset pagination.
+SEARCH_INDEX_SQL = """
+DROP TABLE IF EXISTS "movies_fts";
+CREATE VIRTUAL TABLE "movies_fts" USING fts5(path, title, year, content='movies');
+INSERT INTO "movies_fts" ("movies_fts") VALUES ('rebuild');
+INSERT INTO "movies_fts" ("movies_fts", "rank") VALUES ('rank', 'bm25(1.0, 4.0, 2.0)');
+CREATE INDEX IF NOT EXISTS "idx_movies_year_path" ON "movies" ("year" DESC, "path" ASC);
+"""
+
+
+def create_app(meta_db: str = 'meta.db', movies_db: str = 'movies.db', header_file: str = None,
+               chunk_size: int = 1024, thumbnail_cache: int = 64, header_cache: int = 64,
+               home_cache_ttl: float = 0, pool_size: int = 8, index_file: str = None) -> flask.Flask:
+    """ Creates a PngBin Movies application, which can be served by any WSGI server.
+
+    Every application has its own pools of sqlite connections, HTTP session and in-memory caches (including
+    image info), so with a multi-process server (e.g. gunicorn) each worker process has its own ones.
+
+    :param meta_db: An sqlite database file contains the metadata of PngBin images.
+    :param movies_db: An sqlite database file contains movies info.
+    :param header_file: Path to line separated "key: value" text file for request headers.
+    :param chunk_size: Size in KiB of each chunk when streaming a file.
+    :param thumbnail_cache: Size in MiB of in-memory thumbnail cache.
+    :param header_cache: Size in MiB of in-memory cache of prefetched movie headers.
+    :param home_cache_ttl: Seconds to reuse the same random movies on the home page, 0 to disable.
+    :param pool_size: Maximum number of idle sqlite connections to keep for each database file.
+    :param index_file: Path to an index file created by "pngbin index" from `meta_db`, if given,
+                       it's used instead of querying the metadata database file.
+    :return: A Flask application.
+    """
+    assert os.path.isfile(meta_db), f'Database file "{meta_db}" does not exist.'
+    assert os.path.isfile(movies_db), f'Database file "{movies_db}" does not exist.'
+    assert header_file is None or os.path.isfile(header_file), f'Header file "{header_file}" does not exist.'
+    assert index_file is None or os.path.isfile(index_file), f'Index file "{index_file}" does not exist.'
+
+    with sqlite3.connect(f'file:{movies_db}?mode=ro', uri=True) as conn:
+        use_search_index = _has_search_index(conn)  # if False, searches by scanning the whole `movies` table.
+        use_seek_index = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='movie_headers';").fetchone() is not None
+    conn.close()
+
+    index = Index(index_file) if index_file else None
+    session = create_session(header_file)
+    app = flask.Flask(__name__, static_url_path='/__static__')
+    app.config.update(
+        META_DB=meta_db, MOVIES_DB=movies_db, CHUNK_SIZE=chunk_size * 1024, HOME_CACHE_TTL=home_cache_ttl,
+        USE_SEARCH_INDEX=use_search_index, USE_SEEK_INDEX=use_seek_index
+    )
+    app.extensions['pngbin'] = {
+        'meta_pool': ConnectionPool(meta_db, pool_size),
+        'index': index,
+        'movies_pool': ConnectionPool(movies_db, pool_size),
+        'session': session,
+        'info': create_info(meta_db, session, index),
+        'thumbnails': LRUCache(thumbnail_cache * 2**20),  # (path, mtime of movies database file) -> (etag, data)
+        # (images_id, offset, length) of a `files` row + (offset, length) of a header in the file -> bytes of
+        # container headers of movies, a changed `files` row or `movie_headers` row makes a new key.
+        'headers': LRUCache(header_cache * 2**20),
+        'prefetch': ThreadPoolExecutor(max_workers=4, thread_name_prefix='prefetch'),
+        'prefetching': {},  # the same key as `headers` -> Future of headers that are being fetched.
+        'prefetching_lock': threading.Lock(),
+        'home_cache': [0.0, '']  # [expire time, rendered html of random movies] for `home_cache_ttl`
+    }
+    app.teardown_appcontext(_close_conn)
+    app.add_url_rule('/', 'page_home', page_home)
+    app.add_url_rule('/search', 'page_search', page_search)
+    app.add_url_rule('/t/<string:path>', 'send_thumbnail', send_thumbnail)
+    app.add_url_rule('/f/<string:path>', 'send_file', send_file)
+
+    if not use_search_index:
+        app.logger.warning('Search index is missing or outdated, run with --build_index to make searching faster.')
+    if index is not None and index.is_outdated(meta_db):
+        app.logger.warning('Index file is older than the metadata database file, run "pngbin index" again.')
+    return app
+
+
+def create_session(header_file: str = None) -> requests.Session:
+    """ Creates an HTTP session for fetching PngBin images, with request headers from `header_file` if given. """
+    session = requests.Session()
+    if header_file:
+        with open(header_file, 'r') as fobj:
+            session.headers.update(line.strip().split(': ') for line in fobj if line.strip())
+    return session
+
+
+def create_info(meta_db: str, session: requests.Session, index: Index = None) -> InfoProvider:
+    """ Creates a provider of image info for readers, which fetches images with `session`. """
+    headers = HeaderCache()  # the header of each image is checked before it's read, see ChainReader.
+
+    def get_fobj(urls):
+        if not urls:
+            raise NetReaderError('The image has no urls.')
+        return headers.wrap(urls[0], _get_stream(session, urls[0]))
+    return InfoProvider(meta_db, get_fobj, index=index)
+
+
+def read_file(info, images_id, offset, first, length):
+    """ Returns `length` bytes at `first` of a file which starts at `offset` of `images_id` image,
+        image info is got from `info` (an InfoProvider). """
+    reader = ChainReader(info.iter_info(images_id, offset + first, length), offset + first, length,
+                         decrypt=True, auto_close=True, fallback=True)
+    try:
+        return reader.read(length)
+    finally:
+        reader.close()
+
+
+def _has_search_index(conn):
+    """ Returns True if the search index exists and is up-to-date with `movies` table. """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='movies_fts';").fetchone() is None:
+        return False
+    x = conn.execute('SELECT COUNT(), MAX(rowid) FROM movies_fts_docsize;')  # one row per indexed movie.
+    y = conn.execute('SELECT COUNT(), MAX(rowid) FROM movies;')
+    return x.fetchone() == y.fetchone()
+
+
+def _get_result_html(rows):
+    lines = []
+    i = -1
+    for i, row in enumerate(rows):
+        if i % ITEMS_PER_ROW == 0:
+            lines.append('<div class="row p-2">')
+
+        path, title, year = [html.escape(str(x)) for x in row]
+        lines.append('<div class="col text-center p-0">')
+        lines.append('<div class="container pl-2 pr-2 img-container">')
+        lines.append(f'<a href="/f/{path}">')
+        lines.append(f'<img src="/t/{path}" class="img-thumbnail p-0">')
+        lines.append('</a>')
+        lines.append('</div>')
+        lines.append(f'<p class="text-center mb-3"><strong>{title} ({year})</strong></p>')
+        lines.append('</div>')
+
+        if i % ITEMS_PER_ROW == ITEMS_PER_ROW - 1:
+            lines.append('</div>')
+
+    if i >= 0 and i % ITEMS_PER_ROW != ITEMS_PER_ROW - 1:
+        lines.append('</div>')
+
+    return '\n'.join(lines)
+
+
+class NetReaderError(Exception):
+    """ raises when error occurs during _get_stream(). """
+    pass
+
+
+def _get_stream(session, url):
+    def _fobj(first, last):
+        headers = {
+            'Range': f'bytes={first}-{"" if last is None else last}',
+            'User-Agent': USER_AGENT}
+        err = None
+        for _ in range(3):  # if failed, retries two more tries.
+            try:
+                response = session.get(url, headers=headers, stream=True, timeout=30.0)
+                if response.status_code != 206:
+                    raise NetReaderError('Invalid Status Code (Expect 206): ' + str(response.status_code))
+                ct = response.headers.get('Content-Type', '')
+                if ct != 'image/png':
+                    raise NetReaderError('Invalid Content-Type Header: ' + ct)
+                cl = response.headers.get('Content-Length', '')
+                if last is not None and cl != str((last - first) + 1):  # None is to the end (InflateReader).
+                    raise NetReaderError('Invalid Content-Length Header: ' + cl)
+                return response.raw
+            except requests.RequestException as e:
+                err = e
+        else:
+            raise err
+
+    return _fobj
+
+
+def _get_conn(db='movies', g=True):
+    """ Takes a connection of "meta" or "movies" database file from the pool,
+        if `g` is True, it's put back to the pool when the request ends. """
+    conn = flask.current_app.extensions['pngbin'][db + '_pool'].get()
+    if g:
+        flask.g.setdefault('conns', []).append((db, conn))
+    return conn
+
+
+def _close_conn(_=None):
+    for db, conn in flask.g.pop('conns', []):
+        flask.current_app.extensions['pngbin'][db + '_pool'].put(conn)
+
+
+@functools.lru_cache(maxsize=16)
+def _get_rowid_range(movies_db, mtime):
+    """ Returns (MIN(rowid), MAX(rowid)) of movies, `mtime` of the movies database file invalidates cached value. """
+    conn = sqlite3.connect(f'file:{movies_db}?mode=ro', uri=True)
+    try:
+        return conn.execute('SELECT MIN(rowid), MAX(rowid) FROM movies;').fetchone()
+    finally:
+        conn.close()
+
+
+def _sample_rows(cur, n):
+    """ Returns up to `n` random rows (path, title, year) by picking random rowids,
+        which are primary key lookups instead of sorting the whole table by RANDOM(). """
+    movies_db = flask.current_app.config['MOVIES_DB']
+    first, last = _get_rowid_range(movies_db, os.stat(movies_db).st_mtime)
+    if first is None:
+        return []
+
+    rows = {}
+    for _ in range(4):  # rowids can have gaps (deleted rows), so tries a few more times with bigger samples.
+        k = min((n - len(rows)) * 2, last - first + 1)
+        ids = random.sample(range(first, last + 1), k)
+        cur.execute('SELECT rowid, path, title, year '
+                    'FROM movies '
+                    f'WHERE rowid IN ({",".join("?" * len(ids))});',
+                    ids)
+        rows.update((x[0], x[1:]) for x in cur)
+        if len(rows) >= n:
+            break
+    else:
+        # Too sparse, falls back to the next existing rowid of random points.
+        for _ in range(n * 4):
+            if len(rows) >= n:
+                break
+            cur.execute('SELECT rowid, path, title, year FROM movies WHERE rowid >= ? ORDER BY rowid LIMIT 1;',
+                        (random.randint(first, last),))
+            row = cur.fetchone()
+            rows[row[0]] = row[1:]
+
+    return random.sample(list(rows.values()), min(n, len(rows)))
+
+
+def page_home():
+    home_cache = flask.current_app.extensions['pngbin']['home_cache']
+    ttl = flask.current_app.config['HOME_CACHE_TTL']
+    expire, result_html = home_cache
+    if time.monotonic() >= expire:
+        result_html = _get_result_html(_sample_rows(_get_conn().cursor(), ITEMS_PER_PAGE))
+        if ttl > 0:
+            home_cache[:] = [time.monotonic() + ttl, result_html]
+
+    return flask.render_template('movies.html', **{
+        'page_title': WEB_TITLE,
+        'result_text': 'Random Movies',
+        'result_html': result_html,
+        'search_query': '',
+        'pagination': {}
+    })
+
+
+def _get_match_query(query):
+    """ Converts a search query to an FTS5 query which matches every word as a prefix. """
+    words = ('"' + x.replace('"', '""') + '"*' for x in query.split())
+    return ' '.join(words)
+
+
+def _encode_cursor(x, y):
+    """ Encodes the sort key of a row into a cursor, values keep their types (e.g. a TEXT or NULL year). """
+    return base64.urlsafe_b64encode(json.dumps([x, y]).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(cursor):
+    """ Decodes a cursor of _encode_cursor() into (x, y), or None if it's empty. raises ValueError if invalid. """
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except binascii.Error:
+        raise ValueError('Invalid cursor.')
+    if not (isinstance(key, list) and len(key) == 2
+            and all(x is None or isinstance(x, (int, float, str)) for x in key)):
+        raise ValueError('Invalid cursor.')
+    return tuple(key)
+
+
+def _seek_rows(cur, query, after, before):
+    """ Returns a page of rows (path, title, year, cursor) by keyset pagination, and whether there are more rows
+        in the direction of paging. `after` and `before` are cursors of the last row of the previous page
+        and of the first row of the next page respectively, at most one of them should be given. """
+    backward = bool(before)
+    cursor = _decode_cursor(before or after)
+    params = []
+
+    if query:
+        # Each page is ordered by bm25 rank and rowid.
+        sql = 'SELECT path, title, year, rank, rowid FROM movies_fts WHERE movies_fts MATCH ?'
+        params.append(_get_match_query(query))
+        if cursor is not None:
+            sql += f' AND (rank {"<" if backward else ">"} ? OR (rank = ? AND rowid {"<" if backward else ">"} ?))'
+            params += [cursor[0], cursor[0], cursor[1]]
+        sql += ' ORDER BY rank DESC, rowid DESC' if backward else ' ORDER BY rank ASC, rowid ASC'
+    else:
+        # Each page is ordered by year and path, which is covered by `idx_movies_year_path` index.
+        # NULL years sort last in this order (first when backward), `IS` compares them like values.
+        sql = 'SELECT path, title, year, year, path FROM movies'
+        if cursor is not None:
+            if backward:
+                sql += ' WHERE (year > ? OR (year IS ? AND path < ?) OR (year IS NOT NULL AND ? IS NULL))'
+            else:
+                sql += ' WHERE (year < ? OR (year IS ? AND path > ?) OR (year IS NULL AND ? IS NOT NULL))'
+            params += [cursor[0], cursor[0], cursor[1], cursor[0]]
+        sql += ' ORDER BY year ASC, path DESC' if backward else ' ORDER BY year DESC, path ASC'
+
+    sql += ' LIMIT ?;'
+    params.append(ITEMS_PER_PAGE + 1)
+    rows = [(path, title, year, _encode_cursor(x, y)) for path, title, year, x, y in cur.execute(sql, params)]
+    has_more = len(rows) > ITEMS_PER_PAGE
+    del rows[ITEMS_PER_PAGE:]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+
+@functools.lru_cache(maxsize=1024)
+def _count_rows(movies_db, query, mtime):
+    """ Returns the number of search results, `mtime` of the movies database file invalidates cached values. """
+    conn = sqlite3.connect(f'file:{movies_db}?mode=ro', uri=True)
+    try:
+        if query:
+            sql = 'SELECT COUNT() FROM movies_fts WHERE movies_fts MATCH ?;'
+            return conn.execute(sql, (_get_match_query(query),)).fetchone()[0]
+        return conn.execute('SELECT COUNT() FROM movies;').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def page_search():
+    if not flask.current_app.config['USE_SEARCH_INDEX']:
+        return page_search_legacy()
+
+    query = flask.request.args.get('q', '').strip()
+    page = flask.request.args.get('p', '').strip()
+    after = flask.request.args.get('after', '')
+    before = flask.request.args.get('before', '')
+    page = int(page) if page.isdigit() and int(page) > 0 else 1
+    if not (after or before):
+        page = 1  # without a cursor, always starts at the first page.
+
+    movies_db = flask.current_app.config['MOVIES_DB']
+    cur = _get_conn().cursor()
+    try:
+        rows, has_more = _seek_rows(cur, query, after, before)
+        total = _count_rows(movies_db, query, os.stat(movies_db).st_mtime)
+    except (sqlite3.OperationalError, ValueError):
+        flask.abort(400)  # invalid FTS5 query syntax or cursor.
+
+    result_html = _get_result_html(x[:3] for x in rows)
+    result_text = f'Search result of "{query}". ' if query else 'Search all movies. '
+    result_text += f'Found {total} results' if total else 'NOT FOUND!'
+
+    prev_url = next_url = None
+    if rows and page > 1:
+        prev_url = '/search?' + urlencode({'q': query, 'p': page - 1, 'before': rows[0][3]})
+    if rows and (has_more or before):
+        next_url = '/search?' + urlencode({'q': query, 'p': page + 1, 'after': rows[-1][3]})
+
+    return flask.render_template('movies.html', **{
+        'page_title': WEB_TITLE + ' | ' + result_text,
+        'result_text': result_text,
+        'result_html': result_html,
+        'search_query': query,
+        'pagination': {'prev_url': prev_url, 'next_url': next_url}
+    })
+
+
+def page_search_legacy():
+    query = flask.request.args.get('q', '').strip()
+    page = flask.request.args.get('p', '').strip()
+
+    _query = '%' + query.replace(' ', '%') + '%'
+    page = int(page) if page.isdigit() else 1
+    offset = ITEMS_PER_PAGE * (page - 1)
+
+    cur = _get_conn().cursor()
+    if query:
+        result_text = f'Search result of "{query}". '
+        cur.execute('SELECT path, title, year '
+                    'FROM movies '
+                    'WHERE path LIKE ? '
+                    'ORDER BY year DESC, path ASC '
+                    f'LIMIT {ITEMS_PER_PAGE} OFFSET ?;',
+                    (_query, offset))
+    else:
+        result_text = 'Search all movies. '
+        cur.execute('SELECT path, title, year '
+                    'FROM movies '
+                    'ORDER BY year DESC, path ASC '
+                    f'LIMIT {ITEMS_PER_PAGE} OFFSET ?;',
+                    (offset,))
+    result_html = _get_result_html(cur)
+
+    if query:
+        cur.execute('SELECT COUNT() '
+                    'FROM movies '
+                    'WHERE path LIKE ?;',
+                    (_query,))
+    else:
+        cur.execute('SELECT COUNT() '
+                    'FROM movies;')
+    total = cur.fetchone()[0]
+
+    result_text += f'Found {total} results' if total else 'NOT FOUND!'
+    prev_url = '/search?' + urlencode({'q': query, 'p': page - 1}) if page > 1 else None
+    next_url = '/search?' + urlencode({'q': query, 'p': page + 1}) if page * ITEMS_PER_PAGE < total else None
+    return flask.render_template('movies.html', **{
+        'page_title': WEB_TITLE + ' | ' + result_text,
+        'result_text': result_text,
+        'result_html': result_html,
+        'search_query': query,
+        'pagination': {'prev_url': prev_url, 'next_url': next_url}
+    })
+
+
+def _read_thumbnail(conn, path):
+    """ Returns thumbnail data of `path` or None, reads the BLOB incrementally when sqlite3 supports it. """
+    row = conn.execute('SELECT rowid, length(thumbnail) FROM movies WHERE path = ?;', (path,)).fetchone()
+    if row is None or row[1] is None:
+        return None
+    if not hasattr(conn, 'blobopen'):  # Python < 3.11
+        return conn.execute('SELECT thumbnail FROM movies WHERE rowid = ?;', (row[0],)).fetchone()[0]
+    with conn.blobopen('movies', 'thumbnail', row[0], readonly=True) as blob:
+        return blob.read()
+
+
+def send_thumbnail(path):
+    thumbnails = flask.current_app.extensions['pngbin']['thumbnails']
+    mtime = os.stat(flask.current_app.config['MOVIES_DB']).st_mtime
+    item = thumbnails.get((path, mtime))
+    if item is None:
+        data = _read_thumbnail(_get_conn(), path)
+        if data is None:
+            flask.abort(404)
+        item = (file_etag(data), data)
+        thumbnails.put((path, mtime), item, len(data))
+
+    etag, data = item
+    headers = {
+        'ETag': f'"{etag}"',
+        'Cache-Control': f'public, max-age={THUMBNAIL_MAX_AGE}'
+    }
+    if flask.request.if_none_match.contains_weak(etag):
+        return flask.Response(status=304, headers=headers)
+    return flask.Response(data, mimetype='image/jpeg', headers=headers)
+
+
+def _fetch_header(ext, key):
+    """ Fetches a header into the headers cache, runs in the prefetch executor. """
+    try:
+        images_id, offset, _, first, length = key
+        data = read_file(ext['info'], images_id, offset, first, length)
+        ext['headers'].put(key, data, len(data))
+        return data
+    finally:
+        with ext['prefetching_lock']:
+            ext['prefetching'].pop(key, None)
+
+
+def _prefetch_headers(path, row):
+    """ Starts fetching the container headers of a movie that are not cached yet in background,
+        returns a list of cache keys of the headers (see `headers` in create_app).
+
+    :param row: (images_id, offset, length) of the movie in `files` table.
+    """
+    if not flask.current_app.config['USE_SEEK_INDEX']:
+        return []
+
+    ext = flask.current_app.extensions['pngbin']
+    cur = _get_conn().cursor()
+    keys = [row + x for x in cur.execute('SELECT offset, length FROM movie_headers WHERE path=?;', (path,))
+            if x[0] + x[1] <= row[2]]  # headers of an outdated `movie_headers` row might not fit in the file.
+    with ext['prefetching_lock']:
+        for key in keys:
+            if key not in ext['prefetching'] and ext['headers'].get(key) is None:
+                ext['prefetching'][key] = ext['prefetch'].submit(_fetch_header, ext, key)
+    return keys
+
+
+def _get_header(ext, keys, first):
+    """ Returns (offset, data) of a cached header that contains `first` byte of a movie, or None.
+        If the header is being fetched right now, waits for it instead of fetching the same bytes again,
+        but a header that is still queued behind others is not waited for. """
+    for key in keys:
+        offset, length = key[3:]
+        if offset <= first < offset + length:
+            data = ext['headers'].get(key)
+            if data is None:
+                with ext['prefetching_lock']:
+                    future = ext['prefetching'].get(key)
+                try:
+                    data = future.result(timeout=60.0) if future is not None and future.running() else None
+                except Exception:
+                    data = None  # failed prefetching, reads from upstream as usual.
+            return (offset, data) if data is not None else None
+    return None
+
+
+def send_file(path):
+    # The response is streamed after the request context is gone, so takes everything it needs now.
+    ext = flask.current_app.extensions['pngbin']
+    index = ext['index']
+    if index is not None:
+        row = index.lookup(path)
+        try:
+            row = row and row + (index.get_image(row[2])[0],)
+        except KeyError:
+            row = row + (None,)
+    else:
+        cur = _get_conn('meta').cursor()
+        cur.execute('SELECT f.offset, f.length, f.images_id, i.key '
+                    'FROM files f LEFT JOIN images i ON i.id = f.images_id '
+                    'WHERE f.path=?;', (path,))
+        row = cur.fetchone()
+    if row is None or (row[3] is None and row[1] > 0):  # an empty file doesn't need its image.
+        flask.abort(404)
+
+    offset, length, images_id, key = row
+    headers = _prefetch_headers(path, (images_id, offset, length))
+
+    def _open_reader(first, n):
+        def _open(x, m):
+            return ChainReader(ext['info'].iter_info(images_id, offset + first + x, m), offset + first + x, m,
+                               decrypt=True, auto_close=True, fallback=True)
+
+        header = _get_header(ext, headers, first)
+        if header is None:
+            return _open(0, n)
+        return PrefixReader(memoryview(header[1])[first - header[0]:], n, _open)
+
+    return range_response(
+        length, file_etag(images_id, offset, length, key), _open_reader,
+        name=os.path.split(path)[1],
+        as_attachment='dl' in flask.request.args,
+        chunk_size=flask.current_app.config['CHUNK_SIZE']
+    )
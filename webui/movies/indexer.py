@@ -0,0 +1,336 @@
+from typing import Callable, Iterable, List, Optional, Tuple
+import struct
+import sqlite3
+import sys
+
+
+# ====================================================================================================================
+# An offline indexer of movie containers (MP4 and Matroska/WebM) for PngBin Movies.
+#
+# A browser that plays or seeks a movie first probes the container metadata (MP4 "moov" box or Matroska
+# SeekHead/Info/Tracks/Cues elements), which is usually at the beginning and/or at the end of the file.
+# The indexer records byte ranges of that metadata and a time -> byte offset table of keyframes
+# into the movies database file, so the server can prefetch the metadata when a movie is opened
+# and answer those probes from memory instead of going upstream for each of them.
+#
+# `read` callables used below take (offset, length) and return bytes of the movie file.
+# ====================================================================================================================
+SEEK_INDEX_SQL = """
+CREATE TABLE IF NOT EXISTS "movie_headers" (
+    "path"   TEXT NOT NULL,
+    "offset" INTEGER NOT NULL,
+    "length" INTEGER NOT NULL,
+    PRIMARY KEY ("path", "offset")
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS "movie_keyframes" (
+    "path"   TEXT NOT NULL,
+    "time"   REAL NOT NULL,
+    "offset" INTEGER NOT NULL,
+    PRIMARY KEY ("path", "time")
+) WITHOUT ROWID;
+"""
+
+MAX_HEADER_SIZE = 64 * 2**20  # a larger container metadata is considered invalid.
+
+
+class ContainerError(Exception):
+    """ raises when a movie file is not a supported container or its metadata is invalid. """
+    pass
+
+
+def parse_movie(read: Callable[[int, int], bytes], size: int) -> Tuple[List[tuple], List[tuple]]:
+    """ Parses the container metadata of a movie file.
+
+    :param read: A callable that takes (offset, length) and returns bytes of the movie file.
+    :param size: Length in bytes of the movie file.
+    :return: A tuple of (headers, keyframes), headers is a list of tuple (offset, length) of metadata byte ranges
+             and keyframes is a list of tuple (time in seconds, byte offset).
+    """
+    magic = read(0, min(8, size))
+    if magic[:4] == b'\x1a\x45\xdf\xa3':
+        return _parse_mkv(read, size)
+    if magic[4:8] in (b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide'):
+        return _parse_mp4(read, size)
+    raise ContainerError('Unsupported container format.')
+
+
+def build_seek_index(conn: sqlite3.Connection, movies: Iterable[tuple], rebuild: bool = False) -> int:
+    """ Indexes movies into `movie_headers` and `movie_keyframes` tables, movies that fail are reported to stderr.
+
+    :param conn: A writable connection of the movies database file.
+    :param movies: An iterable of tuple (path, size, read) of movies.
+    :param rebuild: If False, skips movies that are already indexed.
+    :return: Number of indexed movies.
+    """
+    with conn:
+        conn.executescript(SEEK_INDEX_SQL)
+    indexed = {x[0] for x in conn.execute('SELECT DISTINCT path FROM movie_headers;')}
+
+    n = 0
+    for path, size, read in movies:
+        if path in indexed and not rebuild:
+            continue
+        try:
+            headers, keyframes = parse_movie(read, size)
+        except Exception as e:
+            print(f'Warning: "{path}" cannot be indexed. ({type(e).__name__}: {e})', file=sys.stderr)
+            continue
+
+        with conn:  # one transaction per movie, so an interrupted run keeps the indexed movies.
+            conn.execute('DELETE FROM movie_headers WHERE path=?;', (path,))
+            conn.execute('DELETE FROM movie_keyframes WHERE path=?;', (path,))
+            conn.executemany('INSERT INTO movie_headers VALUES (?, ?, ?);', ((path, *x) for x in headers))
+            conn.executemany('INSERT OR IGNORE INTO movie_keyframes VALUES (?, ?, ?);',
+                             ((path, *x) for x in keyframes))
+        n += 1
+    return n
+
+
+def _merge(ranges: list) -> list:
+    """ returns sorted (offset, length) ranges with adjacent and overlapping ones merged. """
+    merged = []
+    for offset, length in sorted(ranges):
+        if merged and offset <= merged[-1][0] + merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], offset + length - merged[-1][0])
+        else:
+            merged.append([offset, length])
+    return [tuple(x) for x in merged]
+
+
+# ====================================================================================================================
+# MP4 (ISO base media file format)
+# ====================================================================================================================
+def _iter_boxes(read: Callable, first: int, last: int):
+    """ yields (type, box offset, data offset, end offset) of boxes from `first` to `last`. """
+    pos = first
+    while pos + 8 <= last:
+        header = read(pos, min(16, last - pos))
+        size, kind = struct.unpack_from('>I4s', header)
+        data = pos + 8
+        if size == 1:
+            if len(header) < 16:
+                raise ContainerError('Truncated box header.')
+            size = struct.unpack_from('>Q', header, 8)[0]
+            data += 8
+        elif size == 0:  # the last box extends to the end.
+            size = last - pos
+        if pos + size < data or pos + size > last:
+            raise ContainerError(f'Invalid size of "{kind.decode("latin-1")}" box at {pos}.')
+        yield kind, pos, data, pos + size
+        pos += size
+
+
+def _find_box(data: bytes, first: int, last: int, *path: bytes) -> Optional[Tuple[int, int]]:
+    """ returns (data offset, end offset) of the first box at `path` within `data`, or None. """
+    read = lambda offset, length: data[offset:offset + length]
+    for kind, _, box_first, box_last in _iter_boxes(read, first, last):
+        if kind == path[0]:
+            return (box_first, box_last) if len(path) == 1 else _find_box(data, box_first, box_last, *path[1:])
+    return None
+
+
+def _parse_mp4(read: Callable, size: int):
+    headers = []
+    moov = None
+    for kind, pos, first, end in _iter_boxes(read, 0, size):
+        if kind in (b'mdat', b'moof'):
+            if moov is not None:
+                break  # the rest is media data, don't walk through every fragment.
+            continue
+        if end - pos > MAX_HEADER_SIZE:
+            raise ContainerError(f'"{kind.decode("latin-1")}" box is too large.')
+        headers.append((pos, end - pos))
+        if kind == b'moov':
+            moov = (pos, first, end)
+    if moov is None:
+        raise ContainerError('"moov" box is missing.')
+
+    data = read(moov[0], moov[2] - moov[0])
+    return _merge(headers), _get_mp4_keyframes(data, moov[1] - moov[0])
+
+
+def _get_mp4_keyframes(moov: bytes, first: int) -> list:
+    """ returns keyframes (time, offset) of the first video track of a "moov" box with data at `first`. """
+    read = lambda offset, length: moov[offset:offset + length]
+    for kind, _, first, last in _iter_boxes(read, first, len(moov)):
+        if kind != b'trak':
+            continue
+        hdlr = _find_box(moov, first, last, b'mdia', b'hdlr')
+        if hdlr is None or moov[hdlr[0] + 8:hdlr[0] + 12] != b'vide':
+            continue
+
+        mdhd = _find_box(moov, first, last, b'mdia', b'mdhd')
+        stbl = _find_box(moov, first, last, b'mdia', b'minf', b'stbl')
+        if mdhd is None or stbl is None:
+            raise ContainerError('Video track has no "mdhd" or "stbl" box.')
+        timescale = struct.unpack_from('>I', moov, mdhd[0] + (12 if moov[mdhd[0]] == 0 else 20))[0]
+        if timescale == 0:
+            raise ContainerError('Video track has zero timescale.')
+
+        table = lambda name, fmt: _get_mp4_table(moov, _find_box(moov, *stbl, name), fmt)
+        stts = table(b'stts', 'II')
+        stsc = table(b'stsc', 'III')
+        stss = table(b'stss', 'I')
+        offsets = table(b'stco', 'I') or table(b'co64', 'Q')
+        stsz = _find_box(moov, *stbl, b'stsz')
+        if stts is None or stsc is None or offsets is None or stsz is None:
+            raise ContainerError('Video track has missing sample tables.')
+        sample_size, count = struct.unpack_from('>II', moov, stsz[0] + 4)
+        sizes = struct.unpack_from(f'>{count}I', moov, stsz[0] + 12) if sample_size == 0 else None
+
+        sync = [x[0] - 1 for x in stss] if stss is not None else range(count)  # 0-based sample numbers.
+        offsets = [x[0] for x in offsets]
+        return _get_sync_samples(sync, stts, stsc, offsets, sizes, sample_size, timescale)
+    return []
+
+
+def _get_mp4_table(moov: bytes, box: Optional[tuple], fmt: str) -> Optional[list]:
+    """ returns entries of a full box with an entry count (e.g. "stts"), each entry is a tuple of `fmt`. """
+    if box is None:
+        return None
+    count = struct.unpack_from('>I', moov, box[0] + 4)[0]
+    if box[0] + 8 + count * struct.calcsize('>' + fmt) > box[1]:
+        raise ContainerError('Truncated sample table.')
+    return list(struct.iter_unpack('>' + fmt, moov[box[0] + 8:box[0] + 8 + count * struct.calcsize('>' + fmt)]))
+
+
+def _get_sync_samples(sync, stts, stsc, offsets, sizes, sample_size, timescale) -> list:
+    """ returns (time, offset) of each sync sample, `sync` is sorted sample numbers. """
+    keyframes = []
+    sync = iter(sync)
+    target = next(sync, None)
+
+    time = 0
+    run, run_left = 0, stts[0][0] if stts else 0  # "stts" is runs of (sample count, time delta).
+    entry = 0  # "stsc" is entries of (first chunk, samples per chunk, sample description index).
+    sample = 0
+    for chunk, offset in enumerate(offsets, 1):
+        while entry + 1 < len(stsc) and stsc[entry + 1][0] <= chunk:
+            entry += 1
+        for _ in range(stsc[entry][1] if stsc else 0):
+            if target is None:
+                return keyframes
+            while run_left == 0 and run + 1 < len(stts):
+                run += 1
+                run_left = stts[run][0]
+
+            if sample == target:
+                keyframes.append((time / timescale, offset))
+                target = next(sync, None)
+            offset += sizes[sample] if sizes is not None else sample_size
+            time += stts[run][1] if run_left else 0
+            run_left -= 1 if run_left else 0
+            sample += 1
+    return keyframes
+
+
+# ====================================================================================================================
+# Matroska (and WebM)
+# ====================================================================================================================
+_EBML = 0x1A45DFA3
+_SEGMENT = 0x18538067
+_SEEK_HEAD = 0x114D9B74
+_SEEK = 0x4DBB
+_SEEK_ID = 0x53AB
+_SEEK_POSITION = 0x53AC
+_INFO = 0x1549A966
+_TIMECODE_SCALE = 0x2AD7B1
+_CLUSTER = 0x1F43B675
+_CUES = 0x1C53BB6B
+_CUE_POINT = 0xBB
+_CUE_TIME = 0xB3
+_CUE_TRACK_POSITIONS = 0xB7
+_CUE_CLUSTER_POSITION = 0xF1
+
+
+def _read_vint(data: bytes, pos: int, is_id: bool = False) -> Tuple[Optional[int], int]:
+    """ returns (value, length) of an EBML variable size integer, value is None for an unknown size. """
+    if pos >= len(data) or data[pos] == 0:
+        raise ContainerError(f'Invalid EBML integer at {pos}.')
+    length = 9 - data[pos].bit_length()
+    if pos + length > len(data):
+        raise ContainerError(f'Truncated EBML integer at {pos}.')
+    value = int.from_bytes(data[pos:pos + length], 'big')
+    if is_id:
+        return value, length
+    value &= (1 << (7 * length)) - 1
+    return (None if value == (1 << (7 * length)) - 1 else value), length
+
+
+def _read_element(data: bytes, pos: int) -> Tuple[int, int, Optional[int]]:
+    """ returns (id, data offset, data length) of an element header at `pos` of `data`. """
+    eid, n = _read_vint(data, pos, True)
+    size, m = _read_vint(data, pos + n)
+    return eid, pos + n + m, size
+
+
+def _iter_elements(data: bytes, first: int, last: int):
+    """ yields (id, data offset, end offset) of elements from `first` to `last` of `data`. """
+    pos = first
+    while pos < last:
+        eid, pos, size = _read_element(data, pos)
+        end = last if size is None else pos + size
+        yield eid, pos, end
+        pos = end
+
+
+def _read_element_at(read: Callable, pos: int, size: int) -> Tuple[int, int, Optional[int]]:
+    """ returns (id, data offset, data length) of an element header at `pos` of the file. """
+    eid, first, length = _read_element(read(pos, min(12, size - pos)), 0)
+    return eid, pos + first, length
+
+
+def _parse_mkv(read: Callable, size: int):
+    eid, first, length = _read_element_at(read, 0, size)  # EBML header
+    if eid != _EBML or length is None:
+        raise ContainerError('Invalid EBML header.')
+    eid, segment, length = _read_element_at(read, first + length, size)
+    if eid != _SEGMENT:
+        raise ContainerError('Segment element is missing.')
+    segment_end = size if length is None else min(segment + length, size)
+
+    # Walks the top-level elements up to the first cluster, that is the header a player reads first.
+    timecode_scale = 1000000
+    cues = None
+    pos = segment
+    while pos < segment_end:
+        eid, first, length = _read_element_at(read, pos, size)
+        if eid == _CLUSTER or length is None:
+            break
+        if length > MAX_HEADER_SIZE:
+            raise ContainerError(f'Element {eid:X} at {pos} is too large.')
+        if eid == _CUES:
+            cues = pos
+        elif eid in (_SEEK_HEAD, _INFO):
+            data = read(first, length)
+            for child, child_first, child_last in _iter_elements(data, 0, len(data)):
+                if child == _TIMECODE_SCALE:
+                    timecode_scale = int.from_bytes(data[child_first:child_last], 'big')
+                elif child == _SEEK:
+                    seek = {x[0]: data[x[1]:x[2]] for x in _iter_elements(data, child_first, child_last)}
+                    if seek.get(_SEEK_ID) == _CUES.to_bytes(4, 'big') and _SEEK_POSITION in seek:
+                        cues = segment + int.from_bytes(seek[_SEEK_POSITION], 'big')
+        pos = first + length
+    headers = [(0, pos)]
+
+    keyframes = []
+    if cues is not None:
+        eid, first, length = _read_element_at(read, cues, size)
+        if eid != _CUES or length is None or length > MAX_HEADER_SIZE:
+            raise ContainerError(f'Invalid Cues element at {cues}.')
+        headers.append((cues, first + length - cues))
+        data = read(first, length)
+        for eid, point_first, point_last in _iter_elements(data, 0, len(data)):
+            if eid != _CUE_POINT:
+                continue
+            time = offset = None
+            for child, child_first, child_last in _iter_elements(data, point_first, point_last):
+                if child == _CUE_TIME:
+                    time = int.from_bytes(data[child_first:child_last], 'big')
+                elif child == _CUE_TRACK_POSITIONS and offset is None:
+                    for x in _iter_elements(data, child_first, child_last):
+                        if x[0] == _CUE_CLUSTER_POSITION:
+                            offset = segment + int.from_bytes(data[x[1]:x[2]], 'big')
+            if time is not None and offset is not None:
+                keyframes.append((time * timecode_scale / 1e9, offset))
+    return _merge(headers), keyframes